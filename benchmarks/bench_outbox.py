@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the cost the delivery outbox adds to each delivery.
+
+This commits transactions that each create delivery attempts for a
+persistent subscription in a FileStorage, once without the outbox
+and once with it, then measures removing the completed outbox entries.
+The difference, divided by the number of attempts, is the overhead
+per delivery. HTTP is not involved; the work that is the same
+either way is left out.
+
+Usage::
+
+    python benchmarks/bench_outbox.py [--transactions N] [--attempts N]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import transaction
+from persistent import Persistent
+from zope import component
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.interfaces import IDatabase
+
+from nti.webhooks.attempts import PersistentWebhookDeliveryAttempt
+from nti.webhooks.outbox import DeliveryOutbox
+
+try:
+    _clock = time.perf_counter
+except AttributeError: # Py2
+    _clock = time.time
+
+
+class Subscription(Persistent):
+    pass
+
+
+def _commit_attempts(db, transactions, attempts, outbox):
+    tx_manager = transaction.TransactionManager(explicit=True)
+    conn = db.open(transaction_manager=tx_manager)
+    with tx_manager:
+        sub = conn.root()['sub'] = Subscription()
+    keys = []
+    begin = _clock()
+    for _ in range(transactions):
+        with tx_manager:
+            created = []
+            for _ in range(attempts):
+                attempt = PersistentWebhookDeliveryAttempt()
+                attempt.payload_data = u'{"id": 1}'
+                attempt.__parent__ = sub
+                created.append(attempt)
+            # Roughly what the subscription does when it stores them.
+            sub.attempts = tuple(created)
+            if outbox is not None:
+                keys.append(outbox.record([(sub, a) for a in created]))
+    elapsed = _clock() - begin
+    conn.close()
+    return elapsed, keys
+
+
+def _complete(db, outbox, keys):
+    # Full batches of completions are flushed to the IDatabase
+    # utility, as they would be in an application.
+    gsm = component.getGlobalSiteManager()
+    gsm.registerUtility(db, IDatabase)
+    try:
+        begin = _clock()
+        for k in keys:
+            outbox.complete(k)
+        outbox.flush(db)
+        return _clock() - begin
+    finally:
+        gsm.unregisterUtility(db, IDatabase)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--transactions', type=int, default=500)
+    parser.add_argument('--attempts', type=int, default=5,
+                        help="Delivery attempts created per transaction.")
+    args = parser.parse_args()
+    deliveries = args.transactions * args.attempts
+
+    tmp = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name in ('baseline', 'outbox'):
+            db = DB(FileStorage(os.path.join(tmp, name + '.fs')))
+            outbox = DeliveryOutbox() if name == 'outbox' else None
+            try:
+                results[name], keys = _commit_attempts(db, args.transactions,
+                                                       args.attempts, outbox)
+                if outbox is not None:
+                    results['complete'] = _complete(db, outbox, keys)
+            finally:
+                db.close()
+    finally:
+        shutil.rmtree(tmp)
+
+    per = lambda seconds: seconds / deliveries * 1e6
+    print("%d deliveries in %d transactions" % (deliveries, args.transactions))
+    print("Commit without outbox: %8.1f us/delivery" % per(results['baseline']))
+    print("Commit with outbox:    %8.1f us/delivery" % per(results['outbox']))
+    print("Remove completed:      %8.1f us/delivery" % per(results['complete']))
+    print("Overhead:              %8.1f us/delivery" % per(
+        results['outbox'] + results['complete'] - results['baseline']))
+
+
+if __name__ == '__main__':
+    main()
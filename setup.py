@@ -97,6 +97,10 @@ setup(
     include_package_data=True,
     extras_require={
         'test': TESTS_REQUIRE,
+        # Used by nti.webhooks.asyncio_executor
+        'asyncio': [
+            'aiohttp; python_version >= "3.6"',
+        ],
         'docs': [
             'Sphinx',
             # sphinx_rtd_theme 0.5.2 requires docutils < 0.17,
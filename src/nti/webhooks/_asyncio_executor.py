@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+The implementation of :mod:`nti.webhooks.asyncio_executor`.
+
+This uses syntax that only Python 3 understands, so it must only be
+imported from there.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import datetime
+import threading
+import time
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from zope import interface
+
+from nti.webhooks.delivery_manager import IExecutorService
+from nti.webhooks.delivery_manager import ScheduledWorkUnit
+from nti.webhooks.delivery_manager import ThreadPoolExecutorService
+
+try:
+    import aiohttp
+except ImportError: # pragma: no cover
+    aiohttp = None
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _as_requests_response(prepared_request, aio_response, content, elapsed):
+    # The rest of the delivery code (and dialects) work with
+    # ``requests`` objects.
+    response = Response()
+    response.status_code = aio_response.status
+    response.reason = aio_response.reason
+    response.headers = CaseInsensitiveDict(aio_response.headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = str(aio_response.url)
+    response.request = prepared_request
+    response.elapsed = datetime.timedelta(seconds=elapsed)
+    response._content = content # pylint:disable=protected-access
+    return response
+
+
+def _which_timeout(ex, connect, read, total):
+    # aiohttp 3.10 added distinct exceptions; before that, both
+    # connect and read timeouts were a ServerTimeoutError.
+    connection_timeout_error = getattr(aiohttp, 'ConnectionTimeoutError', None)
+    if connection_timeout_error is not None and isinstance(ex, connection_timeout_error):
+        return connect
+    if isinstance(ex, aiohttp.ServerTimeoutError):
+        return connect if str(ex).startswith('Connection timeout') else read
+    return total
+
+
+@interface.implementer(IExecutorService)
+class AsyncioExecutorService(ThreadPoolExecutorService):
+    """
+    Runs an :mod:`asyncio` event loop in a daemon thread and delivers
+    :class:`nti.webhooks.delivery_manager.ScheduledWorkUnit` objects
+    using it.
+
+    Other callables that are submitted are run in the pool of
+    threads.
+
+    Tasks are admitted as they are by
+    :class:`~nti.webhooks.delivery_manager.ThreadPoolExecutorService`,
+    except that up to :attr:`max_in_flight` of them may run at once:
+    others wait in a queue holding no more than ``max_queue_depth``,
+    and the ``overflow_policy`` decides what happens when it is full.
+    """
+
+    #: The maximum number of tasks that may be running at once.
+    max_in_flight = 1000
+
+    #: The number of threads used for blocking work, such as
+    #: recording results.
+    max_workers = 10
+
+    #: Whether to make requests using aiohttp, if it is installed.
+    use_aiohttp = True
+
+    _client_session = None
+
+    def __init__(self, max_in_flight=None):
+        super(AsyncioExecutorService, self).__init__()
+        if max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+        self._slots = self.max_in_flight
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_loop,
+            args=(started,),
+            name='WebhookDeliveryManagerLoop')
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self.loop)
+        # Tasks submitted from the loop, such as the next unit for
+        # a host, must never wait for room.
+        self._local.worker = True
+        try:
+            self.loop.run_until_complete(self._start_session())
+        finally:
+            started.set()
+        self.loop.run_forever()
+
+    async def _start_session(self):
+        if aiohttp is not None and self.use_aiohttp:
+            self._client_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                # As with the requests session, receivers don't get to
+                # set cookies.
+                cookie_jar=aiohttp.DummyCookieJar())
+
+    def _start(self, func, queued_at):
+        asyncio.run_coroutine_threadsafe(self._work_async(func, queued_at), self.loop)
+
+    async def _work_async(self, func, queued_at):
+        # The counterpart of ThreadPoolExecutorService._work.
+        while func is not None:
+            self._task_started(queued_at)
+            try:
+                await self._execute(func)
+            except Exception as ex: # pylint:disable=broad-except
+                self._task_failed(ex)
+            if self.drain_handler is not None and not self._queue:
+                await self._in_thread(self._call, self.drain_handler)
+            func, queued_at = self._next_task() or (None, None)
+
+    def _in_thread(self, func, *args):
+        return self.loop.run_in_executor(self.executor, self._as_worker, func, args)
+
+    def _as_worker(self, func, args):
+        self._local.worker = True
+        return func(*args)
+
+    async def _execute(self, func):
+        if not isinstance(func, ScheduledWorkUnit):
+            return await self._in_thread(func)
+        try:
+            deferred = await self._deliver(func)
+        finally:
+            func.finished()
+        if deferred is not None:
+            func.defer(deferred)
+
+    async def _deliver(self, func):
+        # This mirrors DestinationWorkUnit.deliver.
+        # pylint:disable=protected-access
+        unit = func.unit
+        http_session = func.http_session
+        manager = func.manager
+        shipment = unit.shipment
+        for result in unit._sendable(manager):
+            try:
+                if shipment._blocks_before_send(result):
+                    await self._in_thread(shipment._before_send, result)
+                prepared_request = shipment._prepare_request(http_session, result)
+                result.http_response = await self._send(shipment, http_session,
+                                                        prepared_request, result)
+            except Exception: # pylint:disable=broad-except
+                shipment._send_failed(result)
+            unit._sent(result, manager)
+        return await self._in_thread(unit._finish)
+
+    async def _send(self, shipment, http_session, prepared_request, result):
+        # pylint:disable=protected-access
+        if self._client_session is None:
+            return await self._in_thread(shipment._send_request,
+                                         http_session,
+                                         prepared_request,
+                                         result)
+        connect, read, total = shipment._request_timeouts(result)
+        start = result.sentTime = time.time()
+        try:
+            async with self._client_session.request(
+                    prepared_request.method,
+                    prepared_request.url,
+                    headers=prepared_request.headers,
+                    data=prepared_request.body,
+                    timeout=aiohttp.ClientTimeout(total=total[1],
+                                                  sock_connect=connect[1],
+                                                  sock_read=read[1])) as aio_response:
+                content = await aio_response.read()
+        except asyncio.TimeoutError as ex:
+            result.timeout = _which_timeout(ex, connect, read, total)
+            raise
+        return _as_requests_response(prepared_request, aio_response, content,
+                                     time.time() - start)
+
+    async def _stop(self):
+        if self._client_session is not None:
+            await self._client_session.close()
+            self._client_session = None
+
+    def shutdown(self):
+        if not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+        super(AsyncioExecutorService, self).shutdown()
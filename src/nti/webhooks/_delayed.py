@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Calling functions after a delay.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import heapq
+import threading
+import time
+from itertools import count
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class DelayedCalls(object):
+    """
+    Calls functions after a delay, from a single daemon thread.
+
+    The functions should be quick; typically, they submit work to
+    an executor. The thread is started when first needed.
+    """
+
+    def __init__(self, name='WebhookDelayedCalls'):
+        self._name = name
+        self._cond = threading.Condition()
+        # [(when, counter, func)]
+        self._heap = []
+        self._counter = count()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        """
+        The number of calls waiting for their time.
+        """
+        return len(self._heap)
+
+    def call_later(self, delay, func):
+        """
+        Call *func* with no arguments in *delay* seconds.
+        """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Stopped")
+            heapq.heappush(self._heap, (time.time() + delay, next(self._counter), func))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        func = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            try:
+                func()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to call %r", func)
+
+    def stop(self):
+        """
+        Stop the thread. Calls that haven't been made are forgotten.
+        """
+        with self._cond:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            del self._heap[:]
+            self._cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
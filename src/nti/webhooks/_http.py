@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP connection pooling used by the delivery manager.
+
+This builds on the connection pooling that :mod:`requests` gets from
+:mod:`urllib3`, adding per-host pool sizes, eviction of connections
+that have been idle too long or that have simply lived too long, and
+counters describing how well connections are being reused.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError: # Py2
+    from cookielib import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.poolmanager import PoolManager
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class ConnectionPoolStatistics(object):
+    """
+    Thread-safe counters describing connection use.
+
+    .. attribute:: new_connections
+
+       Connections that had to be opened.
+
+    .. attribute:: reused_connections
+
+       Connections that were already open and were used again.
+
+    .. attribute:: idle_evictions
+
+       Open connections that were closed because they had been idle
+       for longer than the idle timeout.
+
+    .. attribute:: lifetime_evictions
+
+       Open connections that were closed because they had been open
+       longer than the maximum lifetime.
+    """
+
+    _FIELDS = (
+        'new_connections',
+        'reused_connections',
+        'idle_evictions',
+        'lifetime_evictions',
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self._FIELDS, 0)
+
+    def __getattr__(self, name):
+        if name in self._FIELDS:
+            return self._counts[name]
+        raise AttributeError(name)
+
+    def increment(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self._FIELDS, 0)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def __repr__(self):
+        return '<%s %s>' % (
+            type(self).__name__,
+            ' '.join('%s=%s' % kv for kv in sorted(self.as_dict().items()))
+        )
+
+
+class _EvictingConnectionMixin(object):
+    """
+    Tracks when each connection was opened and last used, closing
+    (and thus re-opening) those that are too old when they are used
+    again.
+
+    This only uses the public ``connect`` and ``request`` methods of
+    :class:`urllib3.connection.HTTPConnection`; a connection that is
+    closed reconnects when a request is sent.
+    """
+
+    # These are set on the subclasses made for each pool manager.
+    idle_timeout = None
+    max_lifetime = None
+    statistics = None
+
+    _nti_opened_at = None
+    _nti_used_at = None
+
+    def connect(self):
+        super(_EvictingConnectionMixin, self).connect()
+        self._nti_opened_at = time.time()
+        if self.statistics is not None:
+            self.statistics.increment('new_connections')
+
+    def request(self, *args, **kwargs): # pylint:disable=arguments-differ
+        if getattr(self, 'sock', None) is not None:
+            self._reuse_or_close(time.time())
+        try:
+            return super(_EvictingConnectionMixin, self).request(*args, **kwargs)
+        finally:
+            self._nti_used_at = time.time()
+
+    def _reuse_or_close(self, now):
+        evict = None
+        opened = self._nti_opened_at if self._nti_opened_at is not None else now
+        last_used = self._nti_used_at if self._nti_used_at is not None else now
+        if self.max_lifetime is not None and now - opened >= self.max_lifetime:
+            evict = 'lifetime_evictions'
+        elif self.idle_timeout is not None and now - last_used >= self.idle_timeout:
+            evict = 'idle_evictions'
+        stats = self.statistics
+        if evict is None:
+            if stats is not None:
+                stats.increment('reused_connections')
+            return
+        logger.debug("Closing connection to %s (%s)", self.host, evict)
+        self.close()
+        if stats is not None:
+            stats.increment(evict)
+
+
+def _evicting_pool_classes(idle_timeout, max_lifetime, statistics):
+    # Connection pools for each scheme whose connections have these
+    # settings; see ``PoolManager.pool_classes_by_scheme`` and
+    # ``HTTPConnectionPool.ConnectionCls``.
+    settings = {
+        'idle_timeout': idle_timeout,
+        'max_lifetime': max_lifetime,
+        'statistics': statistics,
+    }
+    pool_classes = {}
+    for scheme, pool_class in (('http', HTTPConnectionPool), ('https', HTTPSConnectionPool)):
+        connection_class = type('_Evicting' + pool_class.ConnectionCls.__name__,
+                                (_EvictingConnectionMixin, pool_class.ConnectionCls),
+                                settings)
+        pool_classes[scheme] = type('_Evicting' + pool_class.__name__,
+                                    (pool_class,),
+                                    {'ConnectionCls': connection_class})
+    return pool_classes
+
+
+class _EvictingPoolManager(PoolManager):
+
+    def __init__(self, host_pool_sizes, idle_timeout, max_lifetime, statistics, **kwargs):
+        super(_EvictingPoolManager, self).__init__(**kwargs)
+        self.host_pool_sizes = host_pool_sizes
+        self.pool_classes_by_scheme = _evicting_pool_classes(idle_timeout,
+                                                             max_lifetime,
+                                                             statistics)
+
+    def connection_from_host(self, host, port=None, scheme='http', pool_kwargs=None):
+        size = self.host_pool_sizes.get(host)
+        if size:
+            pool_kwargs = dict(pool_kwargs or (), maxsize=size)
+        return super(_EvictingPoolManager, self).connection_from_host(
+            host, port=port, scheme=scheme, pool_kwargs=pool_kwargs)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    A transport adapter whose connections are pooled per host,
+    with per-host pool sizes, idle eviction, and a maximum lifetime.
+
+    :keyword dict host_pool_sizes: A mapping from host name (without port)
+        to the number of connections to keep for that host. Hosts not
+        in the mapping use *pool_maxsize*.
+    :keyword float idle_timeout: Seconds a connection may sit unused
+        in the pool before being closed instead of reused. `None` for no limit.
+    :keyword float max_lifetime: Seconds a connection may be used before
+        it is closed instead of reused. `None` for no limit.
+    """
+
+    def __init__(self, host_pool_sizes=None, idle_timeout=None, max_lifetime=None,
+                 statistics=None, **kwargs):
+        # These must be set before calling the super class, which
+        # initializes the pool manager.
+        self.host_pool_sizes = dict(host_pool_sizes or {})
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.statistics = statistics if statistics is not None else ConnectionPoolStatistics()
+        super(PooledHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = _EvictingPoolManager(
+            self.host_pool_sizes,
+            self.idle_timeout,
+            self.max_lifetime,
+            self.statistics,
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            **pool_kwargs
+        )
+
+
+def create_pooled_session(adapter):
+    """
+    Create a :class:`requests.Session` that uses *adapter* for all
+    HTTP and HTTPS requests.
+
+    The session does not store cookies, so it is safe to share between
+    unrelated deliveries, and between threads.
+    """
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # A webhook receiver shouldn't be able to influence what we send
+    # to a different receiver.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=()))
+    return session
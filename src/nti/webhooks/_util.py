@@ -9,10 +9,13 @@ from __future__ import print_function
 from calendar import timegm as dt_tuple_to_unix_ts
 from datetime import datetime as DateTime
 import io
+import weakref
 
 from persistent import Persistent
 
+from zope import component
 from zope.exceptions import print_exception as zprint_exceptions
+from zope.interface.interfaces import IRegistrationEvent
 from zope.dublincore.annotatableadapter import ZDCAnnotatableAdapter
 
 from nti.externalization.datetime import datetime_to_string
@@ -35,6 +38,68 @@ def print_exception_to_text(exc_info):
         result = printed
     return result
 
+#: How many registrations and unregistrations
+#: :func:`note_registration_changed` has seen in this process.
+_registration_changes = [0]
+
+@component.adapter(IRegistrationEvent)
+def note_registration_changed(event): # pylint:disable=unused-argument
+    """
+    Count a registration or unregistration, invalidating everything
+    recorded by :func:`utility_registry_generations`.
+
+    This is a fallback for the private generation counters those
+    functions watch; it only sees changes made in this process by
+    registries that send events.
+    """
+    _registration_changes[0] += 1
+
+def _registry_generation(registry):
+    # ``AdapterRegistry._generation`` is private. It's known to be
+    # bumped by every change to the registry, and by changes to its
+    # ``__bases__``, in zope.interface 4.x through 8.x. If it goes
+    # away, we rely on note_registration_changed() alone.
+    return getattr(registry, '_generation', None)
+
+def utility_registry_generations(site_managers):
+    """
+    Return an opaque record of the state of the utilities registered
+    in the *site_managers* and all their bases, for
+    :func:`utility_registries_unchanged`.
+
+    Registering or unregistering a utility, or changing the
+    ``__bases__`` of a site manager, changes the generation of its
+    registry (and, in the same process, of the registries based on
+    it). All the bases are recorded, so changes made elsewhere to
+    persistent registries are noticed too. Any registration event
+    seen by :func:`note_registration_changed` also counts as a change.
+
+    :raises AttributeError: If a site manager doesn't have a
+       utility registry we know how to watch.
+    """
+    registries = {}
+    for site_manager in site_managers:
+        for registry in site_manager.utilities.ro:
+            registries[id(registry)] = registry
+    return _registration_changes[0], [
+        (weakref.ref(registry), _registry_generation(registry))
+        for registry in registries.values()
+    ]
+
+def utility_registries_unchanged(generations):
+    """
+    Have none of the registries recorded by
+    :func:`utility_registry_generations` changed?
+    """
+    changes, generations = generations
+    if changes != _registration_changes[0]:
+        return False
+    for ref, generation in generations:
+        registry = ref()
+        if registry is None or _registry_generation(registry) != generation:
+            return False
+    return True
+
 def describe_class_or_specification(obj):
     """
     Simple description of a class or interface/providedBy.
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+An executor service that delivers webhooks using :mod:`asyncio`.
+
+.. caution:: This module requires Python 3. On Python 2, it can be
+   imported, but :class:`AsyncioExecutorService` is None.
+
+To use it, set
+:attr:`nti.webhooks.delivery_manager.DefaultDeliveryManager.executor_service_factory`
+to :class:`AsyncioExecutorService` before the first delivery is made.
+
+Instead of occupying a thread for each request that is waiting on a
+remote server, an event loop running in a single dedicated thread
+keeps many requests in flight at once. The number of work units
+in flight (and hence the number of responses held in memory) is
+bounded by :attr:`AsyncioExecutorService.max_in_flight`, and the
+number waiting for a slot is bounded just as it is for the default
+executor.
+
+HTTP requests are made using `aiohttp <https://docs.aiohttp.org>`_
+if it is installed. Otherwise, the blocking :mod:`requests` session of
+the delivery manager is used from a pool of threads; this keeps the
+bound on memory, but not the ability to have more requests in flight
+than there are threads.
+
+Recording results in the database is always done from the pool of
+threads, using the same transaction handling as the default executor.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+
+if sys.version_info[0] >= 3:
+    from nti.webhooks._asyncio_executor import AsyncioExecutorService
+else: # pragma: no cover
+    AsyncioExecutorService = None
+
+__all__ = [
+    'AsyncioExecutorService',
+]
@@ -29,6 +29,7 @@ from nti.webhooks._util import print_exception_to_text
 from nti.webhooks._util import text_type
 from nti.webhooks._util import DCTimesMixin
 from nti.webhooks._util import PersistentDCTimesMixin
+from nti.webhooks.payload_store import SharedTextProperty
 
 from nti.webhooks.interfaces import IWebhookDeliveryAttempt
 from nti.webhooks.interfaces import IWebhookDeliveryAttemptRequest
@@ -65,12 +66,18 @@ DeliveryOriginationInfo = namedtuple(
     ('pid', 'hostname', 'createdTime', 'transaction_note',)
 )
 
+DeliveryTimeoutInfo = namedtuple(
+    'DeliveryTimeoutInfo',
+    ('timeout', 'seconds',)
+)
+
 # The origination info itself is also immutable, though the exception
 # history may change.
 @implementer(IWebhookDeliveryAttemptInternalInfo)
 class WebhookDeliveryAttemptInternalInfo(DCTimesMixin, Contained):
 
     exception_history = ()
+    timeout_info = None
 
     def __init__(self):
         now = self.createdTime = self.lastModified = time.time()
@@ -101,6 +108,15 @@ class WebhookDeliveryAttemptInternalInfo(DCTimesMixin, Contained):
         assert isinstance(text, text_type)
         self.exception_history.append(text)
 
+    def storeTimeout(self, timeout, seconds):
+        """
+        Record that the time limit *timeout* (for example, ``'read'``)
+        of *seconds* was reached.
+        """
+        if IPersistent.providedBy(self.__parent__):
+            self.__parent__._p_changed = True # pylint:disable=protected-access
+        self.timeout_info = DeliveryTimeoutInfo(timeout, seconds)
+
 ###
 # Requests and responses.
 # Requests and responses are immutable. Thus they are never
@@ -118,6 +134,10 @@ class WebhookDeliveryAttemptRequest(_Base):
     __name__ = 'request'
     createFieldProperties(IWebhookDeliveryAttemptRequest,
                           omit=('created', 'modified'))
+    # This may be the attempt's shared payload;
+    # see nti.webhooks.payload_store.
+    body = SharedTextProperty('body', body, # pylint:disable=undefined-variable
+                              IWebhookDeliveryAttemptRequest['body'])
 
 @implementer(IWebhookDeliveryAttemptResponse)
 class WebhookDeliveryAttemptResponse(_Base):
@@ -132,7 +152,8 @@ class _StatusDescriptor(object):
     This functions similarly to a FieldPropertyStoredThroughField, in
     that it dispatches events when the property is set. It also
     ensures that the transition from "pending" to anything else only
-    happens once.
+    happens once, and tells the subscription containing the attempt
+    about it, so it can keep count of the attempts in each status.
     """
 
     def __init__(self, field_property):
@@ -145,8 +166,14 @@ class _StatusDescriptor(object):
         status_field = IWebhookDeliveryAttempt['status']
         if inst.resolved():
             raise AttributeError("Cannot change status once set.")
+        old_value = inst.status
         self._fp.__set__(inst, value) # This fires IFieldUpdatedEvent
         inst.lastModified = time.time()
+        # Keep the counts of our subscription current before anything
+        # (like pruning) can react to the change.
+        status_changed = getattr(inst.__parent__, '_attemptStatusChanged', None)
+        if status_changed is not None:
+            status_changed(inst, old_value, value)
         # Now fire our more specific event, if we've settled
         if not status_field.isResolved(value):
             return
@@ -168,6 +195,17 @@ class WebhookDeliveryAttempt(_Base, Contained):
     request = None
     response = None
     __parent__ = None
+    #: How many failed attempts to deliver the same payload came
+    #: before this one. See :mod:`nti.webhooks.retries`.
+    retry_number = 0
+    #: The text to send. This may be kept in a shared object; see
+    #: :mod:`nti.webhooks.payload_store`.
+    payload_data = SharedTextProperty('payload_data')
+    #: If the payload hasn't been rendered yet, a
+    #: :class:`nti.webhooks.deferred_payloads.PayloadReference`
+    #: to the data to render. Once it has been rendered, it is
+    #: stored in ``payload_data``.
+    payload_reference = None
 
     def __init__(self, **kwargs):
         super(WebhookDeliveryAttempt, self).__init__(**kwargs)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Circuit breakers for destination hosts.
+
+When a receiver is down, sending it more requests only ties up
+threads and connections waiting for them to fail. The delivery manager
+keeps a circuit breaker for each destination host (see
+:func:`nti.webhooks.delivery_manager.destination_key`) to stop doing that.
+
+A circuit starts *closed*, and requests are sent. After
+:attr:`~DestinationCircuitBreakers.failure_threshold` consecutive
+failures (an exception, or a 5xx response), the circuit *opens*. While
+it is open, nothing is sent to that host; what happens to the
+delivery attempts instead is decided by the delivery manager's
+``circuit_open_policy``: they either fail right away
+(:data:`CIRCUIT_OPEN_FAIL_FAST`) or are delivered later
+(:data:`CIRCUIT_OPEN_DEFER`). Attempts that fail without being sent
+say nothing about their subscription, so they don't count toward
+deactivating it.
+
+Circuit breakers are off unless the delivery manager's
+``circuit_breaker_failure_threshold`` is set.
+
+After :attr:`~DestinationCircuitBreakers.reset_timeout` seconds, the
+circuit becomes *half-open*, and a limited number of trial requests
+are sent. The first to succeed closes the circuit; the first to fail
+opens it again.
+
+Each change of state is announced with an
+:class:`nti.webhooks.interfaces.IWebhookDestinationCircuitChangedEvent`.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from zope import interface
+from zope.event import notify
+
+from nti.webhooks import MessageFactory as _
+from nti.webhooks.interfaces import IWebhookDestinationCircuitChangedEvent
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Requests are sent.
+CLOSED = 'closed'
+#: Requests are not sent.
+OPEN = 'open'
+#: A limited number of trial requests are sent.
+HALF_OPEN = 'half-open'
+
+#: Circuit open policy: attempts that can't be sent fail immediately.
+CIRCUIT_OPEN_FAIL_FAST = 'fail_fast'
+#: Circuit open policy: attempts that can't be sent wait until the
+#: circuit may let them through.
+CIRCUIT_OPEN_DEFER = 'defer'
+
+#: The message given to delivery attempts that fail without being
+#: sent because the circuit for their host is open.
+CIRCUIT_OPEN_MESSAGE = _(u'Not sent because the remote server has been failing.')
+
+
+def failed_while_open(attempt):
+    """
+    Did the delivery *attempt* fail without being sent because the
+    circuit for its host was open?
+    """
+    return attempt.message == CIRCUIT_OPEN_MESSAGE
+
+
+@interface.implementer(IWebhookDestinationCircuitChangedEvent)
+class DestinationCircuitChangedEvent(object):
+
+    def __init__(self, host, old_state, new_state):
+        self.host = host
+        self.old_state = old_state
+        self.new_state = new_state
+
+    def __repr__(self):
+        return '<%s %r %s -> %s>' % (
+            type(self).__name__,
+            self.host,
+            self.old_state,
+            self.new_state
+        )
+
+
+class _Circuit(object):
+    __slots__ = (
+        'state',
+        'failures',
+        'opened_at',
+        'trials',
+    )
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trials = 0
+
+
+class DestinationCircuitBreakers(object):
+    """
+    The circuit breakers for all destination hosts.
+
+    Only hosts that have failed since they last succeeded are tracked.
+    This object is thread-safe.
+    """
+
+    #: The number of consecutive failures that opens the circuit.
+    #: None disables the circuit breakers.
+    failure_threshold = 5
+
+    #: How long, in seconds, the circuit stays open before trial
+    #: requests are allowed.
+    reset_timeout = 30.0
+
+    #: The number of trial requests that may be in progress at once
+    #: while the circuit is half-open.
+    half_open_max_calls = 1
+
+    def __init__(self, failure_threshold=None, reset_timeout=None, half_open_max_calls=None):
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if reset_timeout is not None:
+            self.reset_timeout = reset_timeout
+        if half_open_max_calls is not None:
+            self.half_open_max_calls = half_open_max_calls
+        self._lock = threading.Lock()
+        # {host: _Circuit}
+        self._circuits = {}
+        #: The number of requests that were not allowed.
+        self.rejected_count = 0
+
+    def state(self, host):
+        """
+        The state of the circuit for *host*: :data:`CLOSED`,
+        :data:`OPEN` or :data:`HALF_OPEN`.
+        """
+        circuit = self._circuits.get(host)
+        return circuit.state if circuit is not None else CLOSED
+
+    def states(self):
+        """
+        A dictionary mapping each host whose circuit isn't closed to its state.
+        """
+        with self._lock:
+            return {
+                host: circuit.state
+                for host, circuit in self._circuits.items()
+                if circuit.state != CLOSED
+            }
+
+    def allow(self, host):
+        """
+        May a request be sent to *host* now?
+
+        If this returns true, the outcome must be reported with
+        :meth:`record`, or, if the request wasn't sent, with
+        :meth:`release`.
+        """
+        changed = None
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.state == CLOSED:
+                return True
+            if circuit.state == OPEN:
+                if time.time() - circuit.opened_at < self.reset_timeout:
+                    self.rejected_count += 1
+                    return False
+                changed = self._transition(host, circuit, HALF_OPEN)
+            allowed = circuit.trials < self.half_open_max_calls
+            if allowed:
+                circuit.trials += 1
+            else:
+                self.rejected_count += 1
+        self._notify(changed)
+        return allowed
+
+    def record(self, host, success):
+        """
+        Report the outcome of a request to *host* that was allowed.
+        """
+        changed = None
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if success:
+                if circuit is None:
+                    return
+                if circuit.state == HALF_OPEN:
+                    changed = self._transition(host, circuit, CLOSED)
+                if circuit.state == CLOSED:
+                    del self._circuits[host]
+                # A request that started before the circuit opened
+                # doesn't close it.
+            elif self.failure_threshold is not None:
+                if circuit is None:
+                    circuit = self._circuits[host] = _Circuit()
+                if circuit.state == CLOSED:
+                    circuit.failures += 1
+                    if circuit.failures >= self.failure_threshold:
+                        changed = self._transition(host, circuit, OPEN)
+                elif circuit.state == HALF_OPEN:
+                    changed = self._transition(host, circuit, OPEN)
+        self._notify(changed)
+
+    def release(self, host):
+        """
+        Report that a request to *host* that was allowed wasn't sent
+        after all, so its outcome says nothing about the host.
+        """
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is not None and circuit.state == HALF_OPEN and circuit.trials:
+                circuit.trials -= 1
+
+    def retry_after(self, host):
+        """
+        Return how long, in seconds, to wait before asking again
+        whether a request may be sent to *host*.
+        """
+        circuit = self._circuits.get(host)
+        if circuit is None or circuit.state == CLOSED:
+            return 0
+        if circuit.state == OPEN:
+            return max(0, circuit.opened_at + self.reset_timeout - time.time())
+        # Half-open, and the trials are in progress. They should
+        # be done soon.
+        return min(1.0, self.reset_timeout)
+
+    @staticmethod
+    def _transition(host, circuit, new_state):
+        old_state = circuit.state
+        circuit.state = new_state
+        circuit.trials = 0
+        if new_state == OPEN:
+            circuit.opened_at = time.time()
+        return DestinationCircuitChangedEvent(host, old_state, new_state)
+
+    @staticmethod
+    def _notify(event):
+        if event is None:
+            return
+        log = logger.warning if event.new_state == OPEN else logger.info
+        log("Circuit for webhook destination %r changed from %s to %s",
+            event.host, event.old_state, event.new_state)
+        notify(event)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing the events fired for one object during one transaction.
+
+Without a policy, a subscription receives one delivery for each
+distinct event fired for an object while a transaction is open. A
+form that saves several fields may fire several
+:class:`~zope.lifecycleevent.interfaces.IObjectModifiedEvent`
+events, and each one produces an identical webhook.
+
+A :class:`~nti.webhooks.interfaces.IWebhookEventCoalescingPolicy`
+can reduce those events before any payloads are rendered. Policies
+are named utilities; a subscription selects one by setting its
+``coalescing_policy`` attribute to the name, and otherwise uses the
+``coalescing_policy`` of its dialect. The default, None, delivers
+every event.
+
+These policies are registered by this package:
+
+``first`` (:class:`KeepFirstEvent`)
+    Deliver only the first event.
+``last`` (:class:`KeepLastEvent`)
+    Deliver only the last event.
+``merge-modified`` (:class:`MergeModifiedEvents`)
+    Deliver one modified event describing every modification.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from zope import component
+from zope.interface import implementer
+from zope.lifecycleevent import Attributes
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IAttributes
+
+from nti.webhooks.interfaces import IWebhookEventCoalescingPolicy
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@implementer(IWebhookEventCoalescingPolicy)
+class KeepFirstEvent(object):
+    """
+    Deliver only the first event.
+    """
+
+    def coalesce(self, data, events):
+        return events[:1]
+
+
+@implementer(IWebhookEventCoalescingPolicy)
+class KeepLastEvent(object):
+    """
+    Deliver only the last event.
+    """
+
+    def coalesce(self, data, events):
+        return events[-1:]
+
+
+def merge_descriptions(events):
+    """
+    Return the descriptions of all the modified *events*, with the
+    attribute names of :class:`~zope.lifecycleevent.Attributes`
+    descriptions of the same interface combined.
+    """
+    result = []
+    # {interface: (index in result, [attribute names])}
+    attributes = {}
+    for event in events:
+        for description in event.descriptions:
+            if IAttributes.providedBy(description):
+                if description.interface not in attributes:
+                    attributes[description.interface] = (len(result), [])
+                    result.append(None)
+                names = attributes[description.interface][1]
+                names.extend(name for name in description.attributes if name not in names)
+            elif description not in result:
+                result.append(description)
+    for interface, (index, names) in attributes.items():
+        result[index] = Attributes(interface, *names)
+    return result
+
+
+@implementer(IWebhookEventCoalescingPolicy)
+class MergeModifiedEvents(object):
+    """
+    Replace the plain :class:`~zope.lifecycleevent.ObjectModifiedEvent`
+    events with a single one, where the last of them was, that has
+    all their descriptions.
+
+    Other events, including subclasses of ``ObjectModifiedEvent``,
+    are delivered as they are.
+    """
+
+    def coalesce(self, data, events):
+        modified = [event for event in events if type(event) is ObjectModifiedEvent]
+        if len(modified) < 2:
+            return events
+        merged = ObjectModifiedEvent(modified[-1].object, *merge_descriptions(modified))
+        result = [event for event in events if type(event) is not ObjectModifiedEvent]
+        result.insert(events.index(modified[-1]) - len(modified) + 1, merged)
+        return result
+
+
+def coalescing_policy_for(subscription):
+    """
+    Return the :class:`~nti.webhooks.interfaces.IWebhookEventCoalescingPolicy`
+    chosen by *subscription* or its dialect, or None.
+    """
+    name = getattr(subscription, 'coalescing_policy', None)
+    if name is None:
+        name = getattr(subscription.dialect, 'coalescing_policy', None)
+    if not name:
+        return None
+    policy = component.queryUtility(IWebhookEventCoalescingPolicy, name, None, subscription)
+    if policy is None:
+        logger.warning("Unknown coalescing policy %r for %r; delivering every event.",
+                       name, subscription)
+    return policy
+
+
+def coalesce_events(data_event_subscriptions):
+    """
+    Apply the coalescing policies of the subscriptions to the
+    ``(data, event, subscription)`` tuples *data_event_subscriptions*,
+    which are in the order the events were fired.
+
+    Returns a list of such tuples. The events of each data object and
+    subscription with a policy are replaced, where the first of them
+    was, by what the policy keeps; the others are left in order.
+    """
+    policies = {}
+    for _, _, subscription in data_event_subscriptions:
+        if subscription not in policies:
+            policies[subscription] = coalescing_policy_for(subscription)
+    if not any(policies.values()):
+        return list(data_event_subscriptions)
+
+    # Only the events of subscriptions with a policy are grouped; the
+    # group goes where its first event was. Everything else stays in
+    # the order it was fired.
+    result = []
+    # {(data, subscription): (index in result, [events])}
+    groups = {}
+    for data, event, subscription in data_event_subscriptions:
+        if policies[subscription] is None:
+            result.append([(data, event, subscription)])
+            continue
+        key = (data, subscription)
+        if key not in groups:
+            groups[key] = (len(result), [])
+            result.append(None)
+        groups[key][1].append(event)
+
+    for (data, subscription), (index, events) in groups.items():
+        if len(events) > 1:
+            events = policies[subscription].coalesce(data, events)
+        result[index] = [(data, event, subscription) for event in events]
+    return [item for items in result for item in items]
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Adapting the number of deliveries in flight to each destination host.
+
+A fixed limit is either too small for fast receivers or too large for
+slow ones. :class:`AdaptiveConcurrencyLimits` adjusts the limit for
+each host on its own, using additive increase and multiplicative
+decrease (AIMD), the way TCP adjusts its congestion window:
+
+- Each time a host has answered as many requests in good time as its
+  current limit allows in flight, the limit goes up by one, up to
+  :attr:`~AdaptiveConcurrencyLimits.max_limit`.
+- When a request to the host fails, times out, is answered with a 5xx
+  or 429 status, or takes longer than
+  :attr:`~AdaptiveConcurrencyLimits.latency_target`, the limit is cut
+  (by default, in half), down to
+  :attr:`~AdaptiveConcurrencyLimits.min_limit`. Only requests started
+  after the last cut can cause another, so a burst of failures from
+  requests that were already in flight counts once.
+- A ``Retry-After`` header on a 429 or 503 response pauses all
+  deliveries to the host for that long (up to
+  :attr:`~AdaptiveConcurrencyLimits.max_retry_after`).
+
+The delivery manager uses these limits in place of a fixed
+``max_concurrent_deliveries_per_host``, which becomes the starting
+limit for each host.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def parse_retry_after(value, now=None):
+    """
+    Return the number of seconds given by the ``Retry-After`` header
+    *value* (either a number of seconds or an HTTP date), or None
+    if it can't be understood.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    now = now if now is not None else time.time()
+    return max(0.0, mktime_tz(parsed) - now)
+
+
+class _HostLimit(object):
+    __slots__ = (
+        'limit',
+        'successes',
+        'decreased_at',
+        'paused_until',
+        'updated',
+    )
+
+    def __init__(self, limit, now):
+        self.limit = limit
+        self.successes = 0
+        self.decreased_at = 0
+        self.paused_until = 0
+        self.updated = now
+
+
+class AdaptiveConcurrencyLimits(object):
+    """
+    The concurrency limits for destination hosts.
+
+    This object is thread-safe.
+    """
+
+    #: The limit for a host that hasn't been seen before.
+    initial_limit = 2
+
+    #: The lowest the limit goes.
+    min_limit = 1
+
+    #: The highest the limit goes.
+    max_limit = 16
+
+    #: Responses that take longer than this many seconds are
+    #: treated as a sign that the host is overloaded.
+    latency_target = 2.0
+
+    #: The limit is multiplied by this when the host is overloaded.
+    decrease_factor = 0.5
+
+    #: The longest, in seconds, that a ``Retry-After`` header can
+    #: pause deliveries.
+    max_retry_after = 300.0
+
+    #: When more hosts than this are tracked, the half that were
+    #: heard from least recently are forgotten.
+    max_hosts = 10000
+
+    def __init__(self, initial_limit=None, max_limit=None, latency_target=None):
+        if initial_limit is not None:
+            self.initial_limit = initial_limit
+        if max_limit is not None:
+            self.max_limit = max_limit
+        if latency_target is not None:
+            self.latency_target = latency_target
+        self._lock = threading.Lock()
+        # {host: _HostLimit}
+        self._hosts = {}
+        #: The number of times a limit was raised.
+        self.increase_count = 0
+        #: The number of times a limit was cut.
+        self.decrease_count = 0
+
+    def limit(self, host):
+        """
+        The most deliveries to *host* that may be in flight at once.
+        """
+        state = self._hosts.get(host)
+        return state.limit if state is not None else self.initial_limit
+
+    def limits(self):
+        """
+        A dictionary mapping each host that has been heard from to its limit.
+        """
+        with self._lock:
+            return {host: state.limit for host, state in self._hosts.items()}
+
+    def paused_for(self, host):
+        """
+        How many seconds deliveries to *host* must wait because it
+        sent a ``Retry-After`` header; 0 if they need not wait.
+        """
+        state = self._hosts.get(host)
+        if state is None:
+            return 0
+        return max(0, state.paused_until - time.time())
+
+    def observe(self, host, started_at, response):
+        """
+        Adjust the limit for *host* given the outcome of a request
+        started at the time *started_at*. *response* is the
+        :class:`requests.Response`, or None if there wasn't one
+        (because the request failed or timed out).
+        """
+        now = time.time()
+        status_code = response.status_code if response is not None else None
+        overloaded = (
+            response is None
+            or status_code >= 500
+            or status_code == 429
+            or now - started_at > self.latency_target
+        )
+        retry_after = None
+        if status_code in (429, 503):
+            retry_after = parse_retry_after(response.headers.get('Retry-After'), now)
+
+        with self._lock:
+            state = self._state(host, now)
+            if retry_after:
+                state.paused_until = max(state.paused_until,
+                                         now + min(retry_after, self.max_retry_after))
+            if not overloaded:
+                state.successes += 1
+                if state.successes >= state.limit:
+                    state.successes = 0
+                    if state.limit < self.max_limit:
+                        state.limit += 1
+                        self.increase_count += 1
+            elif started_at >= state.decreased_at:
+                state.successes = 0
+                state.decreased_at = now
+                new_limit = max(self.min_limit, int(state.limit * self.decrease_factor))
+                if new_limit != state.limit:
+                    state.limit = new_limit
+                    self.decrease_count += 1
+                    logger.info("Reduced concurrent deliveries to %r to %d", host, new_limit)
+
+    def _state(self, host, now):
+        state = self._hosts.get(host)
+        if state is None:
+            if len(self._hosts) >= self.max_hosts:
+                by_age = sorted(self._hosts, key=lambda h: self._hosts[h].updated)
+                for old in by_age[:len(by_age) // 2]:
+                    del self._hosts[old]
+            state = self._hosts[host] = _HostLimit(self.initial_limit, now)
+        state.updated = now
+        return state
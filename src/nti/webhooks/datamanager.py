@@ -11,6 +11,7 @@ from __future__ import division
 from __future__ import print_function
 
 import functools
+from collections import OrderedDict
 from collections import defaultdict
 
 from zope import component
@@ -18,7 +19,11 @@ from zope.interface import implementer
 from transaction.interfaces import IDataManager
 from persistent.interfaces import IPersistent
 
+from nti.webhooks.coalescing import coalesce_events
+from nti.webhooks.deferred_payloads import PayloadReference
+from nti.webhooks.deferred_payloads import payload_reference
 from nti.webhooks.interfaces import IWebhookDeliveryManager
+from nti.webhooks.interfaces import IWebhookDeliveryOutbox
 
 def foreign_transaction(func):
     @functools.wraps(func)
@@ -34,14 +39,17 @@ class _DataManagerState(object):
     Helper to hold intermediate data for the data manager.
     """
 
-    #: A list of ``(data, event, subscription)`` tuples.
+    #: A list of ``(data, event, subscription)`` tuples, after
+    #: applying the coalescing policies of the subscriptions
+    #: (see :mod:`nti.webhooks.coalescing`).
     all_subscriptions = None
 
-    #: A dictionary of ``{data: {dialect: external_form}}``.
+    #: A dictionary of ``{key: external_form}``.
     #: This is to avoid externalizing a single data object more times
-    #: than needed. TODO: Add a way to let the dialect let us know if it
-    #: used the event or not so we can cache more efficiently?
-    _data_to_ext_dialect = None
+    #: than needed. Dialects that can provide the key (see
+    #: :meth:`nti.webhooks.dialect.DefaultWebhookDialect.payload_cache_key_for`)
+    #: may share entries; for others, the key is the data and the dialect.
+    _payloads = None
 
     #: A dictionary of subscription to list of delivery attempts.
     #: This has to be a list because a single subscription may fire
@@ -51,34 +59,75 @@ class _DataManagerState(object):
     #: The ``IWebhookDeliveryManagerShipmentInfo`` object, once created.
     shipment_info = None
 
+    #: What the ``IWebhookDeliveryOutbox``, if any, returned when
+    #: the delivery attempts were recorded.
+    outbox_keys = None
+
     def __init__(self, subscription_dict):
         # TODO: This was designed before we used the event to externalize.
         # Rethink and simplify.
-        all_subscriptions = defaultdict(set)
-        data_to_dialects = self._data_to_ext_dialect = defaultdict(dict)
+        # Keep the order the events were fired in, for coalescing.
+        all_subscriptions = OrderedDict()
+        self._payloads = {}
         for (data, event), subscriptions in subscription_dict.items():
-            all_subscriptions[(data, event)].update(subscriptions)
-            data_to_dialects[data].update({sub.dialect: None for sub in subscriptions})
+            all_subscriptions.setdefault((data, event), set()).update(subscriptions)
 
-        self.all_subscriptions = [
+        self.all_subscriptions = coalesce_events([
             (data, event, sub)
             for (data, event), subscriptions in all_subscriptions.items()
             for sub in subscriptions
-        ]
+        ])
 
         sub_to_payload = self.subscription_to_payloads = defaultdict(list)
         for data, event, sub in self.all_subscriptions:
-            sub_to_payload[sub].append(self._ext_data(data, event, sub))
+            sub_to_payload[sub].append(
+                payload_reference(data, event, sub) or self._ext_data(data, event, sub)
+            )
 
         self.subscription_to_delivery_attempt = defaultdict(list)
 
     def _ext_data(self, data, event, subscription):
         dialect = subscription.dialect
-        result = self._data_to_ext_dialect[data][dialect]
-        if result is None:
-            result = self._data_to_ext_dialect[data][dialect] = dialect.externalizeData(data, event)
-        return result
+        key_for = getattr(dialect, 'payload_cache_key_for', None)
+        key = key_for(data, event) if key_for is not None else (data, dialect)
+        try:
+            return self._payloads[key]
+        except KeyError:
+            result = self._payloads[key] = dialect.externalizeData(data, event)
+            return result
+
+
+
+class _ConnectionJoiner(object):
+    """
+    Registered with the connection of a persistent subscription to make
+    the connection join the current transaction, using only the public
+    ``register()`` method, without registering the subscription.
+
+    It stands in for the subscription, with the same jar and OID, but
+    is never changed. Connections only write registered objects that
+    have changed, so nothing is written for it; if the transaction is
+    aborted, the subscription is invalidated, as it would have been if
+    it had been registered itself.
+    """
+
+    __slots__ = (
+        '_p_jar',
+        '_p_oid',
+    )
 
+    _p_changed = False
+
+    def __init__(self, subscription):
+        # pylint:disable=protected-access
+        self._p_jar = subscription._p_jar
+        self._p_oid = subscription._p_oid
+
+
+def _join_connection(jar, subscription):
+    # Make the connection *jar* take part in the current transaction,
+    # without registering (and possibly writing) the *subscription*.
+    jar.register(_ConnectionJoiner(subscription))
 
 
 @implementer(IDataManager)
@@ -131,7 +180,9 @@ class WebhookDataManager(object):
            once they are joined to the transaction, they will be delivered.
         """
         self.transaction_manager = transaction_manager
-        self._subscriptions = defaultdict(set)
+        self._subscriptions = OrderedDict()
+        # {id(jar): jar} for the connections of the subscriptions.
+        self._joined_jars = {}
         self._tpc_state = None
         self.transaction = transaction
 
@@ -141,20 +192,20 @@ class WebhookDataManager(object):
 
         Once two-phase-commit begins, this method is forbidden.
 
-        TODO We may need a mechanism to say, if we got multiple event types for a single
-        object, when and how to coalesce them. For example, given ObjectCreated and ObjectAdded
-        events, we probably only want to broadcast one of them. This may be dialect specific?
-        Or part of the subscription registration? A priority or 'supercedes' or something?
-        For now, we just wind up discarding the event type and assume it's not important to the
-        delivery.
+        The order in which events are added is kept. When a single
+        object gets multiple events, the coalescing policy of each
+        subscription decides which of them it receives; see
+        :mod:`nti.webhooks.coalescing`.
         """
         # We don't enforce that you can't call this after TPC has begun.
-        self._subscriptions[(data, event)].update(subscriptions)
+        self._subscriptions.setdefault((data, event), set()).update(subscriptions)
         for subscription in subscriptions:
             # pylint:disable=protected-access
-            if IPersistent.providedBy(subscription) and subscription._p_jar and subscription._p_oid:
+            jar = subscription._p_jar if IPersistent.providedBy(subscription) else None
+            if jar and subscription._p_oid and id(jar) not in self._joined_jars:
                 # See comment below for why we must do this.
-                subscription._p_jar.register(subscription)
+                self._joined_jars[id(jar)] = jar
+                _join_connection(jar, subscription)
 
 
     # The sequence for two-phase-commit is
@@ -176,13 +227,16 @@ class WebhookDataManager(object):
     # Thus mutating a persistent object can fail if creating the delivery attempt
     # is the first time an object from some connection has been mutated.
     #
-    # We fix this by pre-emptively registering subscriptions with their connection,
-    # which in turn registers with the transaction, as soon as they are added to this
-    # data manager. Another approach would be to add a before-commit transaction hook
-    # to the transaction that does the same thing.
+    # We fix this by pre-emptively joining the connections of subscriptions
+    # to the transaction, as soon as they are added to this data manager.
+    # We don't register the subscriptions themselves (see ``_join_connection``);
+    # they are usually unchanged, and there's no need to have their
+    # connection consider them again for every event. Another approach would be
+    # to add a before-commit transaction hook to the transaction that does
+    # the same thing.
     #
     # Another option might be to create the delivery attempt much earlier? But
-    # that would forbid any attempt from coalescing events, wouldn't it.
+    # that would forbid coalescing events, which happens in tpc_begin.
 
     @foreign_transaction
     def tpc_begin(self, transaction):
@@ -190,9 +244,26 @@ class WebhookDataManager(object):
         self._tpc_state = state = _DataManagerState(self._subscriptions)
         for subscription, payloads in state.subscription_to_payloads.items():
             state.subscription_to_delivery_attempt[subscription].extend([
-                subscription.createDeliveryAttempt(payload)
+                self._create_attempt(subscription, payload)
                 for payload in payloads
             ])
+        outbox = component.queryUtility(IWebhookDeliveryOutbox)
+        if outbox is not None:
+            state.outbox_keys = outbox.record([
+                (subscription, attempt)
+                for subscription, attempts
+                in state.subscription_to_delivery_attempt.items()
+                for attempt in attempts
+            ])
+
+    @staticmethod
+    def _create_attempt(subscription, payload):
+        if isinstance(payload, PayloadReference):
+            # Rendering is deferred until delivery.
+            attempt = subscription.createDeliveryAttempt(None)
+            attempt.payload_reference = payload
+            return attempt
+        return subscription.createDeliveryAttempt(payload)
 
     @foreign_transaction
     def commit(self, transaction):
@@ -218,6 +289,8 @@ class WebhookDataManager(object):
              if attempt.status == 'pending'
             ]
         )
+        if self._tpc_state.outbox_keys is not None:
+            self._tpc_state.shipment_info.outbox_keys = self._tpc_state.outbox_keys
 
     @foreign_transaction
     def tpc_finish(self, transaction):
@@ -229,10 +302,32 @@ class WebhookDataManager(object):
         # We need to find the persistent objects that are the delivery attempts and
         # only find them by OID when we are next in a Connection; as of now, they're no
         # good to us.
-        delivery_man = component.getUtility(IWebhookDeliveryManager)
-        delivery_man.acceptForDelivery(self._tpc_state.shipment_info)
+        #
+        # We hand the shipment over once the transaction has entirely
+        # committed. Until then, storages may hold locks that stop
+        # other transactions from committing, and the delivery manager
+        # may have to wait for room. Also, deferred payloads are
+        # rendered from the state this transaction commits, and we
+        # don't know its ID until every resource has finished, which
+        # may be after us.
+        transaction.addAfterCommitHook(
+            self._accept_after_commit,
+            (component.getUtility(IWebhookDeliveryManager),
+             self._tpc_state.shipment_info,
+             [
+                 attempt
+                 for attempts in self._tpc_state.subscription_to_delivery_attempt.values()
+                 for attempt in attempts
+             ]))
         self._tpc_state = None
 
+    @staticmethod
+    def _accept_after_commit(status, delivery_man, shipment_info, attempts):
+        if status:
+            if getattr(shipment_info, 'awaiting_commit', False):
+                shipment_info.committed(attempts)
+            delivery_man.acceptForDelivery(shipment_info)
+
     @foreign_transaction
     def tpc_abort(self, transaction):
         # Called if some part of TPC failed.
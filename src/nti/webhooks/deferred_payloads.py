@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering payloads after the transaction that caused them commits.
+
+Normally, each payload is externalized while its transaction is
+committing (in ``tpc_begin``), so large or slow-to-externalize data
+makes every commit that delivers it slower. A dialect that sets
+:attr:`~nti.webhooks.dialect.DefaultWebhookDialect.defer_payload_rendering`
+moves that work to the delivery manager.
+
+When the transaction commits, the delivery attempt records only a
+:class:`PayloadReference`: the database and OID of the data, and the
+interfaces the event provided. The delivery manager's worker then
+opens a read-only (historical) connection to the database as of the
+transaction that created the attempt, loads the data, and renders
+it, with the site of the subscription as the current site, and a
+stand-in event that provides the same interfaces. The rendered
+payload is stored on the attempt with its results.
+
+Rendering is only deferred when that gives the same result as
+rendering eagerly. Payloads are rendered eagerly when:
+
+- the dialect's
+  :attr:`~nti.webhooks.dialect.DefaultWebhookDialect.payload_cache_key`
+  says the payload depends on the event, or on its type, and not
+  just on the data;
+- the data is not persistent, or has not been stored yet (for
+  example, an object created in the same transaction); or
+- the subscription is not persistent, or is in a different database
+  than the data.
+
+The historical state needed to render is only kept until the database
+is packed. Attempts waiting for delivery when that happens fail (see
+:data:`RENDER_FAILED_MESSAGE`).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import namedtuple
+
+import transaction
+from zope.component.hooks import site as current_site
+from zope.component.interfaces import ISite
+from zope.interface import directlyProvides
+from zope.interface import providedBy
+from persistent.interfaces import IPersistent
+
+from nti.webhooks import MessageFactory as _
+from nti.webhooks.dialect import PAYLOAD_CACHE_BY_DATA
+
+#: The message given to delivery attempts whose deferred
+#: payload could not be rendered.
+RENDER_FAILED_MESSAGE = _(u'The data to send could not be produced.')
+
+
+class PayloadReference(namedtuple('PayloadReference',
+                                  ('database_name', 'oid', 'event_provides', 'tid'))):
+    """
+    What a delivery attempt records in place of its payload when
+    rendering is deferred.
+
+    .. attribute:: database_name
+
+       The name of the database holding the data.
+
+    .. attribute:: oid
+
+       The OID of the data.
+
+    .. attribute:: event_provides
+
+       A tuple of the interfaces the event provided.
+
+    .. attribute:: tid
+
+       The ID of the transaction whose state is rendered. This is
+       None until the attempt has been through the delivery manager;
+       until then, it is the serial of the attempt, which was created
+       in that transaction. It is kept so that retries of attempts
+       that failed before their payload was rendered render the same
+       state.
+    """
+    __slots__ = ()
+
+    def __new__(cls, database_name, oid, event_provides, tid=None):
+        return super(PayloadReference, cls).__new__(cls, database_name, oid,
+                                                    event_provides, tid)
+
+
+class ReplayedEvent(object):
+    """
+    Stands in for the event when a deferred payload is rendered.
+
+    It provides the same interfaces as the original event, and its
+    ``object`` is the data; it has no other attributes.
+    """
+
+    def __init__(self, data, event_provides):
+        self.object = data
+        directlyProvides(self, *event_provides)
+
+
+def payload_reference(data, event, subscription):
+    """
+    If the *subscription*'s dialect defers rendering, and rendering the
+    *data* for *event* can be deferred, return a
+    :class:`PayloadReference`. Otherwise, return None.
+
+    This is called while the transaction is committing; it must be cheap.
+    """
+    dialect = subscription.dialect
+    if not getattr(dialect, 'defer_payload_rendering', False):
+        return None
+    if getattr(dialect, 'payload_cache_key', PAYLOAD_CACHE_BY_DATA) != PAYLOAD_CACHE_BY_DATA:
+        # The stand-in event can't replace the real one.
+        return None
+    # pylint:disable=protected-access
+    if not IPersistent.providedBy(data) or not IPersistent.providedBy(subscription):
+        return None
+    if data._p_oid is None or data._p_jar is None or subscription._p_jar is None:
+        return None
+    database_name = data._p_jar.db().database_name
+    if subscription._p_jar.db().database_name != database_name:
+        # The attempt's serial is the transaction ID in its own database,
+        # which tells us nothing about the data's database.
+        return None
+    return PayloadReference(database_name, data._p_oid, tuple(providedBy(event)))
+
+
+def _site_of(context):
+    while context is not None:
+        if ISite.providedBy(context):
+            return context
+        context = getattr(context, '__parent__', None)
+    return None
+
+
+def render_payload(db, reference, tid, dialect, subscription_oid=None):
+    """
+    Render the payload described by the :class:`PayloadReference`
+    *reference* with *dialect*, using the state of the data as of the
+    transaction *tid*.
+
+    *db* is any database in the multi-database that holds the data.
+    If *subscription_oid* is given, it is the OID of the subscription
+    in the same database, and the nearest site containing it is the
+    current site while rendering.
+    """
+    db = db.databases[reference.database_name]
+    tx_manager = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tx_manager, at=tid)
+    try:
+        data = conn.get(reference.oid)
+        subscription = conn.get(subscription_oid) if subscription_oid is not None else None
+        with current_site(_site_of(subscription)):
+            return dialect.externalizeData(data, ReplayedEvent(data, reference.event_provides))
+    finally:
+        tx_manager.abort()
+        conn.close()
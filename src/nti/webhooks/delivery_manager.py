@@ -7,32 +7,72 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import sys
 import time
+import threading
+from collections import deque
+from functools import partial
+from itertools import count
+from itertools import groupby
+from itertools import islice
 
 from concurrent import futures
+try:
+    from urllib.parse import urlsplit
+except ImportError: # Py2
+    from urlparse import urlsplit
 
 import requests
+import transaction
+from urllib3.exceptions import ReadTimeoutError
 
 from zope import interface
 from zope import component
 from zope.container.contained import Contained
 from zope.cachedescriptors.property import Lazy
+from zope.interface.interfaces import ComponentLookupError
 
 from persistent.interfaces import IPersistent
+from BTrees.OOBTree import OOBTree
 from ZODB.interfaces import IDatabase
+from ZODB.POSException import POSKeyError
+from ZODB.utils import oid_repr
+from ZODB.utils import z64
 
 from nti.transactions.loop import TransactionLoop
 
 from nti.webhooks import MessageFactory as _
+from nti.webhooks._delayed import DelayedCalls
+from nti.webhooks._http import ConnectionPoolStatistics
+from nti.webhooks._http import PooledHTTPAdapter
+from nti.webhooks._http import create_pooled_session
 from nti.webhooks._util import print_exception_to_text
 from nti.webhooks._util import text_type
+from nti.webhooks.circuit_breaker import CIRCUIT_OPEN_DEFER
+from nti.webhooks.circuit_breaker import CIRCUIT_OPEN_FAIL_FAST
+from nti.webhooks.circuit_breaker import CIRCUIT_OPEN_MESSAGE
+from nti.webhooks.circuit_breaker import DestinationCircuitBreakers
+from nti.webhooks.concurrency import AdaptiveConcurrencyLimits
+from nti.webhooks.deferred_payloads import RENDER_FAILED_MESSAGE
+from nti.webhooks.deferred_payloads import render_payload
+from nti.webhooks.destination_validator import VALIDATION_FAILED_MESSAGE
+from nti.webhooks.payload_store import share_payload
+from nti.webhooks.payload_store import stored_shared_payload
+from nti.webhooks.rate_limit import DestinationRateLimiter
 
 from nti.webhooks.interfaces import IWebhookDeliveryManager
+from nti.webhooks.interfaces import IWebhookDeliveryOutbox
 from nti.webhooks.interfaces import IWebhookDeliveryManagerShipmentInfo
+from nti.webhooks.interfaces import IWebhookDestinationValidator
 
 logger = __import__('logging').getLogger(__name__)
 
+try:
+    from os import cpu_count as _cpu_count
+except ImportError: # Py2
+    from multiprocessing import cpu_count as _cpu_count
+
 
 class _RunJobWithDatabase(TransactionLoop):
     _connection = None
@@ -54,21 +94,90 @@ class _RunJobWithDatabase(TransactionLoop):
                 self._connection = None
 
 
+def run_in_private_transaction(db, func, attempts=3):
+    """
+    Call ``func(connection)`` with a connection to *db* in a transaction
+    that doesn't involve the thread's transaction manager, committing
+    (or retrying, up to *attempts* times) when it returns.
+
+    This is safe to call from within an after-commit hook of the thread's
+    transaction.
+    """
+    tx_manager = transaction.TransactionManager(explicit=True)
+    conn = db.open(transaction_manager=tx_manager)
+    try:
+        for attempt in tx_manager.attempts(attempts):
+            with attempt:
+                result = func(conn)
+        return result
+    finally:
+        conn.close()
+
+
+def destination_key(url):
+    """
+    Return the key identifying the destination host of *url*.
+
+    This is the (lowercased) host and port, without any inline
+    authentication. Work is grouped, scheduled and limited
+    by this key.
+    """
+    netloc = urlsplit(url).netloc
+    return netloc.rsplit('@', 1)[-1].lower()
+
+
+def _delivery_validation(sub):
+    # The function that finishes validating the destination of *sub*
+    # just before delivery, if its validator puts that off, or None.
+    # The validator is found the same way as when the attempt was
+    # created, in the site of the subscription.
+    try:
+        validator = component.queryUtility(IWebhookDestinationValidator, u'', None, sub)
+    except ComponentLookupError:
+        # It has no site of its own.
+        validator = component.queryUtility(IWebhookDestinationValidator)
+    if getattr(validator, 'validate_at_delivery', False):
+        return validator.validateTargetForDelivery
+    return None
+
+
 class _PersistentAttemptGetter(object):
     __slots__ = (
         'oid',
         'database_name',
+        'subscription_oid',
         'dialect',
         'to',
+        'validate_destination',
         'payload_data',
+        # If the payload hasn't been rendered, its PayloadReference,
+        # and the transaction whose state to render.
+        'payload_reference',
+        'payload_tid',
     )
 
     def __init__(self, sub, attempt):
         self.oid = attempt._p_oid
         self.database_name = attempt._p_jar.db().database_name
+        self.subscription_oid = getattr(sub, '_p_oid', None)
         self.dialect = sub.dialect
         self.to = sub.to
+        self.validate_destination = _delivery_validation(sub)
         self.payload_data = attempt.payload_data
+        self.payload_reference = None
+        self.payload_tid = None
+        reference = getattr(attempt, 'payload_reference', None)
+        if self.payload_data is None and reference is not None:
+            self.payload_reference = reference
+            # A new attempt has no serial until its transaction
+            # commits; see ShipmentInfo.committed.
+            self.payload_tid = reference.tid or (
+                attempt._p_serial if attempt._p_serial != z64 else None
+            )
+
+    @property
+    def subscription_key(self):
+        return (self.database_name, self.subscription_oid)
 
     def __call__(self, connection):
         return connection.get_connection(self.database_name).get(self.oid)
@@ -78,11 +187,16 @@ class _TrivialAttemptGetter(object):
     __slots__ = (
         'sub',
         'attempt',
+        'validate_destination',
     )
 
+    # Only persistent attempts defer rendering.
+    payload_reference = None
+
     def __init__(self, sub, attempt):
         self.sub = sub
         self.attempt = attempt
+        self.validate_destination = _delivery_validation(sub)
 
     @property
     def dialect(self):
@@ -96,6 +210,10 @@ class _TrivialAttemptGetter(object):
     def payload_data(self):
         return self.attempt.payload_data
 
+    @property
+    def subscription_key(self):
+        return id(self.sub)
+
     def __call__(self, connection):
         return self.attempt
 
@@ -103,29 +221,241 @@ class _TrivialAttemptGetter(object):
 class _AttemptResult(object):
     __slots__ = (
         'createdTime',
+        # When the request was handed to the HTTP client, or None if
+        # it never was (because it failed before it could be sent).
+        'sentTime',
         # attempt_getter is a callable(connection) that returns the attempt object.
         # For non-persistent attempts, this can be a simple closure;
         # for persistent attempts, it needs to be more complex.
         'attempt_getter',
         'http_response',
         'exception_string',
+        # The message for the attempt if it failed without being sent.
+        'message',
+        # If a time limit was reached, a tuple (name, seconds);
+        # see IWebhookDeliveryAttemptInternalInfo.
+        'timeout',
     )
 
     def __init__(self, attempt_getter):
         self.createdTime = None
+        self.sentTime = None
         self.attempt_getter = attempt_getter
         self.http_response = None
         self.exception_string = None
+        self.message = None
+        self.timeout = None
+
+
+class DeliveryTimeout(requests.Timeout):
+    """
+    Raised when a response takes longer than the total time
+    allowed, or the shipment's deadline passes.
+    """
+
+
+class DestinationWorkUnit(object):
+    """
+    The attempts from a single shipment that go to a single destination host.
+
+    This is the unit of concurrency for delivery: the delivery manager
+    schedules each unit independently, so a shipment that fans out to many
+    hosts is delivered in parallel. Within a unit, attempts are sent
+    serially, in URL order, over a single HTTP session so that HTTP
+    keep-alive can be used.
+
+    Calling the unit delivers it and records the results.
+    """
+
+    __slots__ = (
+        'shipment',
+        'host',
+        'results',
+        '_deferred_from',
+        # How long, in seconds, to wait before delivering
+        # a unit returned from deliver().
+        'defer_delay',
+    )
+
+    CIRCUIT_OPEN_MESSAGE = CIRCUIT_OPEN_MESSAGE
+    DEADLINE_MESSAGE = _(u'Not sent because the delivery deadline passed.')
+
+    def __init__(self, shipment, host, results):
+        self.shipment = shipment
+        self.host = host
+        self.results = results
+        self._deferred_from = None
+        self.defer_delay = 0
+
+    def __call__(self):
+        with requests.Session() as http_session:
+            self.deliver_all(http_session)
+
+    def deliver_all(self, http_session, manager=None):
+        """
+        Like :meth:`deliver`, but deliver what is deferred too, in
+        this thread, after waiting for its :attr:`defer_delay`.
+        """
+        unit = self
+        while unit is not None:
+            unit = unit.deliver(http_session, manager)
+            if unit is not None and unit.defer_delay:
+                time.sleep(unit.defer_delay)
+
+    def deliver(self, http_session, manager=None):
+        """
+        Send the attempts, then record the results.
+
+        If *manager* (a :class:`DefaultDeliveryManager`) is given, its
+        circuit breakers, rate limiter and adaptive concurrency limits
+        apply: each attempt is sent only if they allow it, and what
+        they learn from the responses is passed back to them.
+
+        Attempts that may not be sent fail without being sent, unless
+        they are deferred (because of a rate limit, a ``Retry-After``
+        header, or an open circuit when the manager's
+        ``circuit_open_policy`` is to defer). In that case, they and
+        the attempts after them are neither sent nor recorded; they
+        are returned as a unit to be delivered after its
+        :attr:`defer_delay`.
+
+        Returns the unit to deliver later, or None.
+        """
+        # pylint:disable=protected-access
+        for result in self._sendable(manager):
+            self.shipment._send_result(http_session, result)
+            self._sent(result, manager)
+        return self._finish()
+
+    def _sendable(self, manager):
+        # Iterate the results that should be sent now.
+        self._deferred_from = None
+        host = self.host
+        deadline = self.shipment.deadline
+        circuit_breakers = getattr(manager, 'circuit_breakers', None)
+        rate_limiter = getattr(manager, 'rate_limiter', None)
+        concurrency = getattr(manager, 'host_concurrency', None)
+        defer_when_open = getattr(manager, 'circuit_open_policy', None) == CIRCUIT_OPEN_DEFER
+        for index, result in enumerate(self.results):
+            if deadline is not None and time.time() >= deadline:
+                result.createdTime = time.time()
+                result.message = self.DEADLINE_MESSAGE
+                result.exception_string = text_type('Not sent: the shipment deadline passed.')
+                result.timeout = ('deadline', self.shipment.deadline_seconds)
+                continue
+            delay = concurrency.paused_for(host) if concurrency is not None else 0
+            if not delay and rate_limiter is not None:
+                getter = result.attempt_getter
+                delay = rate_limiter.acquire(host, getter.subscription_key, getter.dialect)
+            if delay:
+                self._deferred_from = index
+                self.defer_delay = delay
+                return
+            if circuit_breakers is None or circuit_breakers.allow(host):
+                yield result
+            elif defer_when_open:
+                self._deferred_from = index
+                self.defer_delay = circuit_breakers.retry_after(host)
+                return
+            else:
+                result.createdTime = time.time()
+                result.message = self.CIRCUIT_OPEN_MESSAGE
+                result.exception_string = text_type(
+                    'Not sent: the circuit breaker for %s is open.' % (host,))
+
+    def _sent(self, result, manager):
+        # Only what reached the network says anything about the host;
+        # local failures, such as rendering the payload or validating
+        # the destination, don't.
+        circuit_breakers = getattr(manager, 'circuit_breakers', None)
+        if result.sentTime is None:
+            if circuit_breakers is not None:
+                circuit_breakers.release(self.host)
+            return
+        response = result.http_response if result.exception_string is None else None
+        if circuit_breakers is not None:
+            circuit_breakers.record(self.host,
+                                    response is not None and response.status_code < 500)
+        concurrency = getattr(manager, 'host_concurrency', None)
+        if concurrency is not None:
+            concurrency.observe(self.host, result.sentTime, response)
+
+    def _finish(self):
+        # Record what was sent, returning the unit to deliver later (if any).
+        deferred_from = self._deferred_from
+        deferred = None
+        if deferred_from is not None:
+            if not deferred_from:
+                return self
+            deferred = self.shipment._add_unit(self.host, self.results[deferred_from:])
+            deferred.defer_delay = self.defer_delay
+            self.results = self.results[:deferred_from]
+        try:
+            self.shipment._record_results(self.results) # pylint:disable=protected-access
+        except Exception: # pylint:disable=broad-except
+            if deferred is None:
+                raise
+            # _record_results has logged it. Raising would lose the
+            # attempts that are deferred.
+        return deferred
+
+    def fail(self, message, reason):
+        """
+        Fail all the attempts without sending them, with the *message*
+        and the text *reason*, and record that.
+
+        The results are recorded in transactions of their own, so this
+        may be called from anywhere, including transaction hooks.
+        """
+        now = time.time()
+        for result in self.results:
+            result.createdTime = now
+            result.message = message
+            result.exception_string = text_type('Not sent: %s.' % (reason,))
+        self.shipment._record_results(self.results, private=True) # pylint:disable=protected-access
+
+    def __repr__(self):
+        return '<%s host=%r attempts=%d>' % (
+            type(self).__name__,
+            self.host,
+            len(self.results)
+        )
 
 
 @interface.implementer(IWebhookDeliveryManagerShipmentInfo)
 class ShipmentInfo(object):
 
+    #: The most delivery results to record in a single transaction.
+    #: Results for the same subscription are kept together in as few
+    #: transactions as possible. If a transaction can't be committed,
+    #: only the results it contains are lost.
+    result_chunk_size = 50
+
+    #: Set to the value returned from
+    #: :meth:`nti.webhooks.interfaces.IWebhookDeliveryOutbox.record` when
+    #: an outbox is in use.
+    outbox_keys = None
+
+    #: The time by which all attempts must have been sent, or None.
+    #: Attempts not sent by then fail without being sent. See
+    #: :meth:`startDeadline`.
+    deadline = None
+
+    #: The number of seconds that were given to :meth:`startDeadline`.
+    deadline_seconds = None
+
+    #: The size of the pieces in which response bodies are read
+    #: when their time is limited.
+    read_chunk_size = 8192
+
     def __init__(self, subscriptions_and_attempts):
-        # Sort them by URL so that requests to the same host go together;
-        # this may help with HTTP keepalive/pipeline?
-        self._sub_and_attempts = sorted(subscriptions_and_attempts,
-                                        key=lambda sub_attempt: sub_attempt[0].to)
+        # Sort them by destination, then URL, so that requests to the same host go
+        # together; each host becomes a separate DestinationWorkUnit that shares
+        # a single session and thus may benefit from HTTP keep-alive.
+        self._sub_and_attempts = sorted(
+            subscriptions_and_attempts,
+            key=lambda sub_attempt: (destination_key(sub_attempt[0].to), sub_attempt[0].to)
+        )
         self._results = []
         self._had_persistent = False
         for sub, attempt in self._sub_and_attempts:
@@ -137,49 +467,311 @@ class ShipmentInfo(object):
             result = _AttemptResult(getter)
             self._results.append(result)
 
+        self._work_units = [
+            DestinationWorkUnit(self, host, list(results))
+            for host, results
+            in groupby(self._results, key=lambda result: destination_key(result.attempt_getter.to))
+        ]
+        self._lock = threading.Lock()
+        self._units_unrecorded = len(self._work_units)
+        self._all_recorded = True
+        self._awaiting_commit = any(
+            result.attempt_getter.payload_reference is not None
+            and result.attempt_getter.payload_tid is None
+            for result in self._results
+        )
+
+    @property
+    def work_units(self):
+        """
+        A sequence of :class:`DestinationWorkUnit` objects, one for each
+        distinct destination host in this shipment.
+        """
+        return tuple(self._work_units)
+
     def deliver(self):
-        # Collects _AttemptResult objects.
+        """
+        Deliver all the work units of this shipment serially, in this thread.
+        """
         with requests.Session() as http_session:
-            # We can't access any attributes of sub or attempt here, they may be
-            # persistent and we're not in a transaction or having an open connection.
-            for result in self._results:
-                result.createdTime = time.time()
-                try:
-                    prepared_request = result.attempt_getter.dialect.prepareRequest(
-                        http_session,
-                        # Use the attempt_getter as a proxy for the
-                        # subscription/attempt, since, if persistent,
-                        # they cannot be accessed directly. Always do
-                        # this, even if they're not persistent, for
-                        # consistency. NOTE: These are not complete
-                        # proxies, only providing the things that have
-                        # been proven to be needed. Should probably
-                        # introduce interfaces for this and update the
-                        # prepareRequest method description.
-                        result.attempt_getter,
-                        result.attempt_getter)
-                    response = http_session.send(prepared_request)
-                except Exception: # pylint:disable=broad-except
-                    # Remember, cannot access persistent attributes
-                    logger.exception("Failed to deliver for hook to %s", result.attempt_getter.to)
-                    result.exception_string = print_exception_to_text(sys.exc_info())
-                else:
-                    result.http_response = response
+            # Units split off while delivering are delivered by the
+            # unit they came from.
+            for unit in self.work_units:
+                unit.deliver_all(http_session)
+
+    @property
+    def awaiting_commit(self):
+        """
+        Whether some attempts have payloads that can't be rendered
+        until the transaction that created them has committed. If
+        so, :meth:`committed` must be called before this is
+        accepted for delivery.
+        """
+        return self._awaiting_commit
+
+    def committed(self, attempts):
+        """
+        Called with the persistent *attempts* of this shipment once the
+        transaction that created them has committed, and their serials
+        are known.
+        """
+        # pylint:disable=protected-access
+        serials = {
+            (attempt._p_jar.db().database_name, attempt._p_oid): attempt._p_serial
+            for attempt in attempts
+            if IPersistent.providedBy(attempt) and attempt._p_jar is not None
+        }
+        for result in self._results:
+            getter = result.attempt_getter
+            if getter.payload_reference is not None and getter.payload_tid is None:
+                getter.payload_tid = serials.get((getter.database_name, getter.oid))
+        self._awaiting_commit = False
+
+    def startDeadline(self, seconds):
+        """
+        Require all attempts to be sent within *seconds* from now.
+
+        Requests that are in progress when the deadline passes are
+        abandoned.
+        """
+        self.deadline_seconds = seconds
+        self.deadline = time.time() + seconds
+
+    def _add_unit(self, host, results):
+        # Split off some results to be delivered separately.
+        unit = DestinationWorkUnit(self, host, results)
+        with self._lock:
+            self._units_unrecorded += 1
+            self._work_units.append(unit)
+        return unit
+
+    def _send_result(self, http_session, result):
+        # Fills in the _AttemptResult.
+        # We can't access any attributes of sub or attempt here, they may be
+        # persistent and we're not in a transaction or having an open connection.
+        try:
+            self._before_send(result)
+            prepared_request = self._prepare_request(http_session, result)
+            response = self._send_request(http_session, prepared_request, result)
+        except Exception: # pylint:disable=broad-except
+            self._send_failed(result)
+        else:
+            result.http_response = response
 
-        # Now open the database long enough to store the results. We
+    def _request_timeouts(self, result):
+        """
+        Return the ``(name, seconds)`` pairs of the connect, read and
+        total time limits for sending *result*.
+
+        Limits come from the dialect, but none is allowed to go past
+        the shipment's deadline; a limit that would is replaced by
+        the deadline. Seconds may be None for no limit.
+        """
+        dialect = result.attempt_getter.dialect
+        connect = ('connect', getattr(dialect, 'connect_timeout', None))
+        read = ('read', getattr(dialect, 'read_timeout', None))
+        total = ('total', getattr(dialect, 'total_timeout', None))
+        if self.deadline is not None:
+            remaining = ('deadline', max(0, self.deadline - time.time()))
+            connect, read, total = [
+                remaining if limit[1] is None or limit[1] > remaining[1] else limit
+                for limit in (connect, read, total)
+            ]
+        return connect, read, total
+
+    def _send_request(self, http_session, prepared_request, result):
+        connect, read, total = self._request_timeouts(result)
+        started = result.sentTime = time.time()
+        try:
+            response = http_session.send(prepared_request,
+                                         timeout=(connect[1], read[1]),
+                                         stream=total[1] is not None)
+            if total[1] is not None:
+                self._read_content(response, started + total[1], total)
+        except requests.ConnectTimeout:
+            result.timeout = connect
+            raise
+        except requests.ReadTimeout:
+            result.timeout = read
+            raise
+        except DeliveryTimeout:
+            result.timeout = total
+            raise
+        except requests.ConnectionError as ex:
+            # Reading the body wraps read timeouts.
+            if ex.args and isinstance(ex.args[0], ReadTimeoutError):
+                result.timeout = read
+            raise
+        return response
+
+    def _read_content(self, response, ends_at, limit):
+        # Read the body, giving up if that goes past *ends_at*. This is
+        # what requests does when not streaming, with a clock.
+        # pylint:disable=protected-access
+        if response._content is not False:
+            # Already read.
+            return
+        chunks = []
+        try:
+            for chunk in response.iter_content(self.read_chunk_size):
+                chunks.append(chunk)
+                if time.time() > ends_at:
+                    raise DeliveryTimeout('Response took longer than the %s limit of %ss'
+                                          % limit)
+        except Exception:
+            response.close()
+            raise
+        response._content = b''.join(chunks)
+        response._content_consumed = True
+
+    def _blocks_before_send(self, result):
+        # Does _before_send have anything to do?
+        return (
+            result.attempt_getter.validate_destination is not None
+            or result.attempt_getter.payload_reference is not None
+        )
+
+    def _before_send(self, result):
+        # Blocking work to do before the request can be prepared.
+        if result.attempt_getter.payload_reference is not None:
+            self._render_payload(result)
+        if result.attempt_getter.validate_destination is not None:
+            self._validate_destination(result)
+
+    @staticmethod
+    def _render_payload(result):
+        result.createdTime = time.time()
+        getter = result.attempt_getter
+        try:
+            if getter.payload_tid is None:
+                raise ValueError("The transaction to render is not known")
+            getter.payload_data = render_payload(component.getUtility(IDatabase),
+                                                 getter.payload_reference,
+                                                 getter.payload_tid,
+                                                 getter.dialect,
+                                                 getter.subscription_oid)
+        except Exception:
+            result.message = RENDER_FAILED_MESSAGE
+            raise
+        getter.payload_reference = None
+
+    @staticmethod
+    def _validate_destination(result):
+        # Destinations are only validated here if the validator put
+        # it off until delivery.
+        result.createdTime = time.time()
+        getter = result.attempt_getter
+        try:
+            getter.validate_destination(getter.to)
+        except Exception:
+            result.message = VALIDATION_FAILED_MESSAGE
+            raise
+
+    @staticmethod
+    def _prepare_request(http_session, result):
+        result.createdTime = time.time()
+        return result.attempt_getter.dialect.prepareRequest(
+            http_session,
+            # Use the attempt_getter as a proxy for the
+            # subscription/attempt, since, if persistent,
+            # they cannot be accessed directly. Always do
+            # this, even if they're not persistent, for
+            # consistency. NOTE: These are not complete
+            # proxies, only providing the things that have
+            # been proven to be needed. Should probably
+            # introduce interfaces for this and update the
+            # prepareRequest method description.
+            result.attempt_getter,
+            result.attempt_getter)
+
+    @staticmethod
+    def _send_failed(result):
+        # Must be called while handling the exception.
+        # Remember, cannot access persistent attributes
+        logger.exception("Failed to deliver for hook to %s", result.attempt_getter.to)
+        result.exception_string = print_exception_to_text(sys.exc_info())
+
+    def _record_results(self, results, private=False):
+        # Now open the database long enough to store the results. If
+        # *private*, the thread's transaction manager isn't used. We
         # don't use any site here, so per-site configuration for
         # things like event handlers isn't possible. TODO: We probably could,
         # we could look up the hierarchy of the attempt and put it in
         # the first site we find that way.
-        if self._had_persistent:
+        if not self._had_persistent:
             # ``had_persistent`` may be a worthless optimization, but it
             # simplifies some test scenarios a bit during initial bring-up.
-            # TODO: Perhaps we want to just run one, or some limit,
-            # at a time to decrease the chances of conflicts?
-            runner = _RunJobWithDatabase(self._process_results)
-            runner(self._results)
-        else:
-            self._process_results(None, self._results)
+            self._process_results(None, results)
+            return
+
+        # Each chunk is committed (and retried on conflict) on its own,
+        # so one busy subscription can't cost us the results of the others.
+        first_error = None
+        for chunk in self._chunk_results(results, self.result_chunk_size):
+            if private:
+                runner = partial(run_in_private_transaction,
+                                 component.getUtility(IDatabase),
+                                 partial(self._process_results, results=chunk))
+            else:
+                runner = partial(_RunJobWithDatabase(self._process_results), chunk)
+            try:
+                runner()
+            except Exception as ex: # pylint:disable=broad-except
+                logger.exception(
+                    "Failed to record the results of delivery attempts %s",
+                    ', '.join(self._attempt_repr(result.attempt_getter) for result in chunk))
+                if first_error is None:
+                    first_error = ex
+        self._unit_recorded(first_error is None)
+        if first_error is not None:
+            raise first_error # pylint:disable=raising-bad-type
+
+    def _unit_recorded(self, success):
+        with self._lock:
+            self._units_unrecorded -= 1
+            self._all_recorded = self._all_recorded and success
+            done = not self._units_unrecorded and self._all_recorded
+        if done and self.outbox_keys is not None:
+            # If the outbox has gone away, recovery will take care of it.
+            outbox = component.queryUtility(IWebhookDeliveryOutbox)
+            if outbox is not None:
+                outbox.complete(self.outbox_keys)
+
+    @staticmethod
+    def _attempt_repr(attempt_getter):
+        # Persistent attempts are identified by database and OID; we
+        # can't access them here. Others are in memory.
+        oid = getattr(attempt_getter, 'oid', None)
+        if oid is None:
+            return repr(getattr(attempt_getter, 'attempt', attempt_getter))
+        return '%s:%s' % (attempt_getter.database_name, oid_repr(oid))
+
+    @staticmethod
+    def _chunk_results(results, chunk_size):
+        """
+        Divide *results* into lists of no more than *chunk_size*, keeping
+        the results for one subscription together unless there are more
+        of them than fit in a single chunk.
+        """
+        by_subscription = {}
+        for result in results:
+            # OIDs are only unique within a database.
+            by_subscription.setdefault(
+                getattr(result.attempt_getter, 'subscription_key', None),
+                []
+            ).append(result)
+
+        chunk = []
+        for group in by_subscription.values():
+            if chunk and len(chunk) + len(group) > chunk_size:
+                yield chunk
+                chunk = []
+            while len(group) > chunk_size:
+                yield group[:chunk_size]
+                group = group[chunk_size:]
+            chunk.extend(group)
+        if chunk:
+            yield chunk
 
     REMOTE_EXCEPTION_MESSAGE = _(u'Contacting the remote server experienced an unexpected error.')
     LOCAL_EXCEPTION_MESSAGE = _(u'Unexpected error handling the response from the server.')
@@ -189,9 +781,12 @@ class ShipmentInfo(object):
         for result in results:
             attempt = result.attempt_getter(connection)
             attempt.request.createdTime = result.createdTime
+            cls._store_payload(attempt, result.attempt_getter)
+            if result.timeout is not None:
+                attempt.internal_info.storeTimeout(*result.timeout)
             if result.exception_string:
                 attempt.response = None
-                attempt.message = cls.REMOTE_EXCEPTION_MESSAGE
+                attempt.message = result.message or cls.REMOTE_EXCEPTION_MESSAGE
                 attempt.internal_info.storeExceptionText(result.exception_string)
                 attempt.status = 'failed'
             else:
@@ -208,6 +803,19 @@ class ShipmentInfo(object):
                     attempt.status = 'successful' if result.http_response.ok else 'failed'
 
 
+    @staticmethod
+    def _store_payload(attempt, getter):
+        reference = getattr(attempt, 'payload_reference', None)
+        if reference is None:
+            return
+        if getter.payload_reference is None:
+            # Rendered.
+            attempt.payload_data = share_payload(attempt.__parent__, getter.payload_data)
+            attempt.payload_reference = None
+        elif reference.tid is None and getter.payload_tid is not None:
+            # Not rendered. Keep the state to render for retries.
+            attempt.payload_reference = reference._replace(tid=getter.payload_tid)
+
     if str is bytes:
         @staticmethod
         def _dict_to_text(headers):
@@ -226,7 +834,10 @@ class ShipmentInfo(object):
 
         req.url = http_request.url
         req.method = text_type(http_request.method)
-        req.body = text_type(http_request.body) # XXX: Text/bytes. This uses default encoding.
+        body = text_type(http_request.body) # XXX: Text/bytes. This uses default encoding.
+        shared = stored_shared_payload(attempt)
+        # Usually the body is the payload; don't store it again.
+        req.body = shared if shared is not None and shared.data == body else body
 
         # XXX: What about stripping security sensitive headers from
         # request and response? I have a comment about that in the
@@ -266,9 +877,9 @@ class IExecutorService(interface.Interface):
     def waitForPendingExecutions(timeout=None):
         """
         Wait for all tasks that have been submitted but not yet finished
-        to finish.
-        ``submit``, wait for them all to finish. If any one of them
-        raises an exception, this method should raise an exception.
+        to finish, including any tasks they submit while running.
+        If any one of them raises an exception, this method should
+        raise an exception.
         """
 
     def shutdown():
@@ -276,44 +887,619 @@ class IExecutorService(interface.Interface):
         Stop accepting new tasks.
         """
 
+#: Overflow policy: wait up to ``block_timeout`` seconds for room in the
+#: queue, then drop the new task.
+OVERFLOW_BLOCK = 'block'
+#: Overflow policy: discard the task that has been waiting longest.
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+#: Overflow policy: discard the new task.
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+#: Overflow policy: give the new task to the ``spill_handler``
+#: to store durably; if it can't, discard it.
+OVERFLOW_SPILL = 'spill'
+
+
 @interface.implementer(IExecutorService)
 class ThreadPoolExecutorService(object):
+    """
+    Runs tasks in a pool of threads.
+
+    Tasks that cannot start right away wait in a queue holding no more
+    than :attr:`max_queue_depth` tasks. When a task is submitted and the queue is
+    full, :attr:`overflow_policy` decides what happens. Tasks that are
+    discarded have their ``discarded()`` method called, if they have one.
+
+    Tasks submitted by a running task (for example, the next work unit
+    waiting for the same destination) are always queued; blocking or
+    dropping them would only delay the work that frees room in the queue.
+    """
+
+    #: The number of threads. None uses the default of
+    #: :class:`concurrent.futures.ThreadPoolExecutor` in Python 3.8,
+    #: four more than the number of CPUs, up to 32.
+    max_workers = None
+
+    #: The most tasks that may be waiting for a thread.
+    max_queue_depth = 10000
+
+    #: What to do when a task is submitted and the queue is full.
+    #: One of :data:`OVERFLOW_BLOCK`, :data:`OVERFLOW_DROP_OLDEST`,
+    #: :data:`OVERFLOW_DROP_NEWEST` or :data:`OVERFLOW_SPILL`.
+    overflow_policy = OVERFLOW_BLOCK
+
+    #: How long, in seconds, :data:`OVERFLOW_BLOCK` waits.
+    #: Tasks submitted by the delivery manager when a
+    #: transaction commits wait only after the commit has finished,
+    #: holding no locks. Tasks that are resubmitted after being
+    #: deferred (see :meth:`ScheduledWorkUnit.defer`) never wait;
+    #: like tasks submitted by running tasks, they are always queued.
+    block_timeout = 30.0
+
+    #: A callable of one argument, the task, used by :data:`OVERFLOW_SPILL`.
+    #: It returns a true value if it stored the task.
+    spill_handler = None
+
+    #: A callable of no arguments, called from a worker thread each
+    #: time the queue becomes empty. It may submit more tasks.
+    drain_handler = None
 
     def __init__(self):
-        self.pending_tasks = []
-        self.executor = futures.ThreadPoolExecutor(thread_name_prefix='WebhookDeliveryManager')
+        self._max_workers = self.max_workers or min(32, (_cpu_count() or 1) + 4)
+        self.executor = futures.ThreadPoolExecutor(self._max_workers,
+                                                   thread_name_prefix='WebhookDeliveryManager')
+        # The number of tasks that may run at once.
+        self._slots = self._max_workers
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        # (task, time queued)
+        self._queue = deque()
+        # Tasks submitted and not yet finished that aren't in the queue.
+        self._active = 0
+        self._errors = []
+
+        #: The number of tasks discarded because the queue was full.
+        self.dropped_count = 0
+        #: The number of tasks given to the spill handler.
+        self.spilled_count = 0
+        #: The number of tasks that have started.
+        self.started_count = 0
+        #: The total time, in seconds, that started tasks spent waiting.
+        self.total_wait_time = 0.0
+        #: The longest time, in seconds, a started task spent waiting.
+        self.max_wait_time = 0.0
+
+    @property
+    def queue_depth(self):
+        """
+        The number of tasks waiting for a thread.
+        """
+        return len(self._queue)
+
+    @property
+    def pending_count(self):
+        """
+        The number of tasks that have been submitted and not finished.
+        """
+        return self._active + len(self._queue)
+
+    @property
+    def mean_wait_time(self):
+        """
+        The average time, in seconds, that started tasks spent waiting.
+        """
+        with self._cond:
+            return self.total_wait_time / self.started_count if self.started_count else 0.0
 
     def submit(self, func):
-        future = self.executor.submit(func) # pylint:disable=no-member
-        # Thread safety: We're relying on the GIL here to make
-        # appending and removal atomic and possible across threads.
-        self.pending_tasks.append(future)
-        future.add_done_callback(self.pending_tasks.remove)
+        now = time.time()
+        from_worker = getattr(self._local, 'worker', False) or getattr(func, 'resumed', False)
+        start = False
+        discard = overflow = None
+        with self._cond:
+            deadline = None
+            while True:
+                if self._active < self._slots:
+                    self._active += 1
+                    start = True
+                    break
+                if from_worker or len(self._queue) < self.max_queue_depth:
+                    self._queue.append((func, now))
+                    break
+                policy = self.overflow_policy
+                if policy == OVERFLOW_BLOCK:
+                    if deadline is None:
+                        deadline = now + self.block_timeout
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        self._cond.wait(remaining)
+                        continue
+                    overflow = func
+                elif policy == OVERFLOW_DROP_OLDEST:
+                    discard = self._queue.popleft()[0]
+                    self._queue.append((func, now))
+                else:
+                    overflow = func
+                break
+
+        if start:
+            self._start(func, now)
+            return
+        if overflow is not None and self.overflow_policy == OVERFLOW_SPILL:
+            if self.spill_handler is not None and self.spill_handler(overflow):
+                with self._cond:
+                    self.spilled_count += 1
+                overflow = None
+        discard = discard if overflow is None else overflow
+        if discard is not None:
+            self._discard(discard)
+
+    def _start(self, func, queued_at):
+        # Run *func*, and then what is queued, in a newly taken slot.
+        self.executor.submit(self._work, func, queued_at) # pylint:disable=no-member
+
+    def _discard(self, func):
+        logger.error("Delivery queue full (depth=%d); discarding %r", self.max_queue_depth, func)
+        with self._cond:
+            self.dropped_count += 1
+        discarded = getattr(func, 'discarded', None)
+        if discarded is not None:
+            try:
+                discarded()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to discard %r", func)
+
+    def _task_started(self, queued_at):
+        waited = time.time() - queued_at
+        with self._cond:
+            self.started_count += 1
+            self.total_wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+    def _next_task(self):
+        # Called when a task finishes. Returns the next ``(task, queued_at)``
+        # to run in its slot, or None if the slot is free.
+        with self._cond:
+            if self._queue:
+                task = self._queue.popleft()
+            else:
+                task = None
+                self._active -= 1
+            self._cond.notify_all()
+        return task
+
+    def _work(self, func, queued_at):
+        self._local.worker = True
+        while func is not None:
+            self._task_started(queued_at)
+            self._call(func)
+            if self.drain_handler is not None and not self._queue:
+                self._call(self.drain_handler)
+            func, queued_at = self._next_task() or (None, None)
+
+    def _call(self, func):
+        try:
+            func()
+        except Exception as ex: # pylint:disable=broad-except
+            self._task_failed(ex)
+
+    def _task_failed(self, ex):
+        with self._cond:
+            self._errors.append(ex)
 
     def waitForPendingExecutions(self, timeout=None):
-        # Thread safety: We're relying on the GIL to make copying the list
-        # of futures atomic. It's probably important to pass a new list here
-        # so that it doesn't mutate out from under the waiter as things finish.
-        # Note that this waits only for tasks that were already submitted.
-        t = list(self.pending_tasks)
-        done, not_done = futures.wait(t, timeout=timeout)
-        assert not not_done, not_done
-        assert len(done) == len(t), (done, t)
-        for future in done:
+        # Running tasks may submit follow-on tasks before they finish (for example,
+        # the next work unit waiting for the same host), so we keep going until
+        # nothing is pending.
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while self.pending_count:
+                remaining = deadline - time.time() if deadline is not None else None
+                assert remaining is None or remaining > 0, self.pending_count
+                self._cond.wait(remaining)
+            errors, self._errors = self._errors, []
+        if errors:
             # If any of them raised an exception, re-raise it.
             # This only gets the first exception, unfortunately.
-            future.result()
+            raise errors[0]
 
     def shutdown(self):
         self.executor.shutdown()
 
 
+class ScheduledWorkUnit(object):
+    """
+    A :class:`DestinationWorkUnit` that has been given to the executor
+    service by the delivery manager.
+
+    Calling this object delivers the unit using the manager's
+    HTTP session and then calls :meth:`finished`. Executor services
+    that deliver units themselves (such as
+    :class:`nti.webhooks.asyncio_executor.AsyncioExecutorService`) may
+    instead use :attr:`unit` and :attr:`http_session` directly, but
+    they must call :meth:`finished` exactly once when done. If the unit
+    is dropped without being delivered, :meth:`discarded` does that.
+    """
+
+    __slots__ = (
+        'scheduler',
+        'unit',
+        # Whether the unit was deferred, and so has been admitted by
+        # the executor before.
+        'resumed',
+    )
+
+    QUEUE_FULL_MESSAGE = _(u'Not sent because the delivery queue was full.')
+
+    def __init__(self, scheduler, unit, resumed=False):
+        self.scheduler = scheduler
+        self.unit = unit
+        self.resumed = resumed
+
+    @property
+    def http_session(self):
+        return self.scheduler._manager.http_session # pylint:disable=protected-access
+
+    @property
+    def manager(self):
+        return self.scheduler._manager # pylint:disable=protected-access
+
+    def __call__(self):
+        try:
+            deferred = self.unit.deliver(self.http_session, self.manager)
+        finally:
+            self.finished()
+        if deferred is not None:
+            self.defer(deferred)
+
+    def finished(self):
+        self.scheduler._finished(self.unit.host) # pylint:disable=protected-access
+
+    def defer(self, unit):
+        """
+        Schedule the :class:`DestinationWorkUnit` *unit*, returned from
+        delivering our unit, to be delivered after its ``defer_delay``.
+        Call this after :meth:`finished`.
+        """
+        self.scheduler._defer(unit) # pylint:disable=protected-access
+
+    def discarded(self):
+        """
+        Called when the executor has no room for the unit. Its attempts
+        fail without being sent.
+        """
+        try:
+            self.unit.fail(self.QUEUE_FULL_MESSAGE, 'the delivery queue was full')
+        finally:
+            self.finished()
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.unit)
+
+
+class _PerHostScheduler(object):
+    """
+    Submits :class:`DestinationWorkUnit` objects to an executor,
+    allowing only a limited number for any one host to be running at once.
+    The limit is either fixed, or adapted to each host (see
+    :mod:`nti.webhooks.concurrency`).
+
+    Units that would exceed the limit wait in a FIFO queue for their host
+    without occupying a worker; as each running unit finishes, the
+    next one waiting for the same host is submitted.
+    """
+
+    ABANDONED_MESSAGE = _(u'Not sent because delivery was stopped while it was put off.')
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._lock = threading.Lock()
+        self._deferred_changed = threading.Condition(self._lock)
+        self._local = threading.local()
+        # {host: number of submitted but unfinished units}
+        self._active = {}
+        # {id(unit): unit} for units waiting to be scheduled again.
+        self._deferred = {}
+        # {host: deque([(unit, resumed)])}
+        self._waiting = {}
+
+    def _limit(self, host):
+        concurrency = self._manager.host_concurrency
+        if concurrency is None:
+            return self._manager.max_concurrent_deliveries_per_host
+        return concurrency.limit(host)
+
+    def schedule(self, unit, resumed=False):
+        """
+        Submit *unit* when its host has room. If *resumed*, the unit
+        was deferred; see :class:`ScheduledWorkUnit`.
+        """
+        host = unit.host
+        with self._lock:
+            active = self._active.get(host, 0)
+            if active >= self._limit(host):
+                self._waiting.setdefault(host, deque()).append((unit, resumed))
+                return
+            self._active[host] = active + 1
+        self._submit(unit, resumed)
+
+    def _submit(self, unit, resumed):
+        # Submitting may discard a unit, which submits the next unit
+        # for its host, and so on; do that iteratively, not recursively.
+        submitting = getattr(self._local, 'submitting', None)
+        if submitting is not None:
+            submitting.append((unit, resumed))
+            return
+        self._local.submitting = submitting = deque([(unit, resumed)])
+        try:
+            while submitting:
+                unit, resumed = submitting.popleft()
+                self._manager.executor_service.submit(ScheduledWorkUnit(self, unit, resumed))
+        finally:
+            self._local.submitting = None
+
+    def _finished(self, host):
+        next_units = []
+        with self._lock:
+            active = self._active[host] - 1
+            waiting = self._waiting.get(host)
+            if waiting:
+                # Our slot passes directly to the next unit; if the
+                # limit has gone up, more may start.
+                limit = self._limit(host)
+                while waiting and active < limit:
+                    next_units.append(waiting.popleft())
+                    active += 1
+                if not waiting:
+                    del self._waiting[host]
+            if active:
+                self._active[host] = active
+            else:
+                del self._active[host]
+        for unit, resumed in next_units:
+            self._submit(unit, resumed)
+
+    def _defer(self, unit):
+        # Deferred units count as pending until they have been
+        # scheduled again.
+        with self._lock:
+            self._deferred[id(unit)] = unit
+        # pylint:disable=protected-access
+        self._manager._deferred_calls.call_later(unit.defer_delay, partial(self._resume, unit))
+
+    def _resume(self, unit):
+        with self._lock:
+            if self._deferred.get(id(unit)) is not unit:
+                # Abandoned.
+                return
+        try:
+            self.schedule(unit, True)
+        finally:
+            with self._lock:
+                self._deferred.pop(id(unit), None)
+                self._deferred_changed.notify_all()
+
+    @property
+    def deferred_count(self):
+        return len(self._deferred)
+
+    def waitForDeferred(self, timeout=None):
+        """
+        Wait until no units are deferred; those that were have been
+        scheduled again.
+
+        Returns whether there were any to wait for.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            if not self._deferred:
+                return False
+            while self._deferred:
+                remaining = deadline - time.time() if deadline is not None else None
+                assert remaining is None or remaining > 0, len(self._deferred)
+                self._deferred_changed.wait(remaining)
+        return True
+
+    def abandonDeferred(self):
+        """
+        Fail the attempts of the units that are deferred, without
+        sending them.
+        """
+        with self._lock:
+            units = list(self._deferred.values())
+            self._deferred.clear()
+            self._deferred_changed.notify_all()
+        for unit in units:
+            try:
+                unit.fail(self.ABANDONED_MESSAGE, 'the delivery manager stopped')
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to record abandoned %r", unit)
+
+    def active_count(self, host):
+        return self._active.get(host, 0)
+
+    def waiting_count(self, host):
+        return len(self._waiting.get(host, ()))
+
+
+class _DeliverySpill(object):
+    """
+    Durable storage for work units that didn't fit in the executor's
+    queue (see :data:`OVERFLOW_SPILL`).
+
+    The units aren't stored; references to their persistent attempts
+    are, in a BTree in the root of the main database. Those that are
+    still pending when the references are read back by :meth:`drain`
+    are delivered as a new shipment.
+    """
+
+    ROOT_KEY = 'nti.webhooks.delivery_manager.spill'
+
+    def __init__(self, manager):
+        self._manager = manager
+        # Set when this process has spilled something; we drain
+        # automatically then.
+        self._maybe_spilled = False
+        self._counter = count()
+
+    def spill(self, task):
+        """
+        Store the attempts of the :class:`ScheduledWorkUnit` *task*.
+
+        Returns whether that was possible; only units whose attempts
+        are all persistent can be spilled. If it was, then *task*
+        is finished.
+        """
+        unit = getattr(task, 'unit', None)
+        results = unit.results if unit is not None else ()
+        refs = tuple(
+            (result.attempt_getter.database_name, result.attempt_getter.oid)
+            for result in results
+            if isinstance(result.attempt_getter, _PersistentAttemptGetter)
+        )
+        if not refs or len(refs) != len(results):
+            return False
+
+        key = (time.time(), os.getpid(), next(self._counter))
+        def store(conn):
+            root = conn.root()
+            spilled = root.get(self.ROOT_KEY)
+            if spilled is None:
+                spilled = root[self.ROOT_KEY] = OOBTree()
+            spilled[key] = refs
+
+        try:
+            run_in_private_transaction(component.getUtility(IDatabase), store)
+        except Exception: # pylint:disable=broad-except
+            logger.exception("Failed to spill %r", task)
+            return False
+        self._maybe_spilled = True
+        task.finished()
+        return True
+
+    def drain(self, limit):
+        """
+        Deliver the attempts from up to *limit* spilled work units, oldest first.
+
+        Returns whether any spilled units remain.
+        """
+        def load(conn):
+            spilled = conn.root().get(self.ROOT_KEY)
+            if not spilled:
+                return None, False
+            pairs = []
+            for key in list(islice(spilled.keys(), limit)):
+                for database_name, oid in spilled.pop(key):
+                    try:
+                        attempt = conn.get_connection(database_name).get(oid)
+                    except POSKeyError:
+                        continue
+                    if attempt.pending():
+                        pairs.append((attempt.__parent__, attempt))
+            return self._manager.createShipmentInfo(pairs) if pairs else None, bool(spilled)
+
+        shipment, remaining = run_in_private_transaction(component.getUtility(IDatabase), load)
+        if shipment is not None:
+            self._manager.acceptForDelivery(shipment)
+        return remaining
+
+    def drain_if_needed(self):
+        if self._maybe_spilled:
+            self._maybe_spilled = False
+            try:
+                self._maybe_spilled = self.drain(self._manager.spill_drain_batch_size)
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to deliver spilled attempts")
+                self._maybe_spilled = True
+
+
 @interface.implementer(IWebhookDeliveryManager)
 class DefaultDeliveryManager(Contained):
 
+    #: The maximum number of work units (see :class:`DestinationWorkUnit`)
+    #: for any single destination host that may be delivering at the same time.
+    #: Shipments to different hosts are delivered concurrently, limited only
+    #: by the executor. When :attr:`adaptive_concurrency` is on, this is
+    #: only the starting limit for each host.
+    max_concurrent_deliveries_per_host = 2
+
+    #: Whether to adjust the limit of concurrent deliveries for each
+    #: host based on how it responds. See :mod:`nti.webhooks.concurrency`.
+    adaptive_concurrency = True
+
+    #: The highest the adaptive limit for a host may go.
+    adaptive_concurrency_max = 16
+
+    #: Responses slower than this many seconds lower the adaptive limit
+    #: for their host.
+    adaptive_concurrency_latency_target = 2.0
+
+    #: The number of connections to keep open to each destination host,
+    #: unless overridden in :attr:`http_host_pool_sizes`.
+    http_pool_maxsize = 10
+
+    #: A mapping from host name (without the port) to the number of
+    #: connections to keep open to that host. Each manager has its own,
+    #: initially empty.
+    http_host_pool_sizes = None
+
+    #: The number of distinct hosts to keep connection pools for.
+    http_pool_hosts = 100
+
+    #: How long, in seconds, a connection may be unused before it is
+    #: closed instead of being used again. None means no limit.
+    http_idle_timeout = 60
+
+    #: How long, in seconds, a connection may be used before it is
+    #: closed and replaced. This lets DNS changes take effect. None means
+    #: no limit.
+    http_max_connection_lifetime = 600
+
+    #: A callable of no arguments that creates the executor service
+    #: (see :class:`IExecutorService`) used to deliver shipments. The
+    #: default uses a pool of threads, each making one blocking request
+    #: at a time. On Python 3,
+    #: :class:`nti.webhooks.asyncio_executor.AsyncioExecutorService` may be
+    #: used instead to keep many more requests in flight.
+    executor_service_factory = ThreadPoolExecutorService
+
+    #: The number of spilled work units to deliver at a time. See
+    #: :data:`OVERFLOW_SPILL`.
+    spill_drain_batch_size = 100
+
+    #: If not None, the number of seconds each shipment has, from
+    #: the time it is accepted, to send all its attempts. Those
+    #: not sent by then fail (and may be retried; see
+    #: :mod:`nti.webhooks.retries`). See :meth:`ShipmentInfo.startDeadline`.
+    shipment_deadline = None
+
+    #: The number of consecutive failures to deliver to a host that
+    #: opens the circuit breaker for that host. None, the default,
+    #: disables circuit breakers. See :mod:`nti.webhooks.circuit_breaker`.
+    circuit_breaker_failure_threshold = None
+
+    #: How long, in seconds, a circuit stays open before trial
+    #: deliveries are allowed.
+    circuit_breaker_reset_timeout = 30.0
+
+    #: The number of trial deliveries that may be in progress at once
+    #: while a circuit is half-open.
+    circuit_breaker_half_open_max_calls = 1
+
+    #: What happens to attempts that can't be sent because the circuit
+    #: for their host is open: either
+    #: :data:`~nti.webhooks.circuit_breaker.CIRCUIT_OPEN_FAIL_FAST` or
+    #: :data:`~nti.webhooks.circuit_breaker.CIRCUIT_OPEN_DEFER`. Deferred
+    #: attempts are kept in memory only; see :attr:`deferred_count`.
+    circuit_open_policy = CIRCUIT_OPEN_FAIL_FAST
+
     def __init__(self, name):
         self.__name__ = name
         self.__parent__ = None
+        self.http_host_pool_sizes = {}
+        # These are used by concurrent deliveries; there must only
+        # ever be one of each at a time.
+        self._deferred_calls = DelayedCalls('WebhookDeliveryManagerDeferred')
+        self._host_scheduler = _PerHostScheduler(self)
 
     def __reduce__(self):
         return self.__name__
@@ -321,23 +1507,145 @@ class DefaultDeliveryManager(Contained):
     @Lazy
     def executor_service(self):
         # Delay creating a thread pool until used to allow for monkey-patching
-        return ThreadPoolExecutorService()
+        service = self.executor_service_factory()
+        if isinstance(service, ThreadPoolExecutorService):
+            service.spill_handler = self._spill.spill # pylint:disable=no-member
+            service.drain_handler = self._spill.drain_if_needed # pylint:disable=no-member
+        return service
+
+    @Lazy
+    def _spill(self):
+        return _DeliverySpill(self)
+
+    def drainSpilledDeliveries(self, limit=None):
+        """
+        Deliver attempts that were spilled to the database because the
+        delivery queue was full, up to *limit* work units (by default,
+        :attr:`spill_drain_batch_size`).
+
+        This happens automatically for attempts spilled by this process
+        once its queue empties. Call this at startup to deliver those
+        left behind by a process that has exited.
+
+        Returns whether any spilled work units remain.
+        """
+        return self._spill.drain(limit or self.spill_drain_batch_size) # pylint:disable=no-member
+
+    @Lazy
+    def circuit_breakers(self):
+        """
+        The :class:`nti.webhooks.circuit_breaker.DestinationCircuitBreakers`.
+        """
+        if self.circuit_breaker_failure_threshold is None:
+            return None
+        return DestinationCircuitBreakers(
+            failure_threshold=self.circuit_breaker_failure_threshold,
+            reset_timeout=self.circuit_breaker_reset_timeout,
+            half_open_max_calls=self.circuit_breaker_half_open_max_calls,
+        )
+
+    @Lazy
+    def host_concurrency(self):
+        """
+        The :class:`nti.webhooks.concurrency.AdaptiveConcurrencyLimits`,
+        or None if :attr:`adaptive_concurrency` is off.
+        """
+        if not self.adaptive_concurrency:
+            return None
+        return AdaptiveConcurrencyLimits(
+            initial_limit=self.max_concurrent_deliveries_per_host,
+            max_limit=max(self.adaptive_concurrency_max, self.max_concurrent_deliveries_per_host),
+            latency_target=self.adaptive_concurrency_latency_target,
+        )
+
+    @Lazy
+    def rate_limiter(self):
+        """
+        The :class:`nti.webhooks.rate_limit.DestinationRateLimiter`
+        that applies the rate limits of dialects.
+        """
+        return DestinationRateLimiter()
+
+    @property
+    def deferred_count(self):
+        """
+        The number of work units set aside to be delivered later because
+        of a circuit breaker or a rate limit.
+
+        These are pending deliveries: :meth:`waitForPendingDeliveries`
+        waits for them to be delivered. They are only kept in memory;
+        if the manager is reset, their attempts fail without being sent
+        (and if the process exits, they remain pending, to be found by
+        the outbox if there is one).
+        """
+        return self._host_scheduler.deferred_count
+
+    @Lazy
+    def connection_statistics(self):
+        """
+        The :class:`nti.webhooks._http.ConnectionPoolStatistics` for
+        :attr:`http_session`.
+        """
+        return ConnectionPoolStatistics()
+
+    @Lazy
+    def http_session(self):
+        """
+        The long-lived, thread-safe :class:`requests.Session` used to
+        deliver all shipments, sharing a connection pool.
+        """
+        adapter = PooledHTTPAdapter(
+            host_pool_sizes=self.http_host_pool_sizes,
+            idle_timeout=self.http_idle_timeout,
+            max_lifetime=self.http_max_connection_lifetime,
+            statistics=self.connection_statistics,
+            pool_connections=self.http_pool_hosts,
+            pool_maxsize=self.http_pool_maxsize,
+        )
+        return create_pooled_session(adapter)
 
     def createShipmentInfo(self, subscriptions_and_attempts):
         return ShipmentInfo(subscriptions_and_attempts)
 
     def acceptForDelivery(self, shipment_info):
         assert isinstance(shipment_info, ShipmentInfo)
-        self.executor_service.submit(shipment_info.deliver) # pylint:disable=no-member
+        if self.shipment_deadline is not None and shipment_info.deadline is None:
+            shipment_info.startDeadline(self.shipment_deadline)
+        for unit in shipment_info.work_units:
+            self._host_scheduler.schedule(unit)
 
     def waitForPendingDeliveries(self, timeout=None):
-        self.executor_service.waitForPendingExecutions(timeout) # pylint:disable=no-member
+        # Deferred units are submitted to the executor again when their
+        # time comes, and running units may defer more; wait until
+        # neither has anything pending.
+        deadline = time.time() + timeout if timeout is not None else None
+        remaining = lambda: deadline - time.time() if deadline is not None else None
+        # pylint:disable=no-member
+        while True:
+            self.executor_service.waitForPendingExecutions(remaining())
+            if not self._host_scheduler.waitForDeferred(remaining()):
+                break
 
     def _reset(self):
         # Called for test cleanup.
+        deferred_calls = self._deferred_calls
+        self._deferred_calls = DelayedCalls('WebhookDeliveryManagerDeferred')
+        deferred_calls.stop()
+        host_scheduler = self._host_scheduler
+        self._host_scheduler = _PerHostScheduler(self)
+        # Nothing will deliver them now.
+        host_scheduler.abandonDeferred()
         exec_service = self.__dict__.pop('executor_service', None)
         if exec_service is not None:
             exec_service.shutdown()
+        self.__dict__.pop('_spill', None)
+        self.__dict__.pop('circuit_breakers', None)
+        self.__dict__.pop('rate_limiter', None)
+        self.__dict__.pop('host_concurrency', None)
+        http_session = self.__dict__.pop('http_session', None)
+        if http_session is not None:
+            http_session.close()
+        self.__dict__.pop('connection_statistics', None)
 
 # Name string must match variable identifier for pickling
 global_delivery_manager = DefaultDeliveryManager('global_delivery_manager')
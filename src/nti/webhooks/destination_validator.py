@@ -8,24 +8,211 @@ from __future__ import division
 from __future__ import print_function
 
 import socket
+import threading
+import time
+from collections import OrderedDict
 try:
     from urllib.parse import urlsplit
 except ImportError: # Py2
     from urlparse import urlsplit
 
+from zope import component
 from zope import interface
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
 
 from nti.webhooks import interfaces
+from nti.webhooks._delayed import DelayedCalls
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The message given to delivery attempts whose destination
+#: fails validation.
+VALIDATION_FAILED_MESSAGE = u'Verification of the destination URL failed. Please check the domain.'
+
 
 @interface.implementer(interfaces.IWebhookDestinationValidator)
 class DefaultDestinationValidator(object):
+    """
+    Requires HTTPS, and a domain that can be resolved.
 
-    def validateTarget(self, target_url):
+    The results of resolving domains are cached. The system
+    resolver doesn't tell us the TTL of the records it found, so
+    successful lookups are kept for :attr:`positive_ttl` seconds and
+    failed lookups for :attr:`negative_ttl` seconds. No more than
+    :attr:`max_entries` are kept; the least recently used are
+    forgotten first.
+
+    Domains are looked up in the background when a subscription is
+    added (see :func:`prefetch_destination_when_added`), so that
+    the first delivery attempt usually finds them cached.
+
+    Validation normally happens when delivery attempts are created,
+    which is while the transaction that caused them is committing. If
+    the domain isn't cached, that waits on the resolver. Setting
+    :attr:`validate_at_delivery` moves the lookup to the delivery
+    manager instead. When attempts are created, only the scheme and
+    cached failures are checked; the rest of the validation happens
+    just before sending.
+    """
+
+    #: How long, in seconds, to remember that a domain could be resolved.
+    positive_ttl = 300.0
+
+    #: How long, in seconds, to remember that a domain could not be resolved.
+    negative_ttl = 30.0
+
+    #: The most domains to remember.
+    max_entries = 1000
+
+    #: If true, don't wait on the resolver when attempts are created;
+    #: see :meth:`validateTargetForDelivery`.
+    validate_at_delivery = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(host, port): (expires_at, exception or None)}
+        self._cache = OrderedDict()
+        self._prefetching = set()
+        #: The number of lookups answered from the cache.
+        self.hits = 0
+        #: The number of lookups that asked the resolver.
+        self.misses = 0
+
+    @staticmethod
+    def _parse(target_url):
         parsed_url = urlsplit(target_url)
         if parsed_url.scheme != 'https':
             raise ValueError("Refusing to deliver to insecure destination")
+        if not parsed_url.hostname:
+            raise ValueError("No destination host")
+        return parsed_url.hostname, parsed_url.port or 'https'
+
+    def validateTarget(self, target_url):
+        key = self._parse(target_url)
+        if not self.validate_at_delivery:
+            # Look it up, raise an exception if not found.
+            self._resolve(key)
+            return
+
+        found, error = self._cached(key)
+        if error is not None:
+            self._raise(error)
+        if not found:
+            self._prefetch(key)
+
+    def validateTargetForDelivery(self, target_url):
+        """
+        Non-interface method. If :attr:`validate_at_delivery` is set,
+        finish the validation that :meth:`validateTarget` put off.
+        Otherwise, do nothing.
+
+        This is called by the delivery manager just before sending.
+        """
+        if self.validate_at_delivery:
+            self._resolve(self._parse(target_url))
 
-        domain = parsed_url.netloc
-        # Look it up, raise an exception if not found.
-        # TODO: Caching.
-        socket.getaddrinfo(domain, 'https')
+    def prefetch(self, target_url):
+        """
+        Non-interface method. Look up the domain of *target_url* in the
+        background, if it's not already cached.
+        """
+        try:
+            key = self._parse(target_url)
+        except ValueError:
+            return
+        found, _ = self._cached(key)
+        if not found:
+            self._prefetch(key)
+
+    def _cached(self, key):
+        # Return (found, exception or None).
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return False, None
+            # Most recently used goes last.
+            self._cache[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def _resolve(self, key):
+        found, error = self._cached(key)
+        if not found:
+            error = self._lookup(key)
+        if error is not None:
+            self._raise(error)
+
+    def _lookup(self, key):
+        with self._lock:
+            self.misses += 1
+        try:
+            socket.getaddrinfo(*key)
+        except (socket.error, UnicodeError) as ex:
+            error = ex
+            ttl = self.negative_ttl
+        else:
+            error = None
+            ttl = self.positive_ttl
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time.time() + ttl, error)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return error
+
+    @staticmethod
+    def _raise(error):
+        # Raise a new exception each time, so tracebacks don't pile up
+        # on the cached one.
+        raise type(error)(*error.args)
+
+    def _prefetch(self, key):
+        with self._lock:
+            if key in self._prefetching:
+                return
+            self._prefetching.add(key)
+        _get_prefetcher().call_later(0, lambda: self._run_prefetch(key))
+
+    def _run_prefetch(self, key):
+        try:
+            self._lookup(key)
+        finally:
+            with self._lock:
+                self._prefetching.discard(key)
+
+
+# One background thread is shared by all validators.
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+def _get_prefetcher():
+    global _prefetcher # pylint:disable=global-statement
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = DelayedCalls('WebhookDestinationPrefetch')
+        return _prefetcher
+
+
+@component.adapter(interfaces.IWebhookSubscription, IObjectAddedEvent)
+def prefetch_destination_when_added(subscription, _event):
+    validator = component.queryUtility(interfaces.IWebhookDestinationValidator,
+                                       context=subscription)
+    prefetch = getattr(validator, 'prefetch', None)
+    if prefetch is not None:
+        prefetch(subscription.to)
+
+
+def _stop_prefetching():
+    global _prefetcher # pylint:disable=global-statement
+    with _prefetcher_lock:
+        prefetcher, _prefetcher = _prefetcher, None
+    if prefetcher is not None:
+        prefetcher.stop()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp # pylint:disable=ungrouped-imports
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(_stop_prefetching)
@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import pkg_resources
 from zope.interface import implementer
+from zope.interface import providedBy
 from zope import component
 
 from requests import Request
@@ -18,6 +19,16 @@ from nti.externalization.interfaces import IExternalObjectRepresenter
 from nti.webhooks.interfaces import IWebhookDialect
 from nti.webhooks.interfaces import IWebhookPayload
 
+#: The external form depends only on the data. This is the default.
+PAYLOAD_CACHE_BY_DATA = 'data'
+
+#: The external form depends on the data and the interfaces the
+#: event provides, but not on the particular event.
+PAYLOAD_CACHE_BY_EVENT_TYPE = 'data+event_type'
+
+#: The external form depends on the data and the particular event.
+PAYLOAD_CACHE_BY_EVENT = 'data+event'
+
 @implementer(IWebhookDialect)
 class DefaultWebhookDialect(object):
     """
@@ -59,6 +70,94 @@ class DefaultWebhookDialect(object):
     #: The HTTP method (verb) to use.
     http_method = 'POST'
 
+    #: What the result of :meth:`externalizeData` depends on, one of
+    #: :data:`PAYLOAD_CACHE_BY_DATA`, :data:`PAYLOAD_CACHE_BY_EVENT_TYPE`
+    #: or :data:`PAYLOAD_CACHE_BY_EVENT`. When one transaction delivers
+    #: the same data many times, it is only externalized once for each
+    #: distinct key; see :meth:`payload_cache_key_for`. If the payload
+    #: adapters use the event, choose one of the last two.
+    payload_cache_key = PAYLOAD_CACHE_BY_DATA
+
+    #: If true, render payloads in the delivery manager after the
+    #: transaction commits, from the committed state of the data,
+    #: instead of while it is committing. Only applies when
+    #: :attr:`payload_cache_key` is :data:`PAYLOAD_CACHE_BY_DATA`. See
+    #: :mod:`nti.webhooks.deferred_payloads`.
+    defer_payload_rendering = False
+
+    #: The name of the
+    #: :class:`~nti.webhooks.interfaces.IWebhookEventCoalescingPolicy`
+    #: that decides which of the events fired for one object in one
+    #: transaction are delivered, or None to deliver them all.
+    #: Subscriptions may override this. See :mod:`nti.webhooks.coalescing`.
+    coalescing_policy = None
+
+    #: How long, in seconds, to wait to connect to the receiver.
+    #: None waits forever.
+    connect_timeout = 10.0
+
+    #: How long, in seconds, to wait for the receiver to send
+    #: each part of its response. None waits forever.
+    read_timeout = 30.0
+
+    #: How long, in seconds, the whole response may take, no matter how
+    #: steadily it arrives. This is checked between reads, so it may be
+    #: exceeded by up to :attr:`read_timeout`. None means no limit.
+    total_timeout = 60.0
+
+    #: How many times a failed delivery attempt to a persistent
+    #: subscription is retried. Each retry is a new delivery attempt.
+    #: This and the other ``retry_`` settings can be overridden by
+    #: a subscription. See :mod:`nti.webhooks.retries`.
+    retry_limit = 0
+
+    #: How long, in seconds, to wait before the first retry.
+    retry_initial_delay = 30.0
+
+    #: Each retry waits this many times longer than the one before it.
+    retry_backoff_multiplier = 2.0
+
+    #: The longest, in seconds, to wait before a retry.
+    retry_max_delay = 3600.0
+
+    #: The fraction of each wait that is random. 0 waits exactly
+    #: the computed time; 1 waits anywhere from no time to the computed time.
+    retry_jitter = 0.5
+
+    #: The most requests per second to send to any one destination
+    #: host, or None for no limit. Sending is paced using a token
+    #: bucket, shared by the dialects with the same limits; see
+    #: :mod:`nti.webhooks.rate_limit`.
+    rate_limit = None
+
+    #: The most requests that may be sent to a host at once, in a
+    #: burst, before :attr:`rate_limit` applies. None means the
+    #: larger of 1 and :attr:`rate_limit`.
+    rate_limit_burst = None
+
+    #: Like :attr:`rate_limit`, but for each subscription.
+    subscription_rate_limit = None
+
+    #: Like :attr:`rate_limit_burst`, but for each subscription.
+    subscription_rate_limit_burst = None
+
+    #: If not None, a subscription is deactivated when at least this
+    #: fraction (from 0 to 1) of its recent deliveries failed. This and
+    #: the other ``failure_`` settings can be overridden by a
+    #: subscription. See :mod:`nti.webhooks.failure_window`.
+    failure_ratio_limit = None
+
+    #: How many of the most recent delivery results to consider.
+    failure_window_size = 20
+
+    #: If not None, only consider delivery results from this many
+    #: seconds ago or later.
+    failure_window_seconds = None
+
+    #: The fewest delivery results that must be considered before
+    #: deactivating.
+    failure_window_minimum = 10
+
     def produce_payload(self, data, event):
         """
         produce_payload(data, event) -> IWebhookPayload
@@ -97,6 +196,39 @@ class DefaultWebhookDialect(object):
             return result
         return component.queryAdapter(data, IWebhookPayload, default=data, context=data)
 
+    def payload_cache_key_for(self, data, event):
+        """
+        payload_cache_key_for(data, event) -> hashable
+
+        Non-interface method. Return a key such that calling
+        :meth:`externalizeData` with arguments that produce equal keys,
+        on this dialect or any other, produces the same result.
+
+        Besides what is chosen by :attr:`payload_cache_key`, the key
+        includes how this dialect externalizes (its class's methods,
+        :attr:`externalizer_name`, :attr:`externalizer_policy_name` and
+        :attr:`externalizer_format`), so dialects that differ only in
+        other ways, such as those made by the ZCML directive, share
+        payloads.
+        """
+        kind = type(self)
+        key = (
+            kind.produce_payload,
+            kind.externalizeData,
+            self.externalizer_name,
+            self.externalizer_policy_name,
+            self.externalizer_format,
+            data,
+        )
+        scope = self.payload_cache_key
+        if scope == PAYLOAD_CACHE_BY_EVENT_TYPE:
+            key += (providedBy(event),)
+        elif scope == PAYLOAD_CACHE_BY_EVENT:
+            key += (event,)
+        elif scope != PAYLOAD_CACHE_BY_DATA:
+            raise ValueError("Unknown payload cache key", scope)
+        return key
+
     def externalizeData(self, data, event):
         "See :meth:`nti.webhooks.interfaces.IWebhookDialect.externalizeData`"
         payload = self.produce_payload(data, event)
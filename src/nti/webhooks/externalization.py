@@ -16,6 +16,7 @@ from nti.externalization.interfaces import ExternalizationPolicy
 from nti.externalization.datastructures import InterfaceObjectIO
 
 from nti.webhooks.interfaces import IWebhookSubscription
+from nti.webhooks.interfaces import ILimitedAttemptWebhookSubscription
 from nti.webhooks.interfaces import IWebhookDeliveryAttempt
 from nti.webhooks.interfaces import IWebhookDeliveryAttemptRequest
 from nti.webhooks.interfaces import IWebhookDeliveryAttemptResponse
@@ -80,10 +81,19 @@ class SubscriptionExternalizer(_MimeTypeInsertingExternalizer):
         'for_', 'when',
     }) | _MimeTypeInsertingExternalizer._excluded_out_ivars_
 
+    #: Whether to include the externalized delivery attempts as
+    #: ``Contents``. This loads every stored attempt; the
+    #: ``attempt_counts`` summarize them without doing so.
+    include_contents = False
+
     def toExternalObject(self, *args, **kwargs):
         result = super(SubscriptionExternalizer, self).toExternalObject(*args, **kwargs)
         context = self._ext_self
-        result['Contents'] = to_external_object(list(context.values()))
+        if self.include_contents:
+            result['Contents'] = to_external_object(list(context.values()))
+        if ILimitedAttemptWebhookSubscription.providedBy(context):
+            # Summarize them without having to look through the contents.
+            result['attempt_counts'] = context.attemptCounts()
         # TODO: This is a temporary hack. We need to figure out if there is anything
         # useful for receivers to have here or if its better just to omit it.
         result['for_'] = describe_class_or_specification(context.for_)
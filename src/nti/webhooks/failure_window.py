@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Deactivating subscriptions whose deliveries fail too often.
+
+By default, a subscription is only deactivated when every one of its
+stored delivery attempts failed (see
+:func:`nti.webhooks.subscriptions.deactivate_subscription_when_all_failed`),
+so a receiver that fails intermittently is never deactivated.
+
+When the ``failure_ratio_limit`` setting of the dialect of a
+subscription (or of the subscription itself, which overrides the
+dialect) is not None, the subscription is also deactivated when at
+least that fraction of its recent deliveries failed. The recent
+deliveries are the last ``failure_window_size`` that were resolved,
+and, if ``failure_window_seconds`` is set, only those resolved that
+many seconds ago or later. At least ``failure_window_minimum`` of
+them must be considered before deciding. Attempts that failed without
+being sent because the circuit breaker for their host was open (see
+:mod:`nti.webhooks.circuit_breaker`) aren't considered.
+
+The results are kept in a :class:`FailureWindow`: a fixed-size ring
+buffer of times and outcomes, which is a single small persistent
+object for each subscription. Recording a result and judging the
+ratio don't load any delivery attempts. Results recorded by
+concurrent transactions are merged instead of conflicting. The window
+starts over when the subscription is activated again.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from array import array
+import time
+
+from persistent import Persistent
+from zope import component
+from ZODB.POSException import ConflictError
+
+from nti.webhooks import MessageFactory as _
+from nti.webhooks.circuit_breaker import failed_while_open
+from nti.webhooks.interfaces import IWebhookDeliveryAttemptResolvedEvent
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def failure_setting(subscription, name):
+    """
+    Return the failure setting *name* of *subscription*, or of its
+    dialect if the subscription doesn't override it.
+    """
+    value = getattr(subscription, name, None)
+    if value is None:
+        value = getattr(subscription.dialect, name)
+    return value
+
+
+class FailureWindow(Persistent):
+    """
+    The times and outcomes of the most recent *size* delivery results.
+    """
+
+    def __init__(self, size):
+        self._times = array('d', [0.0]) * size
+        self._failed = bytearray(size)
+        # Where the next result goes.
+        self._next = 0
+        # How many results there are, up to size, and how many of
+        # them are failures.
+        self._count = 0
+        self._failures = 0
+        # How many results were ever recorded; used to merge
+        # conflicting changes.
+        self._recorded = 0
+
+    @property
+    def size(self):
+        return len(self._failed)
+
+    def __len__(self):
+        return self._count
+
+    def record(self, failed, now=None):
+        """
+        Record a delivery result, replacing the oldest one if the
+        window is full.
+        """
+        index = self._next
+        if self._count == self.size:
+            self._failures -= self._failed[index]
+        else:
+            self._count += 1
+        self._times[index] = now if now is not None else time.time()
+        self._failed[index] = 1 if failed else 0
+        self._failures += self._failed[index]
+        self._next = (index + 1) % self.size
+        self._recorded += 1
+        # Changing the arrays in place isn't noticed.
+        self._p_changed = True
+
+    def counts(self, since=None):
+        """
+        Return ``(failures, total)`` for the results recorded at the
+        time *since* or later, or for all of them if it is None.
+        """
+        if since is None:
+            return self._failures, self._count
+        failures = total = 0
+        index = self._next
+        for _ in range(self._count):
+            index = (index - 1) % self.size
+            if self._times[index] < since:
+                break
+            total += 1
+            failures += self._failed[index]
+        return failures, total
+
+    def _p_resolveConflict(self, old_state, committed_state, new_state):
+        # Each transaction only appends results. Keep those appended
+        # by both, the committed ones first.
+        try:
+            old_recorded = old_state['_recorded']
+            committed_recorded = committed_state['_recorded']
+            new_recorded = new_state['_recorded']
+        except KeyError:
+            raise ConflictError
+        size = len(committed_state['_failed'])
+        if size != len(new_state['_failed']) or size != len(old_state['_failed']):
+            raise ConflictError
+
+        appended = new_recorded - old_recorded
+        entries = _entries(committed_state)
+        if appended > 0:
+            entries.extend(_entries(new_state)[-appended:])
+        entries = entries[-size:]
+
+        state = dict(committed_state)
+        count = len(entries)
+        state['_times'] = array('d', [t for t, _ in entries] + [0.0] * (size - count))
+        state['_failed'] = bytearray([f for _, f in entries] + [0] * (size - count))
+        state['_next'] = count % size
+        state['_count'] = count
+        state['_failures'] = sum(f for _, f in entries)
+        state['_recorded'] = committed_recorded + appended
+        return state
+
+
+def _entries(state):
+    # The (time, failed) pairs in the state of a FailureWindow,
+    # oldest first.
+    times = state['_times']
+    failed = state['_failed']
+    size = len(failed)
+    count = state['_count']
+    start = state['_next'] - count
+    return [(times[(start + i) % size], failed[(start + i) % size])
+            for i in range(count)]
+
+
+def failure_window_for(subscription):
+    """
+    Return the :class:`FailureWindow` of *subscription*, creating it
+    if needed, or if its size setting changed.
+    """
+    size = failure_setting(subscription, 'failure_window_size')
+    window = subscription._failure_window # pylint:disable=protected-access
+    if window is None or window.size != size:
+        window = subscription._failure_window = FailureWindow(size) # pylint:disable=protected-access
+    return window
+
+
+@component.adapter(IWebhookDeliveryAttemptResolvedEvent)
+def deactivate_subscription_when_failure_ratio_exceeded(event):
+    # type: (IWebhookDeliveryAttemptResolvedEvent) -> None
+    subscription = event.object.__parent__
+    if subscription is None or not subscription.active:
+        return
+    limit = failure_setting(subscription, 'failure_ratio_limit')
+    if limit is None or failed_while_open(event.object):
+        return
+
+    now = time.time()
+    window = failure_window_for(subscription)
+    window.record(not event.success, now)
+    seconds = failure_setting(subscription, 'failure_window_seconds')
+    failures, total = window.counts(now - seconds if seconds is not None else None)
+    if total < failure_setting(subscription, 'failure_window_minimum') \
+       or not failures or failures < limit * total:
+        return
+
+    logger.info(
+        "Deactivating webhook subscription %s due to %d of %d recent delivery failures.",
+        subscription, failures, total,
+    )
+    manager = subscription.__parent__
+    manager.deactivateSubscription(subscription)
+    subscription.status_message = _(u'Delivery suspended due to too many recent delivery failures.')
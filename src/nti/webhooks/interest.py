@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Quickly rejecting events that no subscription is interested in.
+
+When :func:`nti.webhooks.subscribers.dispatch_webhook_event` is
+registered broadly (for example, by ``subscribers_promiscuous.zcml``),
+it runs for many events that no subscription could apply to, and
+finding that out means searching every subscription manager in
+several lookup chains.
+
+Instead, the ``(for_, when)`` specifications of all active
+subscriptions are summarized in an :class:`InterestSet`, which
+answers whether any of them applies to the interfaces provided by
+the data and the event with a single cached registry lookup. These
+summaries are kept current as subscriptions are activated and
+deactivated, by the same ``IRegistered`` and ``IUnregistered``
+events that keep their ``active`` attribute current.
+
+Subscriptions in registries that are not persistent (such as the
+global subscriptions) are summarized in memory. Those in a
+persistent registry are summarized in an :class:`InterestSummary`
+kept in the root of its database, so every process sees the same
+summary, and changes to it are part of the transaction that made
+them. The summary keeps a conflict-resolving counter for each
+specification, so concurrent transactions that activate or deactivate
+subscriptions don't conflict unless a specification becomes active or
+inactive. The set of active specifications is kept by the summary
+itself, which only changes when that happens; each connection builds
+its :class:`InterestSet` from it once for each committed change, so
+checking an event doesn't look at the counters. Concurrent
+deactivations may leave a specification in the set after its last
+subscription is gone, which only means the events it matches are not
+rejected.
+
+A database without a summary might have subscriptions, so events
+that could reach it are never rejected. The summary is created the
+first time a subscription is activated in a persistent registry
+whose database can be found, counting every active subscription that
+:func:`rebuild_interest_summary` can find in the database; from then
+on, it is kept current.
+
+The database of a subscription is found from its registry, or by
+walking up the ``__parent__`` of the subscription. A subscription
+activated in a new registry that can't be found that way (for
+example, one only stored in the root of a database, in the same
+transaction) is only counted in memory by the process that activated
+it, until the summary is rebuilt.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import weakref
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from persistent.interfaces import IPersistent
+from zope import component
+from zope.interface import providedBy
+from zope.interface.adapter import AdapterRegistry
+from zope.interface.interfaces import IRegistered
+from zope.interface.interfaces import IUnregistered
+
+from nti.webhooks.interfaces import IWebhookSubscription
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class InterestSet(object):
+    """
+    Counts the ``(for_, when)`` specifications of subscriptions.
+    """
+
+    def __init__(self, counts=()):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._registry = AdapterRegistry()
+        for required, count in counts:
+            self.add(required, count)
+
+    def add(self, required, count=1):
+        """
+        Count *count* more subscriptions for the tuple of specifications
+        *required*.
+        """
+        with self._lock:
+            old = self._counts.get(required, 0)
+            self._counts[required] = old + count
+            if not old:
+                self._registry.subscribe(required, IWebhookSubscription, required)
+
+    def remove(self, required):
+        """
+        Count one less subscription for *required*.
+        """
+        with self._lock:
+            count = self._counts.get(required, 0) - 1
+            if count > 0:
+                self._counts[required] = count
+            elif required in self._counts:
+                del self._counts[required]
+                self._registry.unsubscribe(required, IWebhookSubscription, required)
+
+    def interested(self, data, event):
+        """
+        Could any of the counted subscriptions apply to *data* and *event*?
+        """
+        return bool(self._registry.subscriptions((providedBy(data), providedBy(event)),
+                                                 IWebhookSubscription))
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+
+class InterestSummary(Persistent):
+    """
+    Counts the ``(for_, when)`` specifications of the active
+    subscriptions in the persistent registries of a database.
+    """
+
+    #: Where the summary is kept in the root of the database.
+    ROOT_KEY = 'nti.webhooks.interest'
+
+    def __init__(self):
+        # {required: Length}. Only the first subscription for a
+        # specification, or the last, changes the tree.
+        self._counts = OOBTree()
+        # The specifications that have any subscriptions. Changing
+        # this changes our serial, which tells other connections to
+        # build their InterestSet again.
+        self._active = frozenset()
+
+    @classmethod
+    def find(cls, jar, create=False):
+        """
+        Return the summary for the database of the connection *jar*,
+        creating it if needed and *create* is true; otherwise None.
+        """
+        root = jar.root()
+        summary = root.get(cls.ROOT_KEY)
+        if summary is None and create:
+            summary = root[cls.ROOT_KEY] = cls()
+        return summary
+
+    def add(self, required):
+        counter = self._counts.get(required)
+        if counter is None:
+            counter = self._counts[required] = Length()
+        if counter() > 0:
+            # If a concurrent transaction removes the last one, one
+            # of us must start over.
+            _read_current(self)
+        else:
+            self._setActive(self._active | {required})
+        counter.change(1)
+
+    def remove(self, required):
+        counter = self._counts.get(required)
+        if counter is None or counter() <= 0:
+            return
+        if counter() > 1:
+            counter.change(-1)
+            return
+        # The last one. Concurrent changes to the counter would be
+        # merged with ours, so instead of changing it, replace it, and
+        # make sure it's not changed in the meantime.
+        _read_current(counter)
+        self._counts[required] = Length()
+        self._setActive(self._active - {required})
+
+    def _setActive(self, active):
+        self._active = frozenset(active)
+        self._v_interest = None
+
+    def interested(self, data, event):
+        interest = getattr(self, '_v_interest', None)
+        if interest is None or self._v_serial != self._p_serial:
+            interest = self._v_interest = InterestSet((required, 1) for required in self._active)
+            self._v_serial = self._p_serial
+        return interest.interested(data, event)
+
+    def __len__(self):
+        return sum(max(counter(), 0) for counter in self._counts.values())
+
+
+def _read_current(obj):
+    # Fail the transaction if *obj* is changed by another one
+    # that commits first.
+    jar = obj._p_jar # pylint:disable=protected-access
+    if jar is not None and obj._p_oid is not None: # pylint:disable=protected-access
+        jar.readCurrent(obj)
+
+
+#: Subscriptions in registries that aren't in a database.
+_process_interest = InterestSet()
+
+#: Subscriptions in persistent registries counted in
+#: :data:`_process_interest` because their database wasn't known.
+_in_process = weakref.WeakSet()
+
+
+def _jar_of(context):
+    # The connection of *context*, or its nearest persistent parent.
+    while context is not None:
+        jar = getattr(context, '_p_jar', None)
+        if jar is not None:
+            return jar
+        context = getattr(context, '__parent__', None)
+    return None
+
+
+def _persistent_registry(registry):
+    # ``PersistentComponents`` aren't themselves persistent, but their
+    # adapter registries are.
+    return IPersistent.providedBy(registry) \
+        or IPersistent.providedBy(getattr(registry, 'adapters', None))
+
+
+def _registry_jar(registry, subscription):
+    for context in getattr(registry, 'adapters', None), registry, subscription:
+        jar = _jar_of(context)
+        if jar is not None:
+            return jar
+    return None
+
+
+@component.adapter(IWebhookSubscription, IRegistered)
+def record_interest_when_registered(subscription, event):
+    registration = event.object
+    if getattr(registration, 'provided', None) is not IWebhookSubscription:
+        return
+    registry = registration.registry
+    if not _persistent_registry(registry):
+        _process_interest.add(registration.required)
+        return
+    jar = _registry_jar(registry, subscription)
+    if jar is None:
+        # A new registry that isn't stored yet, and whose subscription
+        # can't be found from anything that is. We can't tell which
+        # database it will be in, so count it here, for as long as
+        # it's registered or until the summary is rebuilt.
+        _in_process.add(subscription)
+        _process_interest.add(registration.required)
+        return
+    summary = InterestSummary.find(jar)
+    if summary is None:
+        # The first in this database (or the first since a version
+        # that didn't keep summaries). Count everything there is,
+        # including this one.
+        summary, counted = _rebuild_interest_summary(jar)
+        if id(registry) not in counted:
+            _count_registry(summary, registry)
+        return
+    summary.add(registration.required)
+
+
+@component.adapter(IWebhookSubscription, IUnregistered)
+def forget_interest_when_unregistered(subscription, event):
+    registration = event.object
+    if getattr(registration, 'provided', None) is not IWebhookSubscription:
+        return
+    registry = registration.registry
+    if not _persistent_registry(registry):
+        _process_interest.remove(registration.required)
+        return
+    if subscription in _in_process:
+        _in_process.discard(subscription)
+        _process_interest.remove(registration.required)
+        return
+    jar = _registry_jar(registry, subscription)
+    summary = InterestSummary.find(jar) if jar is not None else None
+    if summary is not None:
+        summary.remove(registration.required)
+
+
+def _tracking():
+    # If the subscribers that keep the summaries current aren't
+    # registered, the summaries can't be trusted.
+    adapters = component.getGlobalSiteManager().adapters
+    return (
+        record_interest_when_registered in adapters.subscriptions(
+            (IWebhookSubscription, IRegistered), None)
+        and forget_interest_when_unregistered in adapters.subscriptions(
+            (IWebhookSubscription, IUnregistered), None)
+    )
+
+
+def may_be_interested(data, event):
+    """
+    Could any active subscription apply to *data* and *event*?
+
+    This returns False only when it is sure. The databases consulted
+    are those of the current site manager and of the *data* (or its
+    nearest persistent parent), and any other databases in their
+    multi-databases.
+    """
+    if _process_interest.interested(data, event) or not _tracking():
+        return True
+    seen_databases = set()
+    for jar in _jar_of(component.getSiteManager()), _jar_of(data):
+        if jar is None:
+            continue
+        for name in jar.db().databases:
+            if name in seen_databases:
+                continue
+            seen_databases.add(name)
+            summary = InterestSummary.find(jar.get_connection(name))
+            if summary is None or summary.interested(data, event):
+                return True
+    return False
+
+
+def rebuild_interest_summary(conn, managers=None):
+    """
+    Replace the summary in the database of the connection *conn*
+    with one counting the active subscriptions in the subscription
+    managers in *managers* that are stored in that database.
+
+    If *managers* is not given, all the subscription managers that
+    can be found from the root of the database, as
+    :class:`nti.webhooks.subscribers.ExhaustiveWebhookSubscriptionManagers`
+    finds them, are used. That can be very expensive in a large
+    database.
+
+    Returns the new :class:`InterestSummary`.
+    """
+    return _rebuild_interest_summary(conn, managers)[0]
+
+
+def _rebuild_interest_summary(conn, managers=None):
+    # Also returns the ids of the registries that were counted.
+    if managers is None:
+        from nti.webhooks.subscribers import find_managers_below
+        managers = [
+            manager
+            for value in conn.root().values()
+            for manager in find_managers_below(value)
+        ]
+    summary = InterestSummary()
+    seen = set()
+    for manager in managers:
+        registry = manager.registry
+        if id(registry) in seen or _registry_jar(registry, manager) is not conn:
+            continue
+        seen.add(id(registry))
+        _count_registry(summary, registry)
+    conn.root()[InterestSummary.ROOT_KEY] = summary
+    return summary, seen
+
+
+def _count_registry(summary, registry):
+    for registration in registry.registeredSubscriptionAdapters():
+        if registration.provided is not IWebhookSubscription:
+            continue
+        subscription = registration.factory
+        if subscription in _in_process:
+            # Now we know where it is.
+            _in_process.discard(subscription)
+            _process_interest.remove(registration.required)
+        summary.add(registration.required)
+
+
+def _reset():
+    global _process_interest # pylint:disable=global-statement
+    _process_interest = InterestSet()
+    _in_process.clear()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp # pylint:disable=ungrouped-imports
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(_reset)
@@ -136,6 +136,53 @@ class IWebhookDeliveryManagerShipmentInfo(Interface):
     """
 
 
+class IWebhookDeliveryOutbox(Interface):
+    """
+    Durable record of deliveries that have been committed but not yet
+    completed, so that they survive the process ending.
+
+    This is an optional utility. When it is registered, the data
+    manager records each transaction's pending persistent attempts
+    with it during two-phase commit, and the delivery manager reports
+    when their results have been recorded. Anything left over can be
+    delivered again with :meth:`recover`.
+
+    Delivery through an outbox is at-least-once.
+
+    .. versionadded:: 0.0.7
+    """
+
+    def record(subscriptions_and_attempts):
+        """
+        Durably record the persistent, pending *attempts* in the same
+        transaction that creates them.
+
+        Called while the transaction is committing; it must not be
+        the first change to any connection.
+
+        :return: An opaque object identifying the records, or None
+            if there was nothing to record. This is passed to :meth:`complete`.
+        """
+
+    def complete(keys):
+        """
+        The results of the attempts recorded under *keys* have
+        been stored; the records can be discarded.
+
+        This may be called from any thread, outside of a transaction.
+        """
+
+    def recover(db):
+        """
+        Find attempts recorded in *db* (and the databases it is
+        connected to) that are still pending and not being delivered
+        by anyone else, and deliver them using the
+        :class:`IWebhookDeliveryManager`.
+
+        :return: The number of attempts submitted for delivery.
+        """
+
+
 class IWebhookDestinationValidator(Interface):
     """
     Validates destinations.
@@ -225,6 +272,27 @@ class IWebhookDialect(Interface):
            It may not be possible to access attributes of persistent objects
         """
 
+
+class IWebhookEventCoalescingPolicy(Interface):
+    """
+    Decides which of the events fired for one object during one
+    transaction are delivered to a subscription.
+
+    These are registered as named utilities. A subscription or its
+    dialect selects one by name with its ``coalescing_policy``
+    attribute; see :mod:`nti.webhooks.coalescing`.
+    """
+
+    def coalesce(data, events):
+        """
+        Return the sequence of events to deliver for *data*.
+
+        *events* is a sequence of the distinct events, in the order
+        they were fired, that would each be delivered to the
+        subscription. The result may include events that are not in
+        *events*.
+        """
+
 class IWebhookDeliveryAttemptRequest(_ITimes):
     """
     The details about an HTTP request sent to a webhook.
@@ -377,6 +445,12 @@ class IWebhookDeliveryAttemptInternalInfo(_ITimes):
         "the instance has gone away."
     )
 
+    timeout_info = Attribute(
+        "If the attempt failed because a time limit was reached, "
+        "information about which one (``connect``, ``read``, ``total`` or "
+        "``deadline``) and its length in seconds. Otherwise, None."
+    )
+
 
 class IWebhookDeliveryAttempt(_ITimes, IContained):
     """
@@ -443,6 +517,16 @@ class IWebhookDeliveryAttemptSucceededEvent(IWebhookDeliveryAttemptResolvedEvent
     The ``succeeded`` attribute will be true.
     """
 
+class IWebhookDestinationCircuitChangedEvent(Interface):
+    """
+    The circuit breaker for a destination host changed state.
+
+    See :mod:`nti.webhooks.circuit_breaker`.
+    """
+    host = Attribute(u"The destination host, as a string such as ``example.com:8443``.")
+    old_state = Attribute(u"The previous state: 'closed', 'open' or 'half-open'.")
+    new_state = Attribute(u"The new state: 'closed', 'open' or 'half-open'.")
+
 
 
 class IWebhookSubscription(_ITimes, IContainerNamesContainer):
@@ -592,6 +676,17 @@ class ILimitedAttemptWebhookSubscription(IWebhookSubscription):
         u'failed.'
     )
 
+    def attemptCounts():
+        """
+        Return a dictionary mapping each delivery attempt status
+        (``'pending'``, ``'successful'`` and ``'failed'``) to the
+        number of stored delivery attempts that have it.
+
+        This doesn't need to load the attempts.
+
+        .. versionadded:: 0.0.7
+        """
+
 class ILimitedApplicabilityPreconditionFailureWebhookSubscription(IWebhookSubscription):
     """
     A webhook subscription that supports a limit on the number
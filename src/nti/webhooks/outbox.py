@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+A durable outbox of pending deliveries, stored in ZODB.
+
+This is optional. To use it, include ``outbox.zcml`` from this package::
+
+    <include package="nti.webhooks" file="outbox.zcml" />
+
+That registers :class:`DeliveryOutbox` as the
+:class:`nti.webhooks.interfaces.IWebhookDeliveryOutbox`, and a subscriber
+to recover unfinished deliveries each time a database is opened.
+
+Each transaction that creates persistent delivery attempts adds one
+entry (per database) to a BTree in the root of the database holding
+the subscriptions. The entry refers to the attempts. Once their
+results have been recorded, the entry is no longer needed; those
+entries are removed in batches, in the background. Recovery looks at
+the entries that remain, claims them in batches, and delivers the
+attempts that are still pending. Attempts that were already resolved
+(say, because the process ended before the entry was removed) are not
+delivered again.
+
+Entries younger than the recovery grace period may still be being
+delivered by another process, so recovery leaves them alone, and
+looks at them again once they are old enough.
+
+Only attempts for persistent subscriptions are recorded.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+import uuid
+from functools import partial
+from itertools import count
+
+from zope import component
+from zope import interface
+from zope.processlifetime import IDatabaseOpened
+
+from BTrees.OOBTree import OOBTree
+from ZODB.interfaces import IDatabase
+from ZODB.POSException import POSKeyError
+
+from nti.webhooks._delayed import DelayedCalls
+from nti.webhooks.delivery_manager import run_in_private_transaction
+from nti.webhooks.interfaces import IWebhookDeliveryManager
+from nti.webhooks.interfaces import IWebhookDeliveryOutbox
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IWebhookDeliveryOutbox)
+class DeliveryOutbox(object):
+    """
+    Default implementation of :class:`nti.webhooks.interfaces.IWebhookDeliveryOutbox`.
+
+    Entries are kept in an :class:`BTrees.OOBTree.OOBTree` stored in the
+    database root under :attr:`ROOT_KEY`. Keys are ``(time, token, counter)``
+    tuples, so they sort by creation time and don't collide between processes.
+    Values are ``(attempts, claimed_at)`` tuples.
+    """
+
+    ROOT_KEY = 'nti.webhooks.outbox'
+
+    #: Completed entries are removed once this many have accumulated...
+    completion_batch_size = 100
+
+    #: ... or when the oldest of them was completed at least this many
+    #: seconds ago.
+    completion_flush_interval = 5.0
+
+    #: The number of entries claimed in each recovery transaction.
+    claim_batch_size = 100
+
+    #: Seconds after which a claim made by recovery expires, and
+    #: the entry may be claimed again.
+    claim_timeout = 600
+
+    #: Entries newer than this many seconds are left alone by recovery;
+    #: they may still be being delivered by the process that created them.
+    #: If None, the delivery manager's ``shipment_deadline`` is used if
+    #: it has one, and otherwise :attr:`claim_timeout`. Setting this to
+    #: 0 is only safe if a single process uses the database.
+    recovery_grace = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._completed = []
+        self._first_completed_at = None
+        self._token = uuid.uuid4().hex
+        self._counter = count()
+        self._delayed_calls = DelayedCalls('WebhookOutboxRecovery')
+
+    def _recovery_grace(self, manager):
+        if self.recovery_grace is not None:
+            return self.recovery_grace
+        deadline = getattr(manager, 'shipment_deadline', None)
+        return deadline if deadline is not None else self.claim_timeout
+
+    def _entries(self, conn, create=False):
+        root = conn.root()
+        entries = root.get(self.ROOT_KEY)
+        if entries is None and create:
+            entries = root[self.ROOT_KEY] = OOBTree()
+        return entries
+
+    def record(self, subscriptions_and_attempts):
+        by_jar = {}
+        for subscription, attempt in subscriptions_and_attempts:
+            jar = getattr(subscription, '_p_jar', None)
+            if jar is None or not attempt.pending():
+                continue
+            by_jar.setdefault(jar, []).append(attempt)
+
+        now = time.time()
+        keys = []
+        for jar, attempts in by_jar.items():
+            key = (now, self._token, next(self._counter))
+            self._entries(jar, create=True)[key] = (tuple(attempts), None)
+            keys.append((jar.db().database_name, key))
+        return keys or None
+
+    def complete(self, keys):
+        now = time.time()
+        with self._lock:
+            self._completed.extend(keys)
+            if self._first_completed_at is None:
+                self._first_completed_at = now
+            flush = (
+                len(self._completed) >= self.completion_batch_size
+                or now - self._first_completed_at >= self.completion_flush_interval
+            )
+        if flush:
+            self.flush()
+
+    def flush(self, db=None):
+        """
+        Remove all completed entries now.
+        """
+        with self._lock:
+            completed, self._completed = self._completed, []
+            self._first_completed_at = None
+        if not completed:
+            return
+
+        def remove(conn):
+            for database_name, key in completed:
+                entries = self._entries(conn.get_connection(database_name))
+                if entries is not None:
+                    entries.pop(key, None)
+
+        try:
+            run_in_private_transaction(db or component.getUtility(IDatabase), remove)
+        except Exception: # pylint:disable=broad-except
+            # They'll be discarded by recovery.
+            logger.exception("Failed to remove %d completed outbox entries", len(completed))
+
+    def recover(self, db):
+        return self._recover(db, True)
+
+    def _recover(self, db, again):
+        # If *again* is true, and some entries were too new, recover
+        # once more when they are old enough. The entries left then
+        # were made after the first recovery, by running processes.
+        total = 0
+        manager = component.getUtility(IWebhookDeliveryManager)
+        grace = self._recovery_grace(manager)
+        cutoff = time.time() - grace
+        too_new = False
+        for database_name in sorted(db.databases):
+            after = None
+            while True:
+                shipment, after, attempt_count, newer = run_in_private_transaction(
+                    db,
+                    partial(self._claim, manager, database_name, cutoff, after))
+                too_new = too_new or newer
+                if shipment is not None:
+                    logger.info("Recovered %d pending delivery attempts from %s",
+                                attempt_count, database_name)
+                    manager.acceptForDelivery(shipment)
+                    total += attempt_count
+                if after is None:
+                    break
+        if again and too_new:
+            self._delayed_calls.call_later(grace, partial(self._recover, db, False))
+        return total
+
+    def stop(self):
+        """
+        Forget any recovery waiting for entries to be old enough.
+        """
+        self._delayed_calls.stop()
+        self._delayed_calls = DelayedCalls('WebhookOutboxRecovery')
+
+    @staticmethod
+    def _pending(attempt):
+        try:
+            return attempt.pending()
+        except POSKeyError:
+            return False
+
+    def _claim(self, manager, database_name, cutoff, after, conn):
+        """
+        Look at up to :attr:`claim_batch_size` entries made before the
+        time *cutoff*, with keys greater than *after*, and claim those
+        that need it.
+
+        Returns a shipment for their pending attempts, the key to
+        continue after (or None if all entries have been seen), the
+        number of attempts in the shipment, and whether there are
+        entries made after *cutoff*.
+        """
+        entries = self._entries(conn.get_connection(database_name))
+        if not entries:
+            return None, None, 0, False
+
+        now = time.time()
+        bounds = {'max': (cutoff,)}
+        if after is not None:
+            bounds['min'] = after
+            bounds['excludemin'] = True
+
+        claimed = []
+        finished = []
+        pairs = []
+        last = None
+        exhausted = True
+        scanned = 0
+        for key, (attempts, claimed_at) in entries.items(**bounds):
+            if scanned >= self.claim_batch_size:
+                exhausted = False
+                break
+            scanned += 1
+            last = key
+            if claimed_at is not None and now - claimed_at < self.claim_timeout:
+                continue
+            pending = [attempt for attempt in attempts if self._pending(attempt)]
+            if pending:
+                claimed.append((key, attempts))
+                pairs.extend((attempt.__parent__, attempt) for attempt in pending)
+            else:
+                finished.append(key)
+
+        newer = exhausted and entries.maxKey() > (cutoff,)
+        for key in finished:
+            del entries[key]
+        for key, attempts in claimed:
+            entries[key] = (attempts, now)
+
+        shipment = None
+        if pairs:
+            shipment = manager.createShipmentInfo(pairs)
+            shipment.outbox_keys = [(database_name, key) for key, _ in claimed]
+        return shipment, None if exhausted else last, len(pairs), newer
+
+
+@component.adapter(IDatabaseOpened)
+def recover_outbox_on_open(event):
+    outbox = component.queryUtility(IWebhookDeliveryOutbox)
+    if outbox is not None:
+        outbox.recover(event.database)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Storing each payload once, no matter how many attempts deliver it.
+
+When one event is delivered to many persistent subscriptions, each
+delivery attempt would otherwise keep its own copy of the payload,
+and its request would keep another once it was sent. Instead,
+payloads of at least :attr:`PayloadStore.min_size` characters are
+kept in a :class:`SharedPayload`, found by the SHA-256 digest of its
+text in the :class:`PayloadStore` in the root of the subscription's
+database. Attempts and their requests refer to that object; reading
+their ``payload_data`` or ``body`` gives its text.
+
+Each shared payload counts the attempts using it (with a
+:class:`BTrees.Length.Length`, so concurrent transactions don't
+conflict over the count). When an attempt is removed from its
+subscription, the count goes down, and at zero the payload is removed
+from the store. Concurrent removals can leave payloads in the store
+that nothing uses; :meth:`PayloadStore.sweep` removes them.
+
+Small payloads, and payloads of attempts that aren't stored in a
+database, are kept on the attempt as before.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+
+from persistent import Persistent
+from persistent.interfaces import IPersistent
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from zope import component
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
+from nti.webhooks.interfaces import IWebhookDeliveryAttempt
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def payload_digest(text):
+    """
+    Return the key of the payload *text* in a :class:`PayloadStore`.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class SharedPayload(Persistent):
+    """
+    A payload used by one or more delivery attempts.
+    """
+
+    __parent__ = None
+
+    def __init__(self, digest, data):
+        self.digest = digest
+        #: The text of the payload.
+        self.data = data
+        self._references = Length(0)
+
+    @property
+    def references(self):
+        """The number of attempts using this payload."""
+        return self._references()
+
+
+class PayloadStore(Persistent):
+    """
+    The shared payloads of a database.
+    """
+
+    #: Where the store is kept in the root of the database.
+    ROOT_KEY = 'nti.webhooks.payload_store'
+
+    #: Payloads shorter than this many characters aren't shared.
+    min_size = 256
+
+    def __init__(self):
+        self._payloads = OOBTree()
+
+    @classmethod
+    def find(cls, jar, create=False):
+        """
+        Return the store for the database of the connection *jar*,
+        creating it if needed and *create* is true; otherwise None.
+        """
+        root = jar.root()
+        store = root.get(cls.ROOT_KEY)
+        if store is None and create:
+            store = root[cls.ROOT_KEY] = cls()
+        return store
+
+    def share(self, text):
+        """
+        Return the :class:`SharedPayload` holding *text*, counting
+        one more attempt using it.
+        """
+        digest = payload_digest(text)
+        payload = self._payloads.get(digest)
+        if payload is None:
+            payload = self._payloads[digest] = SharedPayload(digest, text)
+            payload.__parent__ = self
+        payload._references.change(1) # pylint:disable=protected-access
+        return payload
+
+    def release(self, payload):
+        """
+        Count one less attempt using the :class:`SharedPayload`
+        *payload*, removing it when no attempts use it.
+        """
+        payload._references.change(-1) # pylint:disable=protected-access
+        if payload.references <= 0 and self._payloads.get(payload.digest) is payload:
+            del self._payloads[payload.digest]
+
+    def sweep(self):
+        """
+        Remove payloads that no attempt uses. Returns how many were removed.
+        """
+        unused = [digest for digest, payload in self._payloads.items()
+                  if payload.references <= 0]
+        for digest in unused:
+            del self._payloads[digest]
+        return len(unused)
+
+    def __len__(self):
+        return len(self._payloads)
+
+
+def share_payload(subscription, text):
+    """
+    Return what a delivery attempt of *subscription* should store
+    for the payload *text*: either *text* itself or a
+    :class:`SharedPayload` holding it.
+    """
+    jar = getattr(subscription, '_p_jar', None)
+    if jar is None or text is None or len(text) < PayloadStore.min_size:
+        return text
+    return PayloadStore.find(jar, create=True).share(text)
+
+
+class SharedTextProperty(object):
+    """
+    A data descriptor for text that may be kept in a :class:`SharedPayload`.
+
+    Setting a :class:`SharedPayload` stores a reference to it; setting
+    anything else stores that value, through *field_property*, if
+    given. Getting always returns the text.
+
+    If *field* is given, the text of a :class:`SharedPayload` is
+    validated against it before the reference is stored, just as
+    *field_property* validates anything else.
+    """
+
+    def __init__(self, name, field_property=None, field=None):
+        self._name = name
+        self._field_property = field_property
+        self._field = field
+
+    @staticmethod
+    def _dict(inst):
+        # Access to __dict__ doesn't unghostify.
+        if IPersistent.providedBy(inst):
+            inst._p_activate() # pylint:disable=protected-access
+        return inst.__dict__
+
+    def shared(self, inst):
+        """
+        Return the :class:`SharedPayload` stored in *inst*, or None.
+        """
+        value = self._dict(inst).get(self._name)
+        return value if isinstance(value, SharedPayload) else None
+
+    def __get__(self, inst, klass):
+        if inst is None:
+            return self
+        value = self._dict(inst).get(self._name)
+        if isinstance(value, SharedPayload):
+            return value.data
+        if self._field_property is not None:
+            return self._field_property.__get__(inst, klass)
+        return value
+
+    def __set__(self, inst, value):
+        if not isinstance(value, SharedPayload) and self._field_property is not None:
+            self._field_property.__set__(inst, value)
+            return
+        if isinstance(value, SharedPayload) and self._field is not None:
+            self._field.bind(inst).validate(value.data)
+        self._dict(inst)[self._name] = value
+        if IPersistent.providedBy(inst):
+            inst._p_changed = True # pylint:disable=protected-access
+
+
+def stored_shared_payload(inst, name='payload_data'):
+    """
+    Return the :class:`SharedPayload` stored in the attribute *name*
+    of *inst*, or None if there isn't one.
+    """
+    descriptor = getattr(type(inst), name, None)
+    if isinstance(descriptor, SharedTextProperty):
+        return descriptor.shared(inst)
+    return None
+
+
+@component.adapter(IWebhookDeliveryAttempt, IObjectRemovedEvent)
+def release_payload_when_removed(attempt, _event):
+    payload = stored_shared_payload(attempt)
+    if payload is not None and payload.__parent__ is not None:
+        payload.__parent__.release(payload)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Pruning old delivery attempts.
+
+Subscriptions only keep about
+:attr:`~nti.webhooks.interfaces.ILimitedAttemptWebhookSubscription.attempt_limit`
+delivery attempts. When an attempt is resolved and the subscription
+holds more than that, the oldest resolved attempts are removed.
+Subscriptions keep the keys of their resolved attempts in a sorted
+index, so finding the oldest doesn't load any other attempt.
+
+Normally that happens in the transaction that resolved the attempt.
+A persistent subscription whose ``prune_in_background`` attribute is
+true is instead remembered once that transaction commits, and pruned
+in its own transaction by a background thread started by
+:class:`PruningSweeper`, keeping the transactions that record delivery
+results small. Which subscriptions need pruning is only kept in
+memory; if the process ends first, they will be pruned after their
+next attempt is resolved.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+from functools import partial
+
+from zope import component
+
+from ZODB.interfaces import IDatabase
+from ZODB.POSException import POSKeyError
+
+from nti.webhooks.delivery_manager import run_in_private_transaction
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def prune_subscription(subscription):
+    """
+    Remove the oldest resolved delivery attempts from *subscription*
+    until it holds no more than its ``attempt_limit``, or only pending
+    attempts are left.
+
+    Returns the number of attempts removed.
+    """
+    resolved = subscription._resolvedAttemptKeys() # pylint:disable=protected-access
+    count = 0
+    while len(subscription) > subscription.attempt_limit and resolved:
+        key = resolved.minKey()
+        try:
+            del subscription[key]
+        except KeyError:
+            # Not actually there. Don't look for it again.
+            resolved.remove(key)
+            continue
+        count += 1
+    logger.debug(
+        "Pruned %d old delivery attempts from subscription %s",
+        count, subscription
+    )
+    return count
+
+
+class PruningSweeper(object):
+    """
+    Remembers persistent subscriptions that need pruning, and prunes
+    them in the background.
+    """
+
+    #: How often, in seconds, the background thread prunes the
+    #: subscriptions it has been given.
+    tick_interval = 30.0
+
+    #: The most subscriptions pruned in a single transaction.
+    batch_size = 20
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = None
+        # {(database_name, oid)}
+        self._due = set()
+
+    def schedule(self, subscription):
+        """
+        Prune the persistent *subscription* in the background, if the
+        current transaction of its connection commits.
+        """
+        jar = subscription._p_jar # pylint:disable=protected-access
+        key = (jar.db().database_name, subscription._p_oid) # pylint:disable=protected-access
+        jar.transaction_manager.get().addAfterCommitHook(self._committed, (key,))
+
+    def _committed(self, success, key):
+        if not success:
+            return
+        with self._lock:
+            self._due.add(key)
+        self.start()
+
+    def tick(self, db=None):
+        """
+        Prune the subscriptions in *db* (and the databases it is
+        connected to) that need it now.
+
+        Returns the number of delivery attempts removed.
+        """
+        db = db or component.getUtility(IDatabase)
+        with self._lock:
+            due = sorted(key for key in self._due if key[0] in db.databases)
+            self._due.difference_update(due)
+        total = 0
+        for start in range(0, len(due), self.batch_size):
+            total += run_in_private_transaction(
+                db,
+                partial(self._prune, due[start:start + self.batch_size]))
+        return total
+
+    @staticmethod
+    def _prune(keys, conn):
+        total = 0
+        for database_name, oid in keys:
+            try:
+                subscription = conn.get_connection(database_name).get(oid)
+            except POSKeyError:
+                # It's gone.
+                continue
+            total += prune_subscription(subscription)
+        return total
+
+    def pending_count(self):
+        """
+        The number of subscriptions waiting to be pruned.
+        """
+        with self._lock:
+            return len(self._due)
+
+    def start(self):
+        """
+        Start the background thread, if it isn't running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._stopped,),
+                                            name='WebhookPruningSweeper')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, if it's running.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stopped.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self, stopped):
+        while not stopped.wait(self.tick_interval):
+            try:
+                self.tick()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to prune webhook subscriptions")
+
+    def _reset(self):
+        self.stop()
+        with self._lock:
+            self._due.clear()
+
+
+global_pruning_sweeper = PruningSweeper()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp # pylint:disable=ungrouped-imports
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(global_pruning_sweeper._reset) # pylint:disable=protected-access
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Pacing deliveries with token buckets.
+
+A single transaction can produce thousands of delivery attempts for the
+same receiver. To avoid overwhelming it, the delivery manager asks a
+:class:`DestinationRateLimiter` before sending each attempt. The limits
+come from the attempt's dialect (see
+:attr:`nti.webhooks.dialect.DefaultWebhookDialect.rate_limit` and
+:attr:`~nti.webhooks.dialect.DefaultWebhookDialect.subscription_rate_limit`,
+which can also be set in ZCML); a limit of None or 0 means no limit.
+
+Each destination host, and each subscription, that has a limit gets a
+token bucket holding up to *burst* tokens, refilled at *rate* tokens
+per second. Buckets are kept for each distinct *rate* and *burst*: if
+dialects with different limits deliver to the same host, each limit
+is enforced on its own deliveries, without disturbing the others. Sending takes a token from each bucket that applies. When
+one of them is empty, nothing is taken; instead, the delivery manager
+sets the rest of the work unit aside and submits it again once there
+should be a token for it. No thread waits. (Like other deferred work,
+the attempts set aside are only kept in memory.)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    A bucket of up to *capacity* tokens, refilled at *rate* tokens
+    per second. It starts full.
+    """
+
+    __slots__ = (
+        'rate',
+        'capacity',
+        'tokens',
+        'updated',
+    )
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Return how many seconds until a token is available; 0 if
+        one is available now.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class DestinationRateLimiter(object):
+    """
+    The token buckets for destination hosts and subscriptions.
+
+    This object is thread-safe.
+    """
+
+    #: When there are more buckets than this, those that are full
+    #: (and so behave just like a new bucket) are forgotten.
+    max_buckets = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {key: TokenBucket}
+        self._buckets = {}
+        #: The number of times a send was throttled.
+        self.throttled_count = 0
+
+    def acquire(self, host, subscription_key, dialect):
+        """
+        Take the tokens needed to send a request to *host* for
+        the subscription identified by the hashable *subscription_key*,
+        using the limits of *dialect*.
+
+        Returns 0 if the request may be sent now. Otherwise,
+        no tokens are taken, and this returns how many seconds
+        to wait before asking again.
+        """
+        limits = []
+        host_rate = getattr(dialect, 'rate_limit', None)
+        if host_rate:
+            limits.append((('host', host),
+                           host_rate,
+                           getattr(dialect, 'rate_limit_burst', None)))
+        subscription_rate = getattr(dialect, 'subscription_rate_limit', None)
+        if subscription_rate:
+            limits.append((('subscription', subscription_key),
+                           subscription_rate,
+                           getattr(dialect, 'subscription_rate_limit_burst', None)))
+        if not limits:
+            return 0
+
+        now = time.time()
+        with self._lock:
+            buckets = [self._bucket(key, rate, burst, now) for key, rate, burst in limits]
+            wait = max(bucket.wait_time(now) for bucket in buckets)
+            if wait:
+                self.throttled_count += 1
+                return wait
+            for bucket in buckets:
+                bucket.take()
+        return 0
+
+    def _bucket(self, key, rate, burst, now):
+        capacity = burst or max(1, rate)
+        key += (rate, capacity)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._forget_full(now)
+            bucket = self._buckets[key] = TokenBucket(rate, capacity, now)
+        return bucket
+
+    def _forget_full(self, now):
+        for key, bucket in list(self._buckets.items()):
+            if bucket.full(now):
+                del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Retrying failed deliveries.
+
+A failed delivery attempt is never changed. Instead, if the
+subscription allows retries (see the ``retry_`` settings of
+:class:`nti.webhooks.dialect.DefaultWebhookDialect`, which a
+subscription may override), a retry is scheduled for some time in the
+future. When it comes due, a new delivery attempt with the same
+payload is created in the subscription and delivered, and so on until
+an attempt succeeds or the limit is reached.
+
+The wait before each retry grows exponentially, and is partly random so
+that many failures at once don't all retry at once.
+
+Only persistent subscriptions are retried. Scheduled retries are
+kept in a BTree in the root of the database holding the subscription,
+ordered by the time they are due, so finding them doesn't require looking
+at any subscription. A background thread started by
+:class:`RetryScheduler` periodically delivers the retries that are due,
+in a small number of shipments.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+import threading
+import time
+import uuid
+from functools import partial
+from itertools import count
+from itertools import islice
+
+from zope import component
+from zope.processlifetime import IDatabaseOpenedWithRoot
+
+from BTrees.OOBTree import OOBTree
+from ZODB.interfaces import IDatabase
+
+from nti.webhooks.delivery_manager import run_in_private_transaction
+from nti.webhooks.interfaces import IWebhookDeliveryAttemptFailedEvent
+from nti.webhooks.interfaces import IWebhookDeliveryManager
+from nti.webhooks.interfaces import IWebhookDeliveryOutbox
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Client errors that may go away if we try again. Other 4xx
+#: responses are not retried.
+RETRYABLE_CLIENT_ERRORS = frozenset((408, 425, 429))
+
+
+def retry_setting(subscription, name):
+    """
+    Return the retry setting *name* of *subscription*, or of its
+    dialect if the subscription doesn't override it.
+    """
+    value = getattr(subscription, name, None)
+    if value is None:
+        value = getattr(subscription.dialect, name)
+    return value
+
+
+def compute_retry_delay(retry_number, initial_delay, multiplier, max_delay, jitter,
+                        _random=random.random):
+    """
+    Return the number of seconds to wait before retry number
+    *retry_number* (starting from 0).
+
+    This is exponential backoff with a random fraction (*jitter*) taken
+    away.
+    """
+    delay = min(max_delay, initial_delay * multiplier ** retry_number)
+    return delay * (1.0 - jitter * _random())
+
+
+def is_retryable(attempt):
+    """
+    Is the failure of *attempt* one that may succeed if tried again?
+    """
+    status_code = attempt.response.status_code if attempt.response is not None else None
+    if status_code is not None and 400 <= status_code < 500:
+        return status_code in RETRYABLE_CLIENT_ERRORS
+    return True
+
+
+class RetryScheduler(object):
+    """
+    Keeps the index of scheduled retries and delivers them
+    when they are due.
+    """
+
+    ROOT_KEY = 'nti.webhooks.retries'
+
+    #: How often, in seconds, the background thread looks for
+    #: retries that are due.
+    tick_interval = 5.0
+
+    #: The most retries delivered in a single shipment.
+    batch_size = 100
+
+    #: The most shipments delivered for each database in each tick.
+    #: Anything more waits for the next tick.
+    batches_per_tick = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = None
+        self._token = uuid.uuid4().hex
+        self._counter = count()
+
+    def _index(self, conn, create=False):
+        root = conn.root()
+        index = root.get(self.ROOT_KEY)
+        if index is None and create:
+            index = root[self.ROOT_KEY] = OOBTree()
+        return index
+
+    def schedule(self, attempt, due):
+        """
+        Record that the failed *attempt*, which must belong to a persistent
+        subscription, should be retried at the time *due*.
+
+        This must be called in the transaction that marked it as failed.
+        """
+        jar = attempt.__parent__._p_jar
+        key = (due, self._token, next(self._counter))
+        self._index(jar, create=True)[key] = attempt
+        self.start()
+        return key
+
+    def tick(self, db=None, now=None):
+        """
+        Deliver retries that are due now.
+
+        Returns the number of delivery attempts created.
+        """
+        db = db or component.getUtility(IDatabase)
+        now = now if now is not None else time.time()
+        manager = component.getUtility(IWebhookDeliveryManager)
+        total = 0
+        for database_name in sorted(db.databases):
+            for _ in range(self.batches_per_tick):
+                shipment, attempt_count, more = run_in_private_transaction(
+                    db,
+                    partial(self._claim_due, manager, database_name, now))
+                if shipment is not None:
+                    manager.acceptForDelivery(shipment)
+                    total += attempt_count
+                if not more:
+                    break
+        return total
+
+    def _claim_due(self, manager, database_name, now, conn):
+        index = self._index(conn.get_connection(database_name))
+        if not index:
+            return None, 0, False
+
+        due = list(islice(index.items(max=(now,)), self.batch_size + 1))
+        more = len(due) > self.batch_size
+        pairs = []
+        for key, failed in due[:self.batch_size]:
+            del index[key]
+            subscription = failed.__parent__
+            if subscription is None or not subscription.active:
+                continue
+            retry = subscription.createDeliveryAttempt(failed.payload_data)
+            retry.retry_number = failed.retry_number + 1
+            if failed.payload_reference is not None:
+                # It failed before its payload was rendered.
+                retry.payload_reference = failed.payload_reference
+            if retry._p_jar is None:
+                # The shipment needs its OID now, not when we commit.
+                subscription._p_jar.add(retry)
+            if retry.pending():
+                pairs.append((subscription, retry))
+
+        if not pairs:
+            return None, 0, more
+
+        shipment = manager.createShipmentInfo(pairs)
+        outbox = component.queryUtility(IWebhookDeliveryOutbox)
+        if outbox is not None:
+            shipment.outbox_keys = outbox.record(pairs)
+        return shipment, len(pairs), more
+
+    def pending_count(self, db):
+        """
+        The number of retries scheduled in *db* and the databases
+        it is connected to.
+        """
+        def count_them(conn):
+            return sum(
+                len(self._index(conn.get_connection(name)) or ())
+                for name in db.databases
+            )
+        return run_in_private_transaction(db, count_them)
+
+    def start(self):
+        """
+        Start the background thread, if it isn't running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._stopped,),
+                                            name='WebhookRetryScheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, if it's running.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stopped.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self, stopped):
+        while not stopped.wait(self.tick_interval):
+            try:
+                self.tick()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to deliver webhook retries")
+
+
+global_retry_scheduler = RetryScheduler()
+
+
+@component.adapter(IWebhookDeliveryAttemptFailedEvent)
+def schedule_retry_when_failed(event):
+    attempt = event.object
+    subscription = attempt.__parent__
+    if getattr(subscription, '_p_jar', None) is None or not subscription.active:
+        return
+    if attempt.retry_number >= retry_setting(subscription, 'retry_limit'):
+        return
+    if not is_retryable(attempt):
+        return
+
+    delay = compute_retry_delay(
+        attempt.retry_number,
+        retry_setting(subscription, 'retry_initial_delay'),
+        retry_setting(subscription, 'retry_backoff_multiplier'),
+        retry_setting(subscription, 'retry_max_delay'),
+        retry_setting(subscription, 'retry_jitter'),
+    )
+    global_retry_scheduler.schedule(attempt, time.time() + delay)
+
+
+@component.adapter(IDatabaseOpenedWithRoot)
+def start_retries_when_opened(event):
+    # Pick up retries scheduled by earlier processes.
+    if global_retry_scheduler.pending_count(event.database):
+        global_retry_scheduler.start()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp # pylint:disable=ungrouped-imports
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(global_retry_scheduler.stop)
@@ -10,8 +10,14 @@ __all__ = (
     'dispatch_webhook_event',
     'remove_subscriptions_for_principal',
     'ExhaustiveWebhookSubscriptionManagers',
+    'SubscriptionManagerCache',
+    'find_managers_below',
+    'subscription_manager_cache',
 )
 
+import threading
+import weakref
+from collections import OrderedDict
 from itertools import chain
 
 import transaction
@@ -31,37 +37,166 @@ from nti.webhooks.interfaces import IWebhookSubscription
 from nti.webhooks.interfaces import IWebhookSubscriptionSecuritySetter
 from nti.webhooks.interfaces import IWebhookPrincipal
 
+from nti.webhooks._util import utility_registries_unchanged
+from nti.webhooks._util import utility_registry_generations
 from nti.webhooks.datamanager import WebhookDataManager
+from nti.webhooks.interest import may_be_interested
+from nti.webhooks.subscriptions import remember_security_decisions
+from nti.webhooks.subscriptions import security_lookup_cache
 
-def _utilities_up_tree(data):
+def _utilities_up_tree(data, contexts=None):
     context = data
     while context is not None:
+        if contexts is not None:
+            contexts.append(context)
         manager = component.queryNextUtility(context, IWebhookSubscriptionManager)
         context = manager
         if manager is not None:
             yield '<NA>', manager
 
 
-def _find_subscription_managers(data, seen_managers=None):
-    """
-    Iterable across subscription managers.
-    """
+def _discover_subscription_managers(data, contexts):
     # What's the practical difference using ``getUtilitiesFor`` and manually walking
     # through the tree using ``getNextUtility``? The first makes a single call to the adapter
     # registry and uses its own ``.ro`` to walk up and find utilities. The second uses
     # the ``__bases__`` of the site manager itself to walk up and find only the next utility.
     # We want to find both. See ``removing_subscriptions.rst`` for an example that
     # fails if we just use ``getUtilitiesFor``.
-    seen_managers = set() if seen_managers is None else seen_managers
-
     utilities_in_current_site = component.getUtilitiesFor(IWebhookSubscriptionManager)
     utilities_in_data_site = component.getUtilitiesFor(IWebhookSubscriptionManager, data)
-    utilities_up_tree = _utilities_up_tree(data)
+    utilities_up_tree = _utilities_up_tree(data, contexts)
     it = chain(utilities_in_current_site,
                utilities_in_data_site,
                utilities_up_tree)
 
+    managers = []
+    seen = set()
     for _name, sub_manager in it:
+        if sub_manager in seen:
+            continue
+        seen.add(sub_manager)
+        managers.append(sub_manager)
+    return managers
+
+
+class _CachedManagers(object):
+
+    __slots__ = (
+        'current_site_manager',
+        'data_site_manager',
+        'generations',
+        'managers',
+    )
+
+    def __init__(self, current_site_manager, data_site_manager, site_managers, managers):
+        self.current_site_manager = weakref.ref(current_site_manager)
+        self.data_site_manager = weakref.ref(data_site_manager)
+        self.generations = utility_registry_generations(site_managers)
+        self.managers = [weakref.ref(manager) for manager in managers]
+
+    def get(self, current_site_manager, data_site_manager):
+        """
+        Return the managers if they're still current, otherwise None.
+        """
+        if self.current_site_manager() is not current_site_manager \
+           or self.data_site_manager() is not data_site_manager:
+            return None
+        if not utility_registries_unchanged(self.generations):
+            return None
+        managers = [ref() for ref in self.managers]
+        if None in managers:
+            return None
+        return managers
+
+
+class SubscriptionManagerCache(object):
+    """
+    Remembers the subscription managers found for events, for each
+    combination of the current site manager and the site manager of
+    the data.
+
+    Finding them means looking up utilities in both site managers,
+    and then walking up the tree of site managers one utility at a
+    time, which can be the most expensive part of dispatching an
+    event in a deep hierarchy of sites. The result only depends on
+    the utilities registered in those site managers and their bases,
+    so it's kept until any of them change (registering or
+    unregistering a utility, or changing ``__bases__``, changes the
+    generation of a registry).
+
+    No more than :attr:`max_entries` are kept; the least recently used
+    are forgotten first. Entries don't keep site managers or
+    subscription managers alive.
+    """
+
+    #: The most combinations of site managers to remember.
+    max_entries = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(id(current site manager), id(data site manager)): _CachedManagers}
+        self._entries = OrderedDict()
+        #: The number of times the managers were found in the cache.
+        self.hits = 0
+        #: The number of times the managers had to be looked up.
+        self.misses = 0
+
+    def find(self, data):
+        """
+        Return the list of subscription managers for *data* in the
+        current site.
+        """
+        current_site_manager = component.getSiteManager()
+        data_site_manager = component.getSiteManager(data)
+        key = (id(current_site_manager), id(data_site_manager))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+        managers = None
+        if entry is not None:
+            managers = entry.get(current_site_manager, data_site_manager)
+        if managers is not None:
+            with self._lock:
+                self.hits += 1
+            return managers
+
+        contexts = []
+        managers = _discover_subscription_managers(data, contexts)
+        site_managers = [current_site_manager, data_site_manager]
+        site_managers.extend(component.getSiteManager(context) for context in contexts[1:])
+        try:
+            entry = _CachedManagers(current_site_manager, data_site_manager,
+                                    site_managers, managers)
+        except (AttributeError, TypeError):
+            # Not a registry we know how to watch, or can't be
+            # weakly referenced.
+            entry = None
+        with self._lock:
+            self.misses += 1
+            if entry is not None:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return managers
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+#: The cache used by :func:`dispatch_webhook_event` and the other
+#: subscribers in this module.
+subscription_manager_cache = SubscriptionManagerCache()
+
+
+def _find_subscription_managers(data, seen_managers=None):
+    """
+    Iterable across subscription managers.
+    """
+    seen_managers = set() if seen_managers is None else seen_managers
+    for sub_manager in subscription_manager_cache.find(data):
         if sub_manager in seen_managers:
             # De-dup.
             continue
@@ -114,6 +249,10 @@ def dispatch_webhook_event(data, event):
         - Determines if any of those actually apply to the *data*, and
           if so, joins the transaction to prepare for sending them.
 
+    Before any of that, events that no active subscription could
+    apply to are rejected using the summaries described in
+    :mod:`nti.webhooks.interest`.
+
     .. important::
 
        Checking whether a subscription is :term:`applicable`
@@ -131,7 +270,12 @@ def dispatch_webhook_event(data, event):
         manager, this won't work.
     """
     # TODO: I think we could actually find a different transaction manager if we needed to.
-    subscriptions = find_applicable_subscriptions_for(data, event)
+    if not may_be_interested(data, event):
+        # No active subscription anywhere could apply.
+        return
+    # Security decisions are remembered in the transaction we would join.
+    with remember_security_decisions(transaction.manager.get()):
+        subscriptions = find_applicable_subscriptions_for(data, event)
     if subscriptions:
         # TODO: Choosing which datamanager resource to use might
         # be a good extension point.
@@ -226,6 +370,8 @@ def remove_subscriptions_for_principal(principal, event):
     for manager in chain(*manager_iters):
         manager.deleteSubscriptionsForPrincipal(prin_id)
 
+    security_lookup_cache.invalidate(prin_id)
+
 
 @interface.implementer(IWebhookSubscriptionManagers)
 class ExhaustiveWebhookSubscriptionManagers(object):
@@ -252,20 +398,33 @@ class ExhaustiveWebhookSubscriptionManagers(object):
         for m in _find_subscription_managers(self.context, seen):
             yield m
 
-        for m in self._find_recur(self.root, seen):
+        for m in find_managers_below(self.root):
             yield m
 
-    def _find_recur(self, root, seen):
-        # This could be better if we memorized the utilities earlier,
-        # and applied that to _utilities_up_tree. As it is, this is something like
-        # O(n^2)
-        if IWebhookSubscriptionManager.providedBy(root):
-            yield root
 
-        subs = ISublocations(root, None)
-        if subs is None:
-            return
+def find_managers_below(root):
+    """
+    Iterate the subscription managers that are *root* or can be found
+    below it by adapting to :class:`zope.location.interfaces.ISublocations`.
+    """
+    # This could be better if we memorized the utilities earlier,
+    # and applied that to _utilities_up_tree. As it is, this is something like
+    # O(n^2)
+    if IWebhookSubscriptionManager.providedBy(root):
+        yield root
+
+    subs = ISublocations(root, None)
+    if subs is None:
+        return
+
+    for sub in subs.sublocations(): # pylint:disable=too-many-function-args
+        for m in find_managers_below(sub):
+            yield m
+
 
-        for sub in subs.sublocations(): # pylint:disable=too-many-function-args
-            for m in self._find_recur(sub, seen):
-                yield m
+try:
+    from zope.testing.cleanup import addCleanUp # pylint:disable=ungrouped-imports
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(subscription_manager_cache.clear)
@@ -8,7 +8,14 @@ from __future__ import division
 from __future__ import print_function
 
 import sys
+import threading
 import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOTreeSet
 
 from zope import component
 from zope.event import notify
@@ -51,6 +58,7 @@ from nti.schema.schema import SchemaConfigured
 from nti.webhooks import MessageFactory as _
 
 from nti.webhooks.interfaces import IWebhookDialect
+from nti.webhooks.interfaces import IWebhookDeliveryAttempt
 from nti.webhooks.interfaces import IWebhookSubscription
 from nti.webhooks.interfaces import ILimitedAttemptWebhookSubscription
 from nti.webhooks.interfaces import ILimitedApplicabilityPreconditionFailureWebhookSubscription
@@ -62,11 +70,18 @@ from nti.webhooks.interfaces import IWebhookSubscriptionApplicabilityPreconditio
 from nti.webhooks.interfaces import WebhookSubscriptionApplicabilityPreconditionFailureLimitReached
 
 from nti.webhooks.attempts import WebhookDeliveryAttempt
+from nti.webhooks.circuit_breaker import failed_while_open
+from nti.webhooks.destination_validator import VALIDATION_FAILED_MESSAGE
+from nti.webhooks.payload_store import share_payload
+from nti.webhooks.pruning import global_pruning_sweeper
+from nti.webhooks.pruning import prune_subscription
 from nti.webhooks.attempts import PersistentWebhookDeliveryAttempt
 
 from nti.webhooks._util import DCTimesMixin
 from nti.webhooks._util import PersistentDCTimesMixin
 from nti.webhooks._util import describe_class_or_specification
+from nti.webhooks._util import utility_registries_unchanged
+from nti.webhooks._util import utility_registry_generations
 
 from persistent import Persistent
 
@@ -96,6 +111,34 @@ class _CheckObjectOnSetSampleContainer(SampleContainer):
         return family64.OO.BTree()
 
 
+def _new_attempt_counts():
+    # Each counter is its own persistent object, and resolves
+    # conflicting changes to it.
+    return {
+        term.value: Length()
+        for term in IWebhookDeliveryAttempt['status'].vocabulary
+    }
+
+
+class _AttemptTrackingContainer(object):
+    """
+    Keeps the counts of :meth:`AbstractSubscription.attemptCounts`,
+    and the index of resolved attempts, current as attempts are added
+    and removed.
+
+    This must come before the container in the bases.
+    """
+
+    def __setitem__(self, key, attempt):
+        super(_AttemptTrackingContainer, self).__setitem__(key, attempt)
+        self._attemptAdded(key, attempt)
+
+    def __delitem__(self, key):
+        attempt = self[key]
+        super(_AttemptTrackingContainer, self).__delitem__(key)
+        self._attemptRemoved(key, attempt)
+
+
 class IApplicableSubscriptionFactory(Interface): # pylint:disable=inherit-non-class
     """
     A private contract between the Subscription and its SubscriptionManager.
@@ -135,8 +178,51 @@ class AbstractSubscription(SchemaConfigured):
     applicable_precondition_failure_limit = 50
     fallback_to_unauthenticated_principal = True
 
+    # Retry settings. None means to use the value from the dialect.
+    # See nti.webhooks.retries.
+    retry_limit = None
+    retry_initial_delay = None
+    retry_backoff_multiplier = None
+    retry_max_delay = None
+    retry_jitter = None
+
+    # The name of the event coalescing policy. None means to use
+    # the one from the dialect. See nti.webhooks.coalescing.
+    coalescing_policy = None
+
+    # Failure ratio settings. None means to use the value from the
+    # dialect. See nti.webhooks.failure_window.
+    failure_ratio_limit = None
+    failure_window_size = None
+    failure_window_seconds = None
+    failure_window_minimum = None
+
+    # The nti.webhooks.failure_window.FailureWindow of recent delivery
+    # results, once there is one.
+    _failure_window = None
+
+    # {status: Length} counting the stored attempts, so we don't have to
+    # load them to find out. Subscriptions stored before this existed
+    # count them when read, without storing anything, until an attempt
+    # is added, removed or changes status; then they are counted once
+    # and kept from then on.
+    _attempt_counts = None
+
+    # The keys of the resolved attempts. Keys sort in the order attempts
+    # were added, so pruning can find the oldest without loading any
+    # others. Built the first time it's needed.
+    _resolved_attempt_keys = None
+
+    #: If true, a persistent subscription with too many attempts is
+    #: pruned in the background, soon after the transaction that
+    #: resolved an attempt commits, instead of during that transaction.
+    #: See :mod:`nti.webhooks.pruning`.
+    prune_in_background = False
+
     def __init__(self, **kwargs):
         self.createdTime = self.lastModified = time.time()
+        self._attempt_counts = _new_attempt_counts()
+        self._resolved_attempt_keys = OOTreeSet()
         SchemaConfigured.__init__(self, **kwargs)
 
     def keys(self):
@@ -152,6 +238,8 @@ class AbstractSubscription(SchemaConfigured):
             self.__dict__.pop('status_message', None)
             # Reset to 0
             del self._delivery_applicable_precondition_failed
+            # Start judging failures over.
+            self.__dict__.pop('_failure_window', None)
         # TODO: If we need to, this would be a good place to notify specific
         # events about becoming in/active. The ``I[Un]Registered`` event we use to
         # call *this* function can be used, but isn't obvious (and the order may be
@@ -169,8 +257,67 @@ class AbstractSubscription(SchemaConfigured):
         for k in list(self.keys()):
             del self[k]
 
+    def attemptCounts(self):
+        counts = self._attempt_counts
+        if counts is None:
+            # Reading this must not write.
+            result = {status: 0 for status in _new_attempt_counts()}
+            for attempt in self.values():
+                result[attempt.status] += 1
+            return result
+        return {status: count() for status, count in counts.items()}
+
+    def _resolvedAttemptKeys(self):
+        """
+        Return the sorted set of the keys of the resolved attempts.
+        """
+        keys = self._resolved_attempt_keys
+        if keys is None:
+            keys = OOTreeSet(key for key, attempt in self.items() if attempt.resolved())
+            self._resolved_attempt_keys = keys
+        return keys
+
+    def _attemptCountsChanged(self, *changes):
+        # Apply the (status, delta) *changes*, which have already
+        # happened to the stored attempts.
+        counts = self._attempt_counts
+        if counts is None:
+            # We're writing anyway, so start keeping them. Counting
+            # now includes the changes.
+            counts = _new_attempt_counts()
+            for attempt in self.values():
+                counts[attempt.status].change(1)
+            self._attempt_counts = counts
+            return
+        for status, delta in changes:
+            counts[status].change(delta)
+
+    def _attemptAdded(self, key, attempt):
+        self._attemptCountsChanged((attempt.status, 1))
+        if attempt.resolved() and self._resolved_attempt_keys is not None:
+            self._resolved_attempt_keys.add(key)
+
+    def _attemptRemoved(self, key, attempt):
+        self._attemptCountsChanged((attempt.status, -1))
+        if self._resolved_attempt_keys is not None:
+            self._resolved_attempt_keys.discard(key)
+
+    def _attemptStatusChanged(self, attempt, old_status, new_status):
+        # Called by the attempts when their status changes.
+        self._attemptCountsChanged((old_status, -1), (new_status, 1))
+        if self._resolved_attempt_keys is not None \
+           and IWebhookDeliveryAttempt['status'].isResolved(new_status):
+            self._resolved_attempt_keys.add(attempt.__name__)
+
     def _find_principal(self, data):
+        return security_lookup_cache.find('principal', self.owner_id, data,
+                                          self._lookup_principal,
+                                          security_lookup_cache.principal_ttl)
+
+    def _lookup_principal(self, data):
+        # Returns the principal, and whether it may be cached.
         principal = None
+        found = False
         for context in (data, None):
             auth = component.queryUtility(IAuthentication, context=context)
             if auth is None:
@@ -196,6 +343,7 @@ class AbstractSubscription(SchemaConfigured):
                     principal = auth.unauthenticatedPrincipal()
             else:
                 assert principal is not None
+                found = True
                 break
         if principal is None and self.fallback_to_unauthenticated_principal:
             # Hmm. Either no IAuthentication found, or none of them found a
@@ -203,17 +351,22 @@ class AbstractSubscription(SchemaConfigured):
             # In that case, we will fall back to the global IUnauthenticatedPrincipal as
             # defined by zope.principalregistry. This should typically not happen.
             principal = component.getUtility(IUnauthenticatedPrincipal)
-        return principal
+        # Principals that can't be found may be added at any time,
+        # without changing any registrations, so we don't remember that.
+        return principal, found
 
     def _find_permission(self, data):
         if self.permission_id is None:
             return None
+        return security_lookup_cache.find('permission', self.permission_id, data,
+                                          self._lookup_permission)
 
+    def _lookup_permission(self, data):
         for context in (data, None):
             perm = component.queryUtility(IPermission, self.permission_id, context=context)
             if perm is not None:
                 break
-        return perm
+        return perm, perm is not None
 
     def isApplicable(self, data):
         if hasattr(self.for_, 'providedBy'):
@@ -224,9 +377,31 @@ class AbstractSubscription(SchemaConfigured):
                 return False
 
         # No need for the distinction it makes here.
-        return bool(self.__checkSecurity(data))
+        return bool(self.__checkSecurityMemoized(data))
 
-    def __checkSecurity(self, data):
+    def __checkSecurityMemoized(self, data, decisions=None):
+        """
+        Like :meth:`__checkSecurity`, but decisions are remembered
+        while inside :func:`remember_security_decisions`, so many
+        events for the same data in one transaction only check once.
+        """
+        memo = getattr(_security_memos, 'memo', None)
+        if memo is None:
+            return self.__checkSecurity(data, decisions)
+        key = (id(self), id(data), _interaction_key())
+        try:
+            return memo[key][2]
+        except KeyError:
+            pass
+        result = self.__checkSecurity(data, decisions)
+        if result is not None:
+            # Missing principals or permissions must be noticed (and
+            # counted) every time; they may also be fixed at any time.
+            # Keep the objects alive so their ids aren't reused.
+            memo[key] = (self, data, result)
+        return result
+
+    def __checkSecurity(self, data, decisions=None):
         """
         Returns a boolean indicating whether *data* passes the security
         checks defined for this subscription.
@@ -236,6 +411,10 @@ class AbstractSubscription(SchemaConfigured):
         (false) value `None`. This can be used to distinguish the case where
         access is denied by the security policy from the case where requested
         principals are missing.
+
+        If *decisions* is given, it is a dictionary shared by
+        subscriptions checking the same *data* at the same time; the
+        decision for each principal and permission is only made once.
         """
 
         if not self.permission_id and not self.owner_id:
@@ -253,23 +432,18 @@ class AbstractSubscription(SchemaConfigured):
             # It's treated the same as zope.Public. So don't let that happen.
             return None
 
-        # Now, we need to set up the interaction and do the security check.
-        participation = Participation(principal)
-        current_interaction = queryInteraction()
-        if current_interaction is not None:
-            # Cool, we can add our participation to the interaction.
-            current_interaction.add(participation)
-        else:
-            newInteraction(participation)
+        if decisions is None:
+            return _check_permission(principal, self.permission_id, data)
 
+        # The same principal may be a different object each time it's
+        # looked up, so group by its id.
+        key = (principal.id, self.permission_id)
         try:
-            # Yes, this needs the ID of the permission, not the permission object.
-            return checkPermission(self.permission_id, data)
-        finally:
-            if current_interaction is not None:
-                current_interaction.remove(participation)
-            else:
-                endInteraction()
+            return decisions[key]
+        except KeyError:
+            pass
+        result = decisions[key] = _check_permission(principal, self.permission_id, data)
+        return result
 
     # We only ever use the ``increment()`` method of this, *or* we
     # delete it (which works even if there's nothing in our ``__dict__``)
@@ -286,8 +460,17 @@ class AbstractSubscription(SchemaConfigured):
     def __call__(self, data, event):
         # We're assumed applicable for the data and event, no need to double
         # check that.
+        return self._deliverable(data)
+
+    def _deliverable(self, data, decisions=None):
+        """
+        Return this object if it should receive a delivery for *data*,
+        otherwise None, counting the failures to check security.
+
+        *decisions* is as for :meth:`__checkSecurity`.
+        """
         assert self.active
-        security_check = self.__checkSecurity(data)
+        security_check = self.__checkSecurityMemoized(data, decisions)
 
         if security_check:
             # Yay, access granted!
@@ -326,7 +509,7 @@ class AbstractSubscription(SchemaConfigured):
 
     def createDeliveryAttempt(self, payload_data):
         attempt = self._new_deliveryAttempt()
-        attempt.payload_data = payload_data
+        attempt.payload_data = share_payload(self, payload_data)
 
         # Store the attempt (make it contained by this object) before we
         # conceivably change its status. Changing the status
@@ -347,9 +530,7 @@ class AbstractSubscription(SchemaConfigured):
         except Exception: # pylint:disable=broad-except
             # The exception value can vary; it's not intended to be presented to end
             # users as-is
-            attempt.message = (
-                u'Verification of the destination URL failed. Please check the domain.'
-            )
+            attempt.message = VALIDATION_FAILED_MESSAGE
             attempt.internal_info.storeExceptionInfo(sys.exc_info())
             attempt.status = 'failed' # This could cause pruning
 
@@ -366,12 +547,16 @@ class AbstractSubscription(SchemaConfigured):
             describe_class_or_specification(self.when),
         )
 
-class Subscription(_CheckObjectOnSetSampleContainer, AbstractSubscription, DCTimesMixin):
+class Subscription(_AttemptTrackingContainer,
+                   _CheckObjectOnSetSampleContainer,
+                   AbstractSubscription,
+                   DCTimesMixin):
     def __init__(self, **kwargs):
         AbstractSubscription.__init__(self, **kwargs)
         _CheckObjectOnSetSampleContainer.__init__(self)
 
-class PersistentSubscription(_CheckObjectOnSetBTreeContainer,
+class PersistentSubscription(_AttemptTrackingContainer,
+                             _CheckObjectOnSetBTreeContainer,
                              AbstractSubscription,
                              PersistentDCTimesMixin):
     """
@@ -390,6 +575,192 @@ class PersistentSubscription(_CheckObjectOnSetBTreeContainer,
     _p_repr = AbstractSubscription.__repr__
 
 
+def _check_permission(principal, permission_id, data):
+    # Does *principal* have the permission *permission_id* on *data*?
+    participation = Participation(principal)
+    current_interaction = queryInteraction()
+    if current_interaction is not None:
+        # Cool, we can add our participation to the interaction.
+        current_interaction.add(participation)
+    else:
+        newInteraction(participation)
+
+    try:
+        # Yes, this needs the ID of the permission, not the permission object.
+        return checkPermission(permission_id, data)
+    finally:
+        if current_interaction is not None:
+            current_interaction.remove(participation)
+        else:
+            endInteraction()
+
+
+_security_memos = threading.local()
+
+
+@contextmanager
+def remember_security_decisions(tx):
+    """
+    Within this context, the security decisions of subscriptions
+    (whether checked by :meth:`~.AbstractSubscription.isApplicable` or
+    when delivering) are remembered for the rest of the transaction
+    *tx*.
+
+    They are kept in the transaction's data, so they are forgotten
+    when it commits or aborts.
+    """
+    try:
+        memo = tx.data(remember_security_decisions)
+    except KeyError:
+        memo = {}
+        tx.set_data(remember_security_decisions, memo)
+    previous = getattr(_security_memos, 'memo', None)
+    _security_memos.memo = memo
+    try:
+        yield memo
+    finally:
+        _security_memos.memo = previous
+
+
+def _interaction_key():
+    # Our principal is added to the current interaction, if there is one,
+    # and the decision depends on all of its participants.
+    interaction = queryInteraction()
+    if interaction is None:
+        return None
+    return tuple(
+        getattr(participation.principal, 'id', None)
+        for participation in interaction.participations
+    )
+
+
+class _CachedSecurityLookup(object):
+
+    __slots__ = (
+        'current_site_manager',
+        'data_site_manager',
+        'generations',
+        'expires',
+        'value',
+    )
+
+    def __init__(self, current_site_manager, data_site_manager, expires, value):
+        self.current_site_manager = weakref.ref(current_site_manager)
+        self.data_site_manager = weakref.ref(data_site_manager)
+        self.generations = utility_registry_generations((current_site_manager,
+                                                         data_site_manager))
+        self.expires = expires
+        self.value = value
+
+    def current(self, current_site_manager, data_site_manager, now):
+        return (
+            self.current_site_manager() is current_site_manager
+            and self.data_site_manager() is data_site_manager
+            and (self.expires is None or now < self.expires)
+            and utility_registries_unchanged(self.generations)
+        )
+
+
+class SecurityLookupCache(object):
+    """
+    Remembers the principals and permissions found for the security
+    checks of subscriptions.
+
+    They're looked up as utilities in the site of the data and in the
+    current site, so the results are kept for each combination of the
+    two site managers, until the utilities registered in either of
+    them (or their bases) change. Principals are also forgotten after
+    :attr:`principal_ttl` seconds, when they are removed (see
+    :func:`nti.webhooks.subscribers.remove_subscriptions_for_principal`),
+    or when :meth:`invalidate` is called. Principals and permissions
+    that can't be found aren't remembered.
+
+    No more than :attr:`max_entries` are kept; the least recently used
+    are forgotten first.
+    """
+
+    #: The most principals and permissions to remember.
+    max_entries = 1000
+
+    #: How long, in seconds, to remember a principal. A principal
+    #: changed or deleted without the events that make it be forgotten
+    #: (or changed in another process) may be used for this long
+    #: afterwards. 0 doesn't remember principals; None means until
+    #: they are removed.
+    principal_ttl = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(kind, name, id(current site manager), id(data site manager)): _CachedSecurityLookup}
+        self._entries = OrderedDict()
+        #: The number of lookups answered from the cache.
+        self.hits = 0
+        #: The number of lookups that had to query the utilities.
+        self.misses = 0
+
+    def find(self, kind, name, data, lookup, ttl=None):
+        """
+        Return what the *kind* of object named *name* is for *data*.
+
+        If it isn't known, call ``lookup(data)``, which returns the
+        object and whether it may be remembered, for *ttl* seconds if
+        that's not None. A *ttl* of 0 doesn't remember it.
+        """
+        if ttl == 0:
+            return lookup(data)[0]
+        current_site_manager = component.getSiteManager()
+        data_site_manager = component.getSiteManager(data)
+        key = (kind, name, id(current_site_manager), id(data_site_manager))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.current(current_site_manager, data_site_manager, now):
+                self._entries[key] = entry
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+
+        value, cacheable = lookup(data)
+        if not cacheable:
+            return value
+        try:
+            entry = _CachedSecurityLookup(current_site_manager, data_site_manager,
+                                          now + ttl if ttl is not None else None,
+                                          value)
+        except (AttributeError, TypeError):
+            # Not a registry we know how to watch, or can't be
+            # weakly referenced.
+            return value
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, principal_id=None):
+        """
+        Forget the principal *principal_id*, in every site, or
+        everything if not given.
+        """
+        with self._lock:
+            if principal_id is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries
+                        if key[0] == 'principal' and key[1] == principal_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+#: The cache used by subscriptions to find the principal and permission
+#: of their security checks.
+security_lookup_cache = SecurityLookupCache()
+
+
 def _subscription_full(subscription, strict):
     return ILimitedAttemptWebhookSubscription.providedBy(subscription) \
         and len(subscription) > (subscription.attempt_limit - (1 if strict else 0))
@@ -403,20 +774,10 @@ def prune_subscription_when_resolved(event):
     if not _subscription_full(subscription, False):
         return
 
-    # Copy to avoid concurrent modification. On PyPy, we've seen this
-    # produce ``IndexError: list index out of range`` in some tests.
-    # This can be reproduced in CPython using PURE_PYTHON mode.
-    count = 0
-    for key, stored_attempt in list(subscription.items()):
-        if stored_attempt.resolved():
-            del subscription[key]
-            count += 1
-            if len(subscription) <= subscription.attempt_limit:
-                break
-    logger.debug(
-        "Pruned %d old delivery attempts from subscription %s",
-        count, subscription
-    )
+    if subscription.prune_in_background and getattr(subscription, '_p_jar', None) is not None:
+        global_pruning_sweeper.schedule(subscription)
+    else:
+        prune_subscription(subscription)
 
 
 @component.adapter(IWebhookDeliveryAttemptFailedEvent)
@@ -424,16 +785,14 @@ def deactivate_subscription_when_all_failed(event):
     # type: (IWebhookDeliveryAttemptFailedEvent) -> None
     attempt = event.object # type: WebhookDeliveryAttempt
     subscription = attempt.__parent__
-    if not _subscription_full(subscription, True):
+    if failed_while_open(attempt) or not _subscription_full(subscription, True):
         return
 
     # This is a very simple-minded approach. Something more featured
     # might involve a ratio of failed attempts? Over some sort of sliding window?
     # Or examining the time period?
-    # This has to activate all the sub-objects, which could be expensive.
-    # We could make the subscription use BTree Length objects to track
-    # the various states.
-    if all(attempt.failed() for attempt in subscription.values()):
+    counts = subscription.attemptCounts()
+    if counts['failed'] and not counts['pending'] and not counts['successful']:
         logger.info(
             "Deactivating webhook subscription %s due to too many delivery failures.",
             subscription,
@@ -512,7 +871,20 @@ class AbstractWebhookSubscriptionManager(object):
                                                     IWebhookSubscription)
 
     def subscriptionsToDeliver(self, data, event):
-        return self.registry.subscribers((data, event), IWebhookSubscription)
+        # This is what ``self.registry.subscribers((data, event), IWebhookSubscription)``
+        # would do, except that subscriptions with the same principal
+        # and permission share one security check.
+        decisions = {}
+        result = []
+        for subscription in self.activeSubscriptions(data, event):
+            deliverable = getattr(subscription, '_deliverable', None)
+            if deliverable is not None:
+                subscription = deliverable(data, decisions)
+            else:
+                subscription = subscription(data, event)
+            if subscription is not None:
+                result.append(subscription)
+        return result
 
     def deleteSubscriptionsForPrincipal(self, principal_id):
         # We don't think this will be a performance bottleneck, subscription
@@ -598,4 +970,5 @@ except ImportError: # pragma: no cover
     pass
 else:
     addCleanUp(resetGlobals)
+    addCleanUp(security_lookup_cache.clear)
     del addCleanUp
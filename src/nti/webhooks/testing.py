@@ -99,9 +99,11 @@ class SequentialExecutorService(object):
         self.to_run.append(func)
 
     def waitForPendingExecutions(self, timeout=None):
-        funcs, self.to_run = list(self.to_run), []
-        for func in funcs:
-            func()
+        # Running a task may submit more tasks; run those too.
+        while self.to_run:
+            funcs, self.to_run = list(self.to_run), []
+            for func in funcs:
+                func()
 
     def shutdown(self):
         self.to_run = None
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for asyncio_executor.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import has_properties
+
+from nti.webhooks import delivery_manager
+from nti.webhooks.attempts import WebhookDeliveryAttempt
+from nti.webhooks.dialect import DefaultWebhookDialect
+
+from nti.webhooks.tests.test_http import ServerTestMixin
+
+from nti.webhooks.asyncio_executor import AsyncioExecutorService
+
+if AsyncioExecutorService is not None:
+    from nti.webhooks._asyncio_executor import aiohttp
+else: # pragma: no cover
+    aiohttp = None
+
+
+def _makeAttempt():
+    attempt = WebhookDeliveryAttempt()
+    attempt.payload_data = u'{}'
+    return attempt
+
+
+class MockSubscription(object):
+
+    def __init__(self, to):
+        self.to = to
+        self.dialect = DefaultWebhookDialect()
+
+
+@unittest.skipIf(AsyncioExecutorService is None, "Requires Python 3")
+class TestAsyncioExecutorService(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        executor = AsyncioExecutorService(**kwargs)
+        self.addCleanup(executor.shutdown)
+        return executor
+
+    def test_plain_callables(self):
+        executor = self._makeOne()
+        ran = []
+        executor.submit(lambda: ran.append(1))
+        executor.waitForPendingExecutions(5)
+        self.assertEqual(ran, [1])
+
+        def boom():
+            raise ValueError
+
+        executor.submit(boom)
+        with self.assertRaises(ValueError):
+            executor.waitForPendingExecutions(5)
+
+    def test_queue_bounded(self):
+        executor = self._makeOne(max_in_flight=1)
+        executor.max_queue_depth = 1
+        executor.overflow_policy = delivery_manager.OVERFLOW_DROP_NEWEST
+        release = threading.Event()
+        running = threading.Event()
+        ran = []
+
+        def occupy():
+            running.set()
+            release.wait(5)
+
+        executor.submit(occupy)
+        running.wait(5)
+        executor.submit(lambda: ran.append('queued'))
+        executor.submit(lambda: ran.append('dropped'))
+        self.assertEqual(executor.queue_depth, 1)
+        self.assertEqual(executor.dropped_count, 1)
+
+        release.set()
+        executor.waitForPendingExecutions(5)
+        self.assertEqual(ran, ['queued'])
+        self.assertEqual(executor.started_count, 2)
+
+    def test_shutdown_twice(self):
+        executor = AsyncioExecutorService()
+        executor.shutdown()
+        executor.shutdown()
+
+
+
+@unittest.skipIf(AsyncioExecutorService is None, "Requires Python 3")
+class TestDelivery(ServerTestMixin, unittest.TestCase):
+
+    def _deliver(self, executor_factory):
+        manager = delivery_manager.DefaultDeliveryManager('test')
+        manager.executor_service_factory = executor_factory
+        self.addCleanup(manager._reset)
+        self.assertIsInstance(manager.executor_service, AsyncioExecutorService)
+
+        attempts = [_makeAttempt() for _ in range(5)]
+        shipment = manager.createShipmentInfo([
+            (MockSubscription(self.url), attempt)
+            for attempt in attempts
+        ] + [
+            # Unreachable.
+            (MockSubscription('http://127.0.0.1:1/hook'), _makeAttempt())
+        ])
+        manager.acceptForDelivery(shipment)
+        manager.waitForPendingDeliveries(10)
+
+        for attempt in attempts:
+            assert_that(attempt, has_properties(status='successful',
+                                                message=u'200 OK'))
+            assert_that(attempt.response, has_properties(status_code=200))
+            assert_that(attempt.request, has_properties(url=self.url, method='POST'))
+        failed = shipment.work_units[0].results[0].attempt_getter.attempt
+        assert_that(failed, has_properties(status='failed'))
+        self.assertEqual(manager._host_scheduler.active_count('127.0.0.1:1'), 0)
+        return manager.executor_service
+
+    def test_deliver_through_manager_with_threads(self):
+        class ThreadedExecutorService(AsyncioExecutorService):
+            use_aiohttp = False
+
+        executor = self._deliver(lambda: ThreadedExecutorService(max_in_flight=2))
+        self.assertIsNone(executor._client_session)
+
+    @unittest.skipIf(aiohttp is None, "Requires aiohttp")
+    def test_deliver_through_manager_with_aiohttp(self):
+        executor = self._deliver(lambda: AsyncioExecutorService(max_in_flight=2))
+        self.assertIsNotNone(executor._client_session)
+
+if __name__ == '__main__':
+    unittest.main()
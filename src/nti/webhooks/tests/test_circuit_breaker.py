@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for circuit_breaker.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import contains_exactly
+from hamcrest import has_properties
+
+from zope import event
+
+from nti.webhooks.circuit_breaker import CLOSED
+from nti.webhooks.circuit_breaker import HALF_OPEN
+from nti.webhooks.circuit_breaker import OPEN
+from nti.webhooks.circuit_breaker import DestinationCircuitBreakers
+
+
+class TestDestinationCircuitBreakers(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        event.subscribers.append(self.events.append)
+        self.addCleanup(event.subscribers.remove, self.events.append)
+
+    def _makeOne(self, **kwargs):
+        kwargs.setdefault('failure_threshold', 2)
+        kwargs.setdefault('reset_timeout', 60)
+        return DestinationCircuitBreakers(**kwargs)
+
+    def _expire(self, breakers, host):
+        breakers._circuits[host].opened_at -= breakers.reset_timeout
+
+    def test_opens_after_consecutive_failures(self):
+        breakers = self._makeOne()
+        self.assertTrue(breakers.allow('a'))
+        breakers.record('a', False)
+        breakers.record('a', True)
+        # Success resets the count, and stops tracking the host.
+        self.assertEqual(breakers._circuits, {})
+        breakers.record('a', False)
+        self.assertEqual(breakers.state('a'), CLOSED)
+        breakers.record('a', False)
+        self.assertEqual(breakers.state('a'), OPEN)
+
+        self.assertFalse(breakers.allow('a'))
+        self.assertTrue(breakers.allow('b'))
+        self.assertEqual(breakers.rejected_count, 1)
+        self.assertGreater(breakers.retry_after('a'), 59)
+        self.assertEqual(breakers.retry_after('b'), 0)
+        assert_that(self.events, contains_exactly(
+            has_properties(host='a', old_state=CLOSED, new_state=OPEN)))
+
+    def test_half_open_success_closes(self):
+        breakers = self._makeOne(half_open_max_calls=1)
+        breakers.record('a', False)
+        breakers.record('a', False)
+        self._expire(breakers, 'a')
+
+        self.assertTrue(breakers.allow('a'))
+        self.assertEqual(breakers.state('a'), HALF_OPEN)
+        self.assertEqual(breakers.states(), {'a': HALF_OPEN})
+        # Only one trial at a time.
+        self.assertFalse(breakers.allow('a'))
+        self.assertEqual(breakers.retry_after('a'), 1.0)
+
+        breakers.record('a', True)
+        self.assertEqual(breakers.state('a'), CLOSED)
+        self.assertEqual(breakers.states(), {})
+        assert_that([(e.old_state, e.new_state) for e in self.events],
+                    contains_exactly((CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)))
+
+    def test_half_open_failure_reopens(self):
+        breakers = self._makeOne()
+        breakers.record('a', False)
+        breakers.record('a', False)
+        self._expire(breakers, 'a')
+        self.assertTrue(breakers.allow('a'))
+        breakers.record('a', False)
+        self.assertEqual(breakers.state('a'), OPEN)
+        self.assertFalse(breakers.allow('a'))
+
+    def test_release_frees_trial(self):
+        breakers = self._makeOne()
+        breakers.record('a', False)
+        breakers.record('a', False)
+        self._expire(breakers, 'a')
+        self.assertTrue(breakers.allow('a'))
+        self.assertFalse(breakers.allow('a'))
+        # The trial wasn't sent.
+        breakers.release('a')
+        self.assertEqual(breakers.state('a'), HALF_OPEN)
+        self.assertTrue(breakers.allow('a'))
+
+    def test_late_success_while_open(self):
+        breakers = self._makeOne()
+        breakers.record('a', False)
+        breakers.record('a', False)
+        breakers.record('a', True)
+        self.assertEqual(breakers.state('a'), OPEN)
+
+    def test_disabled(self):
+        breakers = self._makeOne()
+        breakers.failure_threshold = None
+        for _ in range(5):
+            breakers.record('a', False)
+        self.assertTrue(breakers.allow('a'))
+        self.assertEqual(breakers._circuits, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for coalescing.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import unittest
+
+from zope.interface import Interface
+from zope.lifecycleevent import Attributes
+from zope.lifecycleevent import ObjectAddedEvent
+from zope.lifecycleevent import ObjectCreatedEvent
+from zope.lifecycleevent import ObjectModifiedEvent
+
+from nti.webhooks.coalescing import KeepFirstEvent
+from nti.webhooks.coalescing import coalesce_events
+from nti.webhooks.coalescing import KeepLastEvent
+from nti.webhooks.coalescing import MergeModifiedEvents
+from nti.webhooks.coalescing import coalescing_policy_for
+from nti.webhooks.datamanager import _DataManagerState
+from nti.webhooks.dialect import DefaultWebhookDialect
+from nti.webhooks.tests import WebhookLayer
+
+
+class IFoo(Interface):
+    pass
+
+
+class IBar(Interface):
+    pass
+
+
+class CountingDialect(DefaultWebhookDialect):
+    count = 0
+
+    def externalizeData(self, data, event):
+        CountingDialect.count += 1
+        return (data, event)
+
+
+class Subscription(object):
+    coalescing_policy = None
+
+    def __init__(self, dialect, coalescing_policy=None):
+        self.dialect = dialect
+        self.coalescing_policy = coalescing_policy
+
+
+class TestPolicies(unittest.TestCase):
+
+    def setUp(self):
+        self.data = object()
+        self.created = ObjectCreatedEvent(self.data)
+        self.first = ObjectModifiedEvent(self.data, Attributes(IFoo, 'a'), 'note')
+        self.added = ObjectAddedEvent(self.data, object(), u'data')
+        self.second = ObjectModifiedEvent(self.data, Attributes(IFoo, 'b', 'a'),
+                                          Attributes(IBar, 'c'), 'note')
+        self.events = [self.created, self.first, self.added, self.second]
+
+    def test_keep_first_and_last(self):
+        self.assertEqual(KeepFirstEvent().coalesce(self.data, self.events), [self.created])
+        self.assertEqual(KeepLastEvent().coalesce(self.data, self.events), [self.second])
+
+    def test_merge_modified(self):
+        result = MergeModifiedEvents().coalesce(self.data, self.events)
+        self.assertEqual(result[:2], [self.created, self.added])
+        merged = result[2]
+        self.assertIs(type(merged), ObjectModifiedEvent)
+        self.assertIs(merged.object, self.data)
+        foo, note, bar = merged.descriptions
+        self.assertEqual((foo.interface, foo.attributes), (IFoo, ('a', 'b')))
+        self.assertEqual(note, 'note')
+        self.assertEqual((bar.interface, bar.attributes), (IBar, ('c',)))
+
+    def test_merge_single_modified_unchanged(self):
+        events = [self.created, self.first]
+        self.assertIs(MergeModifiedEvents().coalesce(self.data, events), events)
+
+
+class TestCoalesceEvents(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def test_order_kept_without_policy(self):
+        dialect = CountingDialect()
+        every = Subscription(dialect)
+        last = Subscription(dialect, 'last')
+        tuples = [
+            (u'a', u'created', every),
+            (u'a', u'created', last),
+            (u'b', u'created', every),
+            (u'b', u'created', last),
+            (u'a', u'modified', every),
+            (u'a', u'modified', last),
+        ]
+        self.assertEqual(coalesce_events(tuples), [
+            (u'a', u'created', every),
+            (u'a', u'modified', last),
+            (u'b', u'created', every),
+            (u'b', u'created', last),
+            (u'a', u'modified', every),
+        ])
+
+
+class TestCoalescingState(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def setUp(self):
+        CountingDialect.count = 0
+
+    def test_policy_from_subscription_or_dialect(self):
+        dialect = CountingDialect()
+        self.assertIsNone(coalescing_policy_for(Subscription(dialect)))
+        dialect.coalescing_policy = 'first'
+        self.assertIsInstance(coalescing_policy_for(Subscription(dialect)), KeepFirstEvent)
+        self.assertIsInstance(coalescing_policy_for(Subscription(dialect, 'last')),
+                              KeepLastEvent)
+        self.assertIsNone(coalescing_policy_for(Subscription(dialect, 'missing')))
+
+    def test_applied_before_rendering(self):
+        dialect = CountingDialect()
+        dialect.payload_cache_key = 'data+event'
+        every, first, last = subs = [
+            Subscription(dialect),
+            Subscription(dialect, 'first'),
+            Subscription(dialect, 'last'),
+        ]
+        state = _DataManagerState(OrderedDict([
+            ((u'data', u'created'), subs),
+            ((u'other', u'created'), subs),
+            ((u'data', u'modified'), subs),
+            ((u'data', u'changed'), subs),
+        ]))
+        payloads = state.subscription_to_payloads
+        # Delivered in the order they were fired.
+        self.assertEqual(payloads[every], [
+            (u'data', u'created'),
+            (u'other', u'created'),
+            (u'data', u'modified'),
+            (u'data', u'changed'),
+        ])
+        self.assertEqual(payloads[first], [(u'data', u'created'), (u'other', u'created')])
+        self.assertEqual(payloads[last], [(u'data', u'changed'), (u'other', u'created')])
+        # Nothing else was rendered.
+        self.assertEqual(CountingDialect.count, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for concurrency.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import unittest
+from email.utils import formatdate
+
+from requests import Response
+
+from nti.webhooks.concurrency import AdaptiveConcurrencyLimits
+from nti.webhooks.concurrency import parse_retry_after
+
+
+def _response(status_code=200, **headers):
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    return response
+
+
+class TestParseRetryAfter(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after(' 120 '), 120)
+
+    def test_date(self):
+        now = time.time()
+        self.assertAlmostEqual(parse_retry_after(formatdate(now + 60), now), 60, delta=1)
+        self.assertEqual(parse_retry_after(formatdate(now - 60), now), 0)
+
+    def test_invalid(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class TestAdaptiveConcurrencyLimits(unittest.TestCase):
+
+    def _makeOne(self):
+        return AdaptiveConcurrencyLimits(initial_limit=2, max_limit=4, latency_target=10)
+
+    def _ok(self, limits, count=1, host='a'):
+        for _ in range(count):
+            limits.observe(host, time.time(), _response())
+
+    def test_additive_increase(self):
+        limits = self._makeOne()
+        self.assertEqual(limits.limit('a'), 2)
+        self._ok(limits)
+        self.assertEqual(limits.limit('a'), 2)
+        self._ok(limits)
+        self.assertEqual(limits.limit('a'), 3)
+        self._ok(limits, 3)
+        self.assertEqual(limits.limit('a'), 4)
+        self._ok(limits, 10)
+        self.assertEqual(limits.limit('a'), 4)
+        self.assertEqual(limits.increase_count, 2)
+        self.assertEqual(limits.limits(), {'a': 4})
+
+    def test_multiplicative_decrease(self):
+        limits = self._makeOne()
+        self._ok(limits, 7)
+        self.assertEqual(limits.limit('a'), 4)
+        started = time.time()
+        limits.observe('a', started, _response(503))
+        self.assertEqual(limits.limit('a'), 2)
+        # Requests that were already in flight don't cut it again.
+        limits.observe('a', started - 1, None)
+        self.assertEqual(limits.limit('a'), 2)
+        limits.observe('a', time.time() + 1, None)
+        self.assertEqual(limits.limit('a'), 1)
+        limits.observe('a', time.time() + 2, _response(429))
+        self.assertEqual(limits.limit('a'), 1)
+        self.assertEqual(limits.decrease_count, 2)
+
+    def test_slow_response(self):
+        limits = self._makeOne()
+        limits.observe('a', time.time() - 11, _response())
+        self.assertEqual(limits.limit('a'), 1)
+
+    def test_retry_after_pauses(self):
+        limits = self._makeOne()
+        self.assertEqual(limits.paused_for('a'), 0)
+        limits.observe('a', time.time(), _response(429, **{'Retry-After': '30'}))
+        self.assertGreater(limits.paused_for('a'), 29)
+        self.assertEqual(limits.paused_for('b'), 0)
+        limits.max_retry_after = 1
+        limits.observe('b', time.time(), _response(503, **{'Retry-After': '30'}))
+        self.assertLessEqual(limits.paused_for('b'), 1)
+
+    def test_forgets_hosts(self):
+        limits = self._makeOne()
+        limits.max_hosts = 2
+        self._ok(limits, host='a')
+        self._ok(limits, host='b')
+        self._ok(limits, host='c')
+        self.assertEqual(sorted(limits.limits()), ['b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
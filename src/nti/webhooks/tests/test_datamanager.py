@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for datamanager.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import transaction
+from persistent import Persistent
+from zope import component
+from zope.interface import Interface
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+from ZODB import DB
+
+from nti.webhooks import delivery_manager
+from nti.webhooks.datamanager import WebhookDataManager
+from nti.webhooks.datamanager import _ConnectionJoiner
+from nti.webhooks.datamanager import _DataManagerState
+from nti.webhooks.dialect import DefaultWebhookDialect
+from nti.webhooks.dialect import PAYLOAD_CACHE_BY_EVENT
+from nti.webhooks.interfaces import IWebhookDeliveryManager
+from nti.webhooks.subscriptions import PersistentSubscription
+from nti.webhooks.tests import WebhookLayer
+
+
+class CountingDialect(DefaultWebhookDialect):
+    count = 0
+
+    def externalizeData(self, data, event):
+        CountingDialect.count += 1
+        return u'%s %s' % (data, event)
+
+
+class OtherDialect(object):
+    # Doesn't extend DefaultWebhookDialect.
+    count = 0
+
+    def externalizeData(self, data, event):
+        OtherDialect.count += 1
+        return data
+
+
+class Subscription(object):
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+
+
+class TestDataManagerState(unittest.TestCase):
+
+    def setUp(self):
+        CountingDialect.count = OtherDialect.count = 0
+
+    def test_dialects_share_payloads(self):
+        subs = [Subscription(CountingDialect()) for _ in range(5)]
+        subs.append(Subscription(OtherDialect()))
+        subs.append(Subscription(OtherDialect()))
+        state = _DataManagerState({
+            (u'data', u'created'): subs,
+            (u'data', u'modified'): subs,
+        })
+        self.assertEqual(CountingDialect.count, 1)
+        self.assertEqual(OtherDialect.count, 2)
+        self.assertEqual(len(state.subscription_to_payloads[subs[0]]), 2)
+
+    def test_payload_by_event(self):
+        dialect = CountingDialect()
+        dialect.payload_cache_key = PAYLOAD_CACHE_BY_EVENT
+        subs = [Subscription(dialect), Subscription(CountingDialect())]
+        state = _DataManagerState({
+            (u'data', u'created'): subs,
+            (u'data', u'modified'): subs,
+        })
+        # One for each event, plus one shared by both events.
+        self.assertEqual(CountingDialect.count, 3)
+        self.assertEqual(sorted(state.subscription_to_payloads[subs[0]]),
+                         [u'data created', u'data modified'])
+
+
+class Data(Persistent):
+
+    def toExternalObject(self, **kwargs):
+        return {}
+
+
+class TestJoinTransaction(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def setUp(self):
+        gsm = component.getGlobalSiteManager()
+        manager = delivery_manager.DefaultDeliveryManager('test')
+        self.addCleanup(manager._reset)
+        self.accepted = []
+        manager.acceptForDelivery = self.accepted.append
+        gsm.registerUtility(manager, IWebhookDeliveryManager)
+        self.addCleanup(gsm.unregisterUtility, manager, IWebhookDeliveryManager)
+
+        db = DB(None)
+        self.addCleanup(db.close)
+        self.tx_manager = transaction.TransactionManager(explicit=True)
+        self.conn = db.open(transaction_manager=self.tx_manager)
+        self.addCleanup(self.conn.close)
+
+    def test_subscription_not_written(self):
+        with self.tx_manager:
+            root = self.conn.root()
+            root['sub'] = sub = PersistentSubscription(to=u'https://example.com/hook',
+                                                       for_=Interface,
+                                                       when=IObjectModifiedEvent)
+            root['data'] = data = Data()
+        serial = sub._p_serial
+
+        with self.tx_manager:
+            for _ in range(3):
+                WebhookDataManager.join_transaction(self.tx_manager, data,
+                                                    ObjectModifiedEvent(data), [sub])
+            # The connection joined once, without registering the
+            # subscription.
+            self.assertEqual([type(obj) for obj in self.conn._registered_objects],
+                             [_ConnectionJoiner])
+
+        self.assertEqual(sub._p_serial, serial)
+        self.assertEqual(len(sub), 3)
+        self.assertEqual(len(self.accepted), 1)
+
+    def test_abort(self):
+        with self.tx_manager:
+            root = self.conn.root()
+            root['sub'] = sub = PersistentSubscription(to=u'https://example.com/hook',
+                                                       for_=Interface,
+                                                       when=IObjectModifiedEvent)
+            root['data'] = data = Data()
+
+        self.tx_manager.begin()
+        WebhookDataManager.join_transaction(self.tx_manager, data,
+                                            ObjectModifiedEvent(data), [sub])
+        self.tx_manager.abort()
+        with self.tx_manager:
+            self.assertEqual(len(sub), 0)
+        self.assertEqual(self.accepted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
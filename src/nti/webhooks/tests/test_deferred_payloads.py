@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for deferred_payloads.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import transaction
+from persistent import Persistent
+from persistent.list import PersistentList
+from zope import component
+from zope.component.hooks import getSite
+from zope.component.interfaces import ISite
+from zope.interface import implementer
+from zope.interface import providedBy
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+from ZODB import DB
+from ZODB.interfaces import IDatabase
+
+from nti.webhooks import delivery_manager
+from nti.webhooks.attempts import PersistentWebhookDeliveryAttempt
+from nti.webhooks.datamanager import WebhookDataManager
+from nti.webhooks.deferred_payloads import RENDER_FAILED_MESSAGE
+from nti.webhooks.deferred_payloads import payload_reference
+from nti.webhooks.dialect import DefaultWebhookDialect
+from nti.webhooks.dialect import PAYLOAD_CACHE_BY_EVENT
+from nti.webhooks.dialect import PAYLOAD_CACHE_BY_EVENT_TYPE
+from nti.webhooks.interfaces import IWebhookDeliveryManager
+
+
+class DeferringDialect(DefaultWebhookDialect):
+    defer_payload_rendering = True
+
+    def externalizeData(self, data, event):
+        if data.value is None:
+            raise ValueError("Can't render")
+        modified = IObjectModifiedEvent.providedBy(event)
+        return u'%s modified=%s' % (data.value, modified)
+
+
+class SiteRecordingDialect(DeferringDialect):
+
+    def externalizeData(self, data, event):
+        return u'%s' % (getattr(getSite(), 'name', None),)
+
+
+@implementer(ISite)
+class Site(Persistent):
+    name = u'the site'
+
+    def getSiteManager(self):
+        return component.getGlobalSiteManager()
+
+
+class Data(Persistent):
+
+    def __init__(self, value):
+        self.value = value
+
+
+class PersistentMockSubscription(Persistent):
+    to = 'https://example.com/hook'
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.attempts = PersistentList()
+
+    def createDeliveryAttempt(self, payload_data):
+        attempt = PersistentWebhookDeliveryAttempt()
+        attempt.payload_data = payload_data
+        attempt.__parent__ = self
+        self.attempts.append(attempt)
+        return attempt
+
+
+class TestPayloadReference(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.addCleanup(self.db.close)
+        self.conn = self.db.open()
+        self.addCleanup(self.conn.close)
+        self.addCleanup(transaction.abort)
+        self.data = Data(1)
+        self.sub = PersistentMockSubscription(DeferringDialect())
+        self.conn.add(self.data)
+        self.conn.add(self.sub)
+
+    def _reference(self, data=None, sub=None):
+        return payload_reference(data or self.data, ObjectModifiedEvent(self.data),
+                                 sub or self.sub)
+
+    def test_deferred(self):
+        reference = self._reference()
+        self.assertEqual(reference.database_name, 'unnamed')
+        self.assertEqual(reference.oid, self.data._p_oid)
+        self.assertEqual(reference.event_provides,
+                         tuple(providedBy(ObjectModifiedEvent(None))))
+        self.assertIsNone(reference.tid)
+
+    def test_not_deferred(self):
+        self.assertIsNone(self._reference(sub=PersistentMockSubscription(DeferringDialect())))
+        self.assertIsNone(self._reference(data=Data(2)))
+        self.sub.dialect = DefaultWebhookDialect()
+        self.assertIsNone(self._reference())
+        self.sub.dialect = DeferringDialect()
+        self.sub.dialect.payload_cache_key = PAYLOAD_CACHE_BY_EVENT
+        self.assertIsNone(self._reference())
+        self.sub.dialect.payload_cache_key = PAYLOAD_CACHE_BY_EVENT_TYPE
+        self.assertIsNone(self._reference())
+
+
+class TestDeferredRendering(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.addCleanup(self.db.close)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(self.db, IDatabase)
+        self.addCleanup(gsm.unregisterUtility, self.db, IDatabase)
+
+        self.manager = delivery_manager.DefaultDeliveryManager('test')
+        self.addCleanup(self.manager._reset)
+        self.accepted = []
+        self.manager.acceptForDelivery = self.accepted.append
+        gsm.registerUtility(self.manager, IWebhookDeliveryManager)
+        self.addCleanup(gsm.unregisterUtility, self.manager, IWebhookDeliveryManager)
+
+        self.tx_manager = transaction.TransactionManager(explicit=True)
+        self.conn = self.db.open(transaction_manager=self.tx_manager)
+        self.addCleanup(self.conn.close)
+        with self.tx_manager:
+            root = self.conn.root()
+            root['data'] = self.data = Data(1)
+            root['sub'] = self.sub = PersistentMockSubscription(DeferringDialect())
+
+    def _commit_delivery(self, value=2):
+        with self.tx_manager:
+            self.data.value = value
+            WebhookDataManager.join_transaction(self.tx_manager, self.data,
+                                                ObjectModifiedEvent(self.data),
+                                                [self.sub])
+        self.assertEqual(len(self.accepted), 1)
+        shipment = self.accepted[0]
+        attempt = self.sub.attempts[-1]
+        return shipment, attempt
+
+    def _record(self, shipment):
+        def record(conn):
+            shipment._process_results(conn, shipment._results)
+        delivery_manager.run_in_private_transaction(self.db, record)
+        self.tx_manager.begin()
+        self.addCleanup(self.tx_manager.abort)
+
+    def test_rendered_from_committed_state(self):
+        shipment, attempt = self._commit_delivery()
+        self.assertIsNone(attempt.payload_data)
+        self.assertEqual(attempt.payload_reference.oid, self.data._p_oid)
+        self.assertFalse(shipment.awaiting_commit)
+        result, = shipment._results
+        self.assertEqual(result.attempt_getter.payload_tid, attempt._p_serial)
+
+        # Later changes aren't seen.
+        with self.tx_manager:
+            self.data.value = 3
+
+        shipment._before_send(result)
+        self.assertEqual(result.attempt_getter.payload_data, u'2 modified=True')
+
+        self._record(shipment)
+        self.assertEqual(attempt.payload_data, u'2 modified=True')
+        self.assertIsNone(attempt.payload_reference)
+
+    def test_rendered_in_subscription_site(self):
+        with self.tx_manager:
+            self.conn.root()['site'] = self.sub.__parent__ = Site()
+            self.sub.dialect = SiteRecordingDialect()
+        shipment, _ = self._commit_delivery()
+        result, = shipment._results
+        self.assertIsNone(getSite())
+        shipment._before_send(result)
+        self.assertEqual(result.attempt_getter.payload_data, u'the site')
+        self.assertIsNone(getSite())
+
+    def test_render_failure(self):
+        shipment, attempt = self._commit_delivery(None)
+        result, = shipment._results
+        with self.assertRaises(ValueError):
+            shipment._before_send(result)
+        self.assertEqual(result.message, RENDER_FAILED_MESSAGE)
+
+        # The state to render is kept for retries.
+        tid = attempt._p_serial
+        self._record(shipment)
+        self.assertIsNone(attempt.payload_data)
+        self.assertEqual(attempt.payload_reference.tid, tid)
+
+    def test_recovered_attempts_know_their_state(self):
+        _, attempt = self._commit_delivery()
+        shipment = delivery_manager.ShipmentInfo([(self.sub, attempt)])
+        self.assertFalse(shipment.awaiting_commit)
+        result, = shipment._results
+        self.assertEqual(result.attempt_getter.payload_tid, attempt._p_serial)
+
+    def test_eager_when_not_stored(self):
+        with self.tx_manager:
+            data = Data(5)
+            WebhookDataManager.join_transaction(self.tx_manager, data,
+                                                ObjectModifiedEvent(data),
+                                                [self.sub])
+        attempt = self.sub.attempts[-1]
+        self.assertEqual(attempt.payload_data, u'5 modified=True')
+        self.assertIsNone(attempt.payload_reference)
+        self.assertFalse(self.accepted[0].awaiting_commit)
+
+
+if __name__ == '__main__':
+    unittest.main()
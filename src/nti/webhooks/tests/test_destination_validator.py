@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for destination_validator.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+import time
+import unittest
+
+import fudge
+import requests
+from zope import component
+from zope.interface.interfaces import IComponentLookup
+from zope.interface.registry import Components
+
+from nti.webhooks import delivery_manager
+from nti.webhooks.attempts import WebhookDeliveryAttempt
+from nti.webhooks.destination_validator import DefaultDestinationValidator
+from nti.webhooks.destination_validator import VALIDATION_FAILED_MESSAGE
+from nti.webhooks.destination_validator import _stop_prefetching
+from nti.webhooks.interfaces import IWebhookDestinationValidator
+
+
+def _getaddrinfo(host, port):
+    if host.endswith('.invalid'):
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', 443))]
+
+
+def _wait_for_prefetch(validator):
+    for _ in range(500):
+        if not validator._prefetching:
+            return
+        time.sleep(0.01)
+    raise AssertionError("Prefetch didn't finish") # pragma: no cover
+
+
+class Subscription(object):
+    dialect = None
+
+    def __init__(self, to):
+        self.to = to
+
+
+class SiteSubscription(Subscription):
+    # Found in the site manager *registry*.
+
+    def __init__(self, to, registry):
+        Subscription.__init__(self, to)
+        self.registry = registry
+
+    def __conform__(self, iface):
+        if iface is IComponentLookup:
+            return self.registry
+        return None
+
+
+class TestDefaultDestinationValidator(unittest.TestCase):
+
+    def setUp(self):
+        patched = fudge.patch('socket.getaddrinfo')
+        self.getaddrinfo = patched.__enter__()
+        self.getaddrinfo.is_callable().calls(_getaddrinfo)
+        self.addCleanup(patched.__exit__, None, None, None)
+        self.addCleanup(_stop_prefetching)
+
+    def test_requires_https(self):
+        validator = DefaultDestinationValidator()
+        with self.assertRaises(ValueError):
+            validator.validateTarget('http://example.com')
+        with self.assertRaises(ValueError):
+            validator.validateTarget('https:///path')
+        self.assertEqual(validator.misses, 0)
+
+    def test_caches_success(self):
+        validator = DefaultDestinationValidator()
+        validator.validateTarget('https://example.com/a')
+        validator.validateTarget('https://user@EXAMPLE.com/b')
+        validator.validateTarget('https://example.com:8443/b')
+        self.assertEqual(validator.misses, 2)
+        self.assertEqual(validator.hits, 1)
+
+    def test_caches_failure(self):
+        validator = DefaultDestinationValidator()
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                validator.validateTarget('https://example.invalid')
+        self.assertEqual(validator.misses, 1)
+        self.assertEqual(validator.hits, 1)
+
+    def test_expires(self):
+        validator = DefaultDestinationValidator()
+        validator.positive_ttl = -1
+        validator.validateTarget('https://example.com')
+        validator.validateTarget('https://example.com')
+        self.assertEqual(validator.misses, 2)
+        self.assertEqual(validator.hits, 0)
+
+    def test_least_recently_used_forgotten(self):
+        validator = DefaultDestinationValidator()
+        validator.max_entries = 2
+        validator.validateTarget('https://a.example.com')
+        validator.validateTarget('https://b.example.com')
+        validator.validateTarget('https://a.example.com')
+        validator.validateTarget('https://c.example.com')
+        self.assertEqual(list(validator._cache),
+                         [('a.example.com', 'https'), ('c.example.com', 'https')])
+
+    def test_validate_at_delivery(self):
+        validator = DefaultDestinationValidator()
+        validator.validate_at_delivery = True
+        # Unknown domains pass, but are looked up in the background.
+        validator.validateTarget('https://example.invalid')
+        _wait_for_prefetch(validator)
+        self.assertEqual(validator.misses, 1)
+        # Now that it's known to fail, it doesn't pass.
+        with self.assertRaises(socket.gaierror):
+            validator.validateTarget('https://example.invalid')
+        with self.assertRaises(socket.gaierror):
+            validator.validateTargetForDelivery('https://example.invalid')
+        validator.validateTargetForDelivery('https://example.com')
+        self.assertEqual(validator.misses, 2)
+
+    def test_validate_for_delivery_does_nothing_by_default(self):
+        validator = DefaultDestinationValidator()
+        validator.validateTargetForDelivery('https://example.invalid')
+        self.assertEqual(validator.misses, 0)
+
+    def test_prefetch(self):
+        validator = DefaultDestinationValidator()
+        validator.prefetch('http://example.com')
+        validator.prefetch('https://example.com')
+        _wait_for_prefetch(validator)
+        self.assertEqual(validator.misses, 1)
+        validator.prefetch('https://example.com')
+        validator.validateTarget('https://example.com')
+        self.assertEqual(validator.misses, 1)
+        self.assertEqual(validator.hits, 2)
+
+
+class TestValidateAtDelivery(unittest.TestCase):
+
+    def setUp(self):
+        patched = fudge.patch('socket.getaddrinfo')
+        patched.__enter__().is_callable().calls(_getaddrinfo)
+        self.addCleanup(patched.__exit__, None, None, None)
+        self.addCleanup(_stop_prefetching)
+        self.validator = DefaultDestinationValidator()
+        self.validator.validate_at_delivery = True
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(self.validator)
+        self.addCleanup(gsm.unregisterUtility, self.validator)
+
+    def _deliver(self, subscription):
+        attempt = WebhookDeliveryAttempt()
+        attempt.payload_data = u'{}'
+        shipment = delivery_manager.ShipmentInfo([(subscription, attempt)])
+        with requests.Session() as http_session:
+            for unit in shipment.work_units:
+                unit.deliver(http_session)
+        return attempt
+
+    def test_failure_recorded_on_attempt(self):
+        attempt = self._deliver(Subscription('https://example.invalid/hook'))
+        self.assertEqual(attempt.status, 'failed')
+        self.assertEqual(attempt.message, VALIDATION_FAILED_MESSAGE)
+        self.assertIn('gaierror', attempt.internal_info.exception_history[0])
+        self.assertEqual(self.validator.misses, 1)
+
+    def test_validator_of_subscription_site(self):
+        # Only the validator of the subscription's site puts off
+        # validation, so only it validates at delivery.
+        self.validator.validate_at_delivery = False
+        local_validator = DefaultDestinationValidator()
+        local_validator.validate_at_delivery = True
+        registry = Components(bases=(component.getGlobalSiteManager(),))
+        registry.registerUtility(local_validator, IWebhookDestinationValidator)
+
+        attempt = self._deliver(SiteSubscription('https://example.invalid/hook', registry))
+        self.assertEqual(attempt.message, VALIDATION_FAILED_MESSAGE)
+        self.assertEqual(local_validator.misses, 1)
+        self.assertEqual(self.validator.misses, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for dialect.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from zope import interface
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent import ObjectCreatedEvent
+
+from nti.webhooks.dialect import DefaultWebhookDialect
+from nti.webhooks.dialect import PAYLOAD_CACHE_BY_EVENT
+from nti.webhooks.dialect import PAYLOAD_CACHE_BY_EVENT_TYPE
+
+
+class IMarker(interface.Interface):
+    pass
+
+
+class TestPayloadCacheKey(unittest.TestCase):
+
+    def _key(self, dialect, event, data=u'data'):
+        return dialect.payload_cache_key_for(data, event)
+
+    def test_by_data(self):
+        dialect = DefaultWebhookDialect()
+        self.assertEqual(self._key(dialect, ObjectModifiedEvent(None)),
+                         self._key(dialect, ObjectCreatedEvent(None)))
+        self.assertNotEqual(self._key(dialect, None),
+                            self._key(dialect, None, data=u'other'))
+
+    def test_by_event_type(self):
+        dialect = DefaultWebhookDialect()
+        dialect.payload_cache_key = PAYLOAD_CACHE_BY_EVENT_TYPE
+        marked = ObjectModifiedEvent(None)
+        interface.alsoProvides(marked, IMarker)
+        self.assertEqual(self._key(dialect, ObjectModifiedEvent(None)),
+                         self._key(dialect, ObjectModifiedEvent(None)))
+        self.assertNotEqual(self._key(dialect, ObjectModifiedEvent(None)),
+                            self._key(dialect, ObjectCreatedEvent(None)))
+        self.assertNotEqual(self._key(dialect, ObjectModifiedEvent(None)),
+                            self._key(dialect, marked))
+
+    def test_by_event(self):
+        dialect = DefaultWebhookDialect()
+        dialect.payload_cache_key = PAYLOAD_CACHE_BY_EVENT
+        event = ObjectModifiedEvent(None)
+        self.assertEqual(self._key(dialect, event), self._key(dialect, event))
+        self.assertNotEqual(self._key(dialect, event),
+                            self._key(dialect, ObjectModifiedEvent(None)))
+
+    def test_unknown(self):
+        dialect = DefaultWebhookDialect()
+        dialect.payload_cache_key = 'bad'
+        with self.assertRaises(ValueError):
+            self._key(dialect, None)
+
+    def test_shared_between_dialects(self):
+        class Configured(DefaultWebhookDialect):
+            http_method = 'PUT'
+            retry_limit = 3
+
+        class Named(DefaultWebhookDialect):
+            externalizer_name = u'other'
+
+        class Custom(DefaultWebhookDialect):
+            def externalizeData(self, data, event):
+                raise NotImplementedError
+
+        key = self._key(DefaultWebhookDialect(), None)
+        self.assertEqual(self._key(Configured(), None), key)
+        self.assertNotEqual(self._key(Named(), None), key)
+        self.assertNotEqual(self._key(Custom(), None), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for failure_window.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import unittest
+
+from zope.interface import Interface
+from zope.interface.interfaces import IObjectEvent
+from ZODB.POSException import ConflictError
+
+from nti.webhooks import interest
+from nti.webhooks.circuit_breaker import CIRCUIT_OPEN_MESSAGE
+from nti.webhooks.failure_window import FailureWindow
+from nti.webhooks.subscriptions import PersistentWebhookSubscriptionManager
+from nti.webhooks.tests import WebhookLayer
+
+
+class TestFailureWindow(unittest.TestCase):
+
+    def test_counts(self):
+        window = FailureWindow(3)
+        self.assertEqual(window.counts(), (0, 0))
+        window.record(True, 1)
+        window.record(False, 2)
+        self.assertEqual(window.counts(), (1, 2))
+        window.record(True, 3)
+        window.record(True, 4)
+        # The first is gone.
+        self.assertEqual(len(window), 3)
+        self.assertEqual(window.counts(), (2, 3))
+        self.assertEqual(window.counts(since=3), (2, 2))
+        self.assertEqual(window.counts(since=5), (0, 0))
+
+    def test_resolve_conflict(self):
+        window = FailureWindow(4)
+        window.record(True, 1)
+        window.record(False, 2)
+        old = window.__getstate__()
+
+        committed = FailureWindow(4)
+        committed.__setstate__(copy.deepcopy(old))
+        committed.record(True, 3)
+
+        new = FailureWindow(4)
+        new.__setstate__(copy.deepcopy(old))
+        new.record(True, 4)
+        new.record(False, 5)
+
+        resolved = FailureWindow(4)
+        resolved.__setstate__(window._p_resolveConflict(
+            old, committed.__getstate__(), new.__getstate__()))
+        # The oldest fell out.
+        self.assertEqual(len(resolved), 4)
+        self.assertEqual(resolved.counts(), (2, 4))
+        self.assertEqual(resolved.counts(since=4), (1, 2))
+        self.assertEqual(resolved._recorded, 5)
+        resolved.record(True, 6)
+        self.assertEqual(resolved.counts(since=5), (1, 2))
+
+    def test_resolve_conflict_different_sizes(self):
+        window = FailureWindow(2)
+        other = FailureWindow(3)
+        with self.assertRaises(ConflictError):
+            window._p_resolveConflict(window.__getstate__(),
+                                      window.__getstate__(),
+                                      other.__getstate__())
+
+
+class TestDeactivation(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def setUp(self):
+        # The manager isn't stored, so its subscriptions count as
+        # being of interest to this process.
+        self.addCleanup(interest._reset)
+        self.manager = PersistentWebhookSubscriptionManager()
+        self.subscription = self.manager.createSubscription(
+            to=u'https://example.com/hook', for_=Interface, when=IObjectEvent)
+        self.subscription.failure_ratio_limit = 0.5
+        self.subscription.failure_window_size = 4
+        self.subscription.failure_window_minimum = 3
+
+    def _resolve(self, *statuses, **kwargs):
+        for status in statuses:
+            attempt = self.subscription._new_deliveryAttempt()
+            self.subscription[str(len(self.subscription))] = attempt
+            attempt.message = kwargs.get('message')
+            attempt.status = status
+
+    def test_disabled_by_default(self):
+        del self.subscription.failure_ratio_limit
+        self._resolve('failed', 'failed', 'failed')
+        self.assertTrue(self.subscription.active)
+        self.assertIsNone(self.subscription._failure_window)
+
+    def test_deactivated_at_limit(self):
+        self._resolve('failed', 'successful')
+        # Not enough to judge.
+        self.assertTrue(self.subscription.active)
+        self._resolve('successful', 'successful', 'failed')
+        # 1 of the last 4.
+        self.assertTrue(self.subscription.active)
+        self._resolve('failed')
+        self.assertFalse(self.subscription.active)
+        self.assertIn(u'recent delivery failures', self.subscription.status_message)
+
+        # Activating starts over.
+        self.manager.activateSubscription(self.subscription)
+        self.assertIsNone(self.subscription._failure_window)
+        self._resolve('failed')
+        self.assertTrue(self.subscription.active)
+
+    def test_failures_while_open_ignored(self):
+        # Neither by this nor by the rule that all attempts failed.
+        self.subscription.attempt_limit = 4
+        self._resolve('failed', 'failed', 'failed', 'failed', message=CIRCUIT_OPEN_MESSAGE)
+        self.assertTrue(self.subscription.active)
+        self.assertIsNone(self.subscription._failure_window)
+
+    def test_time_window(self):
+        self.subscription.failure_window_seconds = 60
+        self._resolve('failed', 'failed')
+        # Make those old.
+        self.subscription._failure_window._times[0] = 0
+        self.subscription._failure_window._times[1] = 0
+        self._resolve('failed', 'successful', 'successful')
+        self.assertTrue(self.subscription.active)
+
+
+if __name__ == '__main__':
+    unittest.main()
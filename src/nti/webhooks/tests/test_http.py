@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for _http.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError: # Py2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+from nti.webhooks import _http
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.send_header('Set-Cookie', 'tracking=1')
+        self.end_headers()
+
+    def log_message(self, *args): # pylint:disable=arguments-differ
+        "Be quiet"
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    # Each connection is handled in its own thread, so idle keep-alive
+    # connections don't block new ones. Closing the server closes the
+    # connections and waits for their threads.
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    def process_request_thread(self, request, client_address):
+        with self._lock:
+            self._connections.add(request)
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._lock:
+                self._connections.discard(request)
+
+    def server_close(self):
+        with self._lock:
+            for request in self._connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except (IOError, OSError): # pragma: no cover
+                    pass
+        # Python 2 doesn't wait for the threads.
+        getattr(ThreadingMixIn, 'server_close', HTTPServer.server_close)(self)
+
+
+class ServerTestMixin(object):
+    """
+    Runs a :class:`_Server` in a thread for each test, stopping
+    it in ``tearDown``.
+    """
+
+    handler = _Handler
+
+    def setUp(self):
+        super(ServerTestMixin, self).setUp()
+        self.server = _Server(('127.0.0.1', 0), self.handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/hook' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        super(ServerTestMixin, self).tearDown()
+
+
+class TestPooledSession(ServerTestMixin, unittest.TestCase):
+
+    def _makeSession(self, **kwargs):
+        adapter = _http.PooledHTTPAdapter(**kwargs)
+        session = _http.create_pooled_session(adapter)
+        self.addCleanup(session.close)
+        return session, adapter.statistics
+
+    def test_connections_reused(self):
+        session, stats = self._makeSession()
+        for _ in range(3):
+            session.post(self.url, data=b'{}').raise_for_status()
+        assert_that(stats.as_dict(),
+                    has_entries(new_connections=1, reused_connections=2))
+        # No cookies are kept.
+        self.assertEqual(len(session.cookies), 0)
+
+    def test_max_lifetime(self):
+        session, stats = self._makeSession(max_lifetime=0)
+        for _ in range(3):
+            session.post(self.url, data=b'{}').raise_for_status()
+        assert_that(stats.as_dict(),
+                    has_entries(new_connections=3,
+                                reused_connections=0,
+                                lifetime_evictions=2))
+
+    def test_idle_timeout(self):
+        session, stats = self._makeSession(idle_timeout=0)
+        for _ in range(2):
+            session.post(self.url, data=b'{}').raise_for_status()
+        assert_that(stats.as_dict(),
+                    has_entries(new_connections=2,
+                                idle_evictions=1))
+
+    def test_statistics_not_shared(self):
+        _, stats = self._makeSession()
+        _, other_stats = self._makeSession()
+        stats.increment('new_connections')
+        self.assertEqual(stats.new_connections, 1)
+        self.assertEqual(other_stats.new_connections, 0)
+        stats.reset()
+        self.assertEqual(stats.new_connections, 0)
+
+    def test_host_pool_size(self):
+        session, _ = self._makeSession(host_pool_sizes={'127.0.0.1': 3},
+                                       pool_maxsize=1)
+        session.post(self.url, data=b'{}').raise_for_status()
+        pool = session.get_adapter(self.url).poolmanager.connection_from_url(self.url)
+        self.assertEqual(pool.pool.maxsize, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
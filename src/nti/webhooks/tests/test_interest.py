@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for interest.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from persistent import Persistent
+from zope.interface import Interface
+from zope.interface import implementer
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from nti.webhooks import interest
+from nti.webhooks.interest import InterestSet
+from nti.webhooks.interest import InterestSummary
+from nti.webhooks.interest import may_be_interested
+from nti.webhooks.interest import rebuild_interest_summary
+from nti.webhooks.subscriptions import PersistentWebhookSubscriptionManager
+from nti.webhooks.subscriptions import getGlobalSubscriptionManager
+from nti.webhooks.subscriptions import resetGlobals
+from nti.webhooks.tests import WebhookLayer
+
+
+class IFoo(Interface):
+    pass
+
+
+class ISubFoo(IFoo):
+    pass
+
+
+class IBar(Interface):
+    pass
+
+
+@implementer(ISubFoo)
+class Foo(Persistent):
+    pass
+
+
+@implementer(IBar)
+class Bar(Persistent):
+    pass
+
+
+class TestInterestSet(unittest.TestCase):
+
+    def test_counts(self):
+        interest_set = InterestSet()
+        modified = ObjectModifiedEvent(None)
+        self.assertFalse(interest_set.interested(Foo(), modified))
+        interest_set.add((IFoo, IObjectModifiedEvent))
+        interest_set.add((IFoo, IObjectModifiedEvent))
+        self.assertEqual(len(interest_set), 2)
+        self.assertTrue(interest_set.interested(Foo(), modified))
+        self.assertFalse(interest_set.interested(Bar(), modified))
+        self.assertFalse(interest_set.interested(Foo(), object()))
+
+        interest_set.remove((IFoo, IObjectModifiedEvent))
+        self.assertTrue(interest_set.interested(Foo(), modified))
+        interest_set.remove((IFoo, IObjectModifiedEvent))
+        interest_set.remove((IFoo, IObjectModifiedEvent))
+        self.assertEqual(len(interest_set), 0)
+        self.assertFalse(interest_set.interested(Foo(), modified))
+
+    def test_untrusted_without_subscribers(self):
+        # Nothing is configured, so the summaries aren't kept current.
+        self.assertTrue(may_be_interested(Bar(), ObjectModifiedEvent(None)))
+
+
+class TestInterestSummary(unittest.TestCase):
+
+    required = (IFoo, IObjectModifiedEvent)
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        self.addCleanup(self.db.close)
+
+    def _concurrently(self, *changes):
+        # Apply each change to the summary in its own transaction,
+        # all begun before any commits, then commit them in order.
+        tx_managers = [transaction.TransactionManager(explicit=True) for _ in changes]
+        conns = [self.db.open(transaction_manager=tx_manager) for tx_manager in tx_managers]
+        for conn in conns:
+            self.addCleanup(conn.close)
+        for tx_manager in tx_managers:
+            tx_manager.begin()
+        for conn, change in zip(conns, changes):
+            getattr(InterestSummary.find(conn), change)(self.required)
+        try:
+            for committed, tx_manager in enumerate(tx_managers):
+                tx_manager.commit()
+        except ConflictError:
+            for tx_manager in tx_managers[committed:]:
+                tx_manager.abort()
+            raise
+
+    def _summary(self, count):
+        with self.db.transaction() as conn:
+            summary = InterestSummary.find(conn, create=True)
+            for _ in range(count):
+                summary.add(self.required)
+
+    def test_concurrent_changes_merge(self):
+        self._summary(2)
+        self._concurrently('add', 'remove')
+
+        with self.db.transaction() as conn:
+            summary = InterestSummary.find(conn)
+            self.assertEqual(len(summary), 2)
+            self.assertTrue(summary.interested(Foo(), ObjectModifiedEvent(None)))
+            summary.remove(self.required)
+            summary.remove(self.required)
+            self.assertFalse(summary.interested(Foo(), ObjectModifiedEvent(None)))
+            self.assertEqual(len(summary), 0)
+
+    def test_removing_last_conflicts_with_adding(self):
+        self._summary(1)
+        with self.assertRaises(ConflictError):
+            self._concurrently('add', 'remove')
+
+    def test_adding_conflicts_with_removing_last(self):
+        self._summary(1)
+        with self.assertRaises(ConflictError):
+            self._concurrently('remove', 'add')
+
+    def test_counters_not_loaded_to_check(self):
+        self._summary(1)
+        self.db.cacheMinimize()
+        with self.db.transaction() as conn:
+            summary = InterestSummary.find(conn)
+            self.assertTrue(summary.interested(Foo(), ObjectModifiedEvent(None)))
+            self.assertFalse(summary.interested(Bar(), ObjectModifiedEvent(None)))
+            self.assertEqual(summary._counts._p_status, 'ghost')
+
+
+class TestMayBeInterested(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def setUp(self):
+        self.addCleanup(interest._reset)
+        self.addCleanup(resetGlobals)
+        self.modified = ObjectModifiedEvent(None)
+
+    def _create(self, manager):
+        return manager.createSubscription(to='https://example.com/hook',
+                                          for_=IFoo, when=IObjectModifiedEvent)
+
+    def test_global_subscriptions(self):
+        self.assertFalse(may_be_interested(Foo(), self.modified))
+        manager = getGlobalSubscriptionManager()
+        subscription = self._create(manager)
+        self.assertTrue(may_be_interested(Foo(), self.modified))
+        self.assertFalse(may_be_interested(Bar(), self.modified))
+        manager.deactivateSubscription(subscription)
+        self.assertFalse(may_be_interested(Foo(), self.modified))
+
+    def test_persistent_subscriptions(self):
+        db = DB(None)
+        self.addCleanup(db.close)
+        tx_manager = transaction.TransactionManager(explicit=True)
+        conn = db.open(transaction_manager=tx_manager)
+        self.addCleanup(conn.close)
+        with tx_manager:
+            root = conn.root()
+            root['manager'] = manager = PersistentWebhookSubscriptionManager()
+            root['foo'] = foo = Foo()
+            root['bar'] = bar = Bar()
+            subscription = self._create(manager)
+
+        with tx_manager:
+            # Without a summary, we can't tell.
+            self.assertTrue(may_be_interested(bar, self.modified))
+            summary = rebuild_interest_summary(conn)
+            self.assertEqual(len(summary), 1)
+            self.assertTrue(may_be_interested(foo, self.modified))
+            self.assertFalse(may_be_interested(bar, self.modified))
+
+        with tx_manager:
+            manager.deactivateSubscription(subscription)
+            self.assertFalse(may_be_interested(foo, self.modified))
+
+        # Another connection sees the committed summary.
+        other_tx_manager = transaction.TransactionManager()
+        other_conn = db.open(transaction_manager=other_tx_manager)
+        try:
+            self.assertEqual(len(InterestSummary.find(other_conn)), 0)
+            self.assertFalse(may_be_interested(other_conn.root()['foo'], self.modified))
+        finally:
+            other_tx_manager.abort()
+            other_conn.close()
+
+        with tx_manager:
+            manager.activateSubscription(subscription)
+            self.assertTrue(may_be_interested(foo, self.modified))
+            self.assertEqual(len(InterestSummary.find(conn)), 1)
+
+    def test_summary_created_by_first_registration(self):
+        db = DB(None)
+        self.addCleanup(db.close)
+        tx_manager = transaction.TransactionManager(explicit=True)
+        conn = db.open(transaction_manager=tx_manager)
+        self.addCleanup(conn.close)
+        with tx_manager:
+            conn.root()['manager'] = manager = PersistentWebhookSubscriptionManager()
+            conn.root()['bar'] = bar = Bar()
+        with tx_manager:
+            self._create(manager)
+            self.assertEqual(len(InterestSummary.find(conn)), 1)
+            self.assertFalse(may_be_interested(bar, self.modified))
+
+        # As if stored by a version without summaries.
+        with tx_manager:
+            del conn.root()[InterestSummary.ROOT_KEY]
+        with tx_manager:
+            manager.createSubscription(to='https://example.com/hook',
+                                       for_=IBar, when=IObjectModifiedEvent)
+            # Both are counted.
+            self.assertEqual(len(InterestSummary.find(conn)), 2)
+            self.assertTrue(may_be_interested(bar, self.modified))
+
+
+if __name__ == '__main__':
+    unittest.main()
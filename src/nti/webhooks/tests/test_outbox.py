@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for outbox.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import has_length
+from hamcrest import is_
+
+import transaction
+from persistent import Persistent
+from zope import component
+from ZODB import DB
+from ZODB.interfaces import IDatabase
+
+from nti.webhooks import delivery_manager
+from nti.webhooks.attempts import PersistentWebhookDeliveryAttempt
+from nti.webhooks.interfaces import IWebhookDeliveryManager
+from nti.webhooks.interfaces import IWebhookDeliveryOutbox
+from nti.webhooks.outbox import DeliveryOutbox
+
+
+class PersistentMockSubscription(Persistent):
+    dialect = None
+    to = 'https://example.com/hook'
+
+
+class TestDeliveryOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.addCleanup(self.db.close)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(self.db, IDatabase)
+        self.addCleanup(gsm.unregisterUtility, self.db, IDatabase)
+
+        self.manager = delivery_manager.DefaultDeliveryManager('test')
+        self.addCleanup(self.manager._reset)
+        self.accepted = []
+        self.manager.acceptForDelivery = self.accepted.append
+        gsm.registerUtility(self.manager, IWebhookDeliveryManager)
+        self.addCleanup(gsm.unregisterUtility, self.manager, IWebhookDeliveryManager)
+
+        self.outbox = DeliveryOutbox()
+        self.outbox.recovery_grace = 0
+        self.addCleanup(self.outbox.stop)
+        gsm.registerUtility(self.outbox, IWebhookDeliveryOutbox)
+        self.addCleanup(gsm.unregisterUtility, self.outbox, IWebhookDeliveryOutbox)
+
+        self.tx_manager = transaction.TransactionManager(explicit=True)
+        self.conn = self.db.open(transaction_manager=self.tx_manager)
+        self.addCleanup(self.conn.close)
+
+    def _record(self, count=2):
+        with self.tx_manager:
+            sub = PersistentMockSubscription()
+            self.conn.add(sub)
+            attempts = []
+            for _ in range(count):
+                attempt = PersistentWebhookDeliveryAttempt()
+                attempt.payload_data = u'{}'
+                attempt.__parent__ = sub
+                attempts.append(attempt)
+            keys = self.outbox.record([(sub, attempt) for attempt in attempts])
+        return keys, attempts
+
+    def _entries(self):
+        with self.tx_manager:
+            return dict(self.conn.root()[DeliveryOutbox.ROOT_KEY])
+
+    def test_record_and_complete(self):
+        self.outbox.completion_batch_size = 2
+        keys, attempts = self._record()
+        assert_that(keys, has_length(1))
+        entries = self._entries()
+        assert_that(entries, has_length(1))
+        self.assertEqual(list(entries.values())[0][0], tuple(attempts))
+
+        # Completion is batched.
+        self.outbox.complete(keys)
+        assert_that(self._entries(), has_length(1))
+        keys2, _ = self._record()
+        self.outbox.complete(keys2)
+        assert_that(self._entries(), has_length(0))
+
+    def test_nothing_to_record(self):
+        attempt = PersistentWebhookDeliveryAttempt()
+        self.assertIsNone(self.outbox.record([(object(), attempt)]))
+
+    def test_recover(self):
+        self.outbox.claim_batch_size = 1
+        _, attempts = self._record()
+        _, resolved = self._record(1)
+        with self.tx_manager:
+            resolved[0].status = 'failed'
+        self._record()
+
+        count = self.outbox.recover(self.db)
+        self.assertEqual(count, 4)
+        assert_that(self.accepted, has_length(2))
+        shipment = self.accepted[0]
+        assert_that(shipment.work_units[0].results, has_length(2))
+        assert_that(shipment.outbox_keys, has_length(1))
+        # The resolved entry was discarded
+        assert_that(self._entries(), has_length(2))
+
+        # Everything is claimed, so nothing is recovered again...
+        self.assertEqual(self.outbox.recover(self.db), 0)
+        # ...until the claims expire.
+        self.outbox.claim_timeout = 0
+        self.assertEqual(self.outbox.recover(self.db), 4)
+
+        # Once delivered, the attempts aren't recovered.
+        with self.tx_manager:
+            for attempt in attempts:
+                attempt.status = 'successful'
+        self.accepted = []
+        self.manager.acceptForDelivery = self.accepted.append
+        self.assertEqual(self.outbox.recover(self.db), 2)
+        assert_that(self._entries(), has_length(1))
+
+    def test_recover_after_grace(self):
+        del self.outbox.recovery_grace
+        self.assertEqual(self.outbox._recovery_grace(self.manager), self.outbox.claim_timeout)
+        self.manager.shipment_deadline = 0.1
+        self._record()
+        # Too new now...
+        self.assertEqual(self.outbox.recover(self.db), 0)
+        self.assertEqual(len(self.outbox._delayed_calls), 1)
+        # ...but recovered when old enough.
+        for _ in range(50):
+            if self.accepted:
+                break
+            time.sleep(0.1)
+        assert_that(self.accepted, has_length(1))
+        self.assertEqual(len(self.outbox._delayed_calls), 0)
+
+    def test_batches_count_claimed_entries(self):
+        self.outbox.claim_batch_size = 2
+        for _ in range(3):
+            self._record(1)
+        claims = []
+        claim = self.outbox._claim
+        def counting_claim(*args):
+            result = claim(*args)
+            claims.append(result[2])
+            return result
+        self.outbox._claim = counting_claim
+        self.assertEqual(self.outbox.recover(self.db), 3)
+        # Already claimed entries are looked at in batches, too.
+        self.assertEqual(self.outbox.recover(self.db), 0)
+        self.assertEqual(claims, [2, 1, 0, 0])
+
+    def test_recover_empty(self):
+        self.assertEqual(self.outbox.recover(self.db), 0)
+
+    def test_shipment_completes_outbox(self):
+        self.outbox.completion_batch_size = 1
+        keys, attempts = self._record()
+        with self.tx_manager:
+            shipment = self.manager.createShipmentInfo(
+                [(attempt.__parent__, attempt) for attempt in attempts])
+        shipment.outbox_keys = keys
+        shipment._unit_recorded(True)
+        assert_that(self._entries(), is_({}))
+
+    def test_shipment_failure_keeps_outbox(self):
+        self.outbox.completion_batch_size = 1
+        keys, attempts = self._record()
+        with self.tx_manager:
+            shipment = self.manager.createShipmentInfo(
+                [(attempt.__parent__, attempt) for attempt in attempts])
+        shipment.outbox_keys = keys
+        shipment._unit_recorded(False)
+        assert_that(self._entries(), has_length(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
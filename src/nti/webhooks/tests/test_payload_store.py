@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for payload_store.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import requests
+import transaction
+from persistent import Persistent
+from zope.lifecycleevent import ObjectRemovedEvent
+from ZODB import DB
+
+from nti.webhooks.attempts import PersistentWebhookDeliveryAttempt
+from nti.webhooks.attempts import WebhookDeliveryAttempt
+from nti.webhooks.attempts import WebhookDeliveryAttemptRequest
+from nti.webhooks.delivery_manager import ShipmentInfo
+from nti.webhooks.payload_store import PayloadStore
+from nti.webhooks.payload_store import SharedPayload
+from nti.webhooks.payload_store import release_payload_when_removed
+from nti.webhooks.payload_store import share_payload
+from nti.webhooks.payload_store import stored_shared_payload
+
+BIG = u'{"data": "%s"}' % (u'x' * PayloadStore.min_size,)
+
+
+class Holder(Persistent):
+    pass
+
+
+class TestPayloadStore(unittest.TestCase):
+
+    def test_share_and_release(self):
+        store = PayloadStore()
+        first = store.share(BIG)
+        second = store.share(BIG)
+        self.assertIs(first, second)
+        self.assertEqual(first.references, 2)
+        self.assertIsNot(store.share(BIG + u' '), first)
+        self.assertEqual(len(store), 2)
+
+        store.release(first)
+        self.assertEqual(len(store), 2)
+        store.release(first)
+        self.assertEqual(first.references, 0)
+        self.assertEqual(len(store), 1)
+
+    def test_sweep(self):
+        store = PayloadStore()
+        payload = store.share(BIG)
+        payload._references.change(-1)
+        store.share(u'other')
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(len(store), 1)
+
+
+class TestSharedAttempts(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.addCleanup(self.db.close)
+        self.tx_manager = transaction.TransactionManager(explicit=True)
+        self.conn = self.db.open(transaction_manager=self.tx_manager)
+        self.addCleanup(self.conn.close)
+        with self.tx_manager:
+            self.sub = self.conn.root()['sub'] = Holder()
+
+    def _attempts(self, count, payload=BIG):
+        attempts = []
+        for i in range(count):
+            attempt = PersistentWebhookDeliveryAttempt()
+            attempt.payload_data = share_payload(self.sub, payload)
+            attempt.__parent__ = self.sub
+            setattr(self.sub, 'attempt%d' % i, attempt)
+            attempts.append(attempt)
+        return attempts
+
+    def test_stored_once(self):
+        with self.tx_manager:
+            attempts = self._attempts(3)
+        with self.tx_manager:
+            store = PayloadStore.find(self.conn)
+            self.assertEqual(len(store), 1)
+            shared = stored_shared_payload(attempts[0])
+            self.assertIsInstance(shared, SharedPayload)
+            self.assertEqual(shared.references, 3)
+            for attempt in attempts:
+                self.assertIs(stored_shared_payload(attempt), shared)
+                self.assertEqual(attempt.payload_data, BIG)
+
+        # Another connection sees the same.
+        tx_manager = transaction.TransactionManager()
+        conn = self.db.open(tx_manager)
+        try:
+            sub = conn.root()['sub']
+            self.assertEqual(sub.attempt2.payload_data, BIG)
+            self.assertIs(stored_shared_payload(sub.attempt1),
+                          stored_shared_payload(sub.attempt2))
+        finally:
+            tx_manager.abort()
+            conn.close()
+
+        with self.tx_manager:
+            for attempt in attempts:
+                release_payload_when_removed(attempt, ObjectRemovedEvent(attempt))
+        with self.tx_manager:
+            self.assertEqual(len(PayloadStore.find(self.conn)), 0)
+
+    def test_small_payloads_not_shared(self):
+        with self.tx_manager:
+            attempt, = self._attempts(1, u'{}')
+            self.assertIsNone(stored_shared_payload(attempt))
+            self.assertEqual(attempt.payload_data, u'{}')
+            self.assertIsNone(PayloadStore.find(self.conn))
+
+    def test_unstored_subscriptions_not_shared(self):
+        attempt = WebhookDeliveryAttempt()
+        attempt.payload_data = share_payload(Holder(), BIG)
+        self.assertIsNone(stored_shared_payload(attempt))
+        self.assertEqual(attempt.payload_data, BIG)
+
+    def test_request_body_shares_payload(self):
+        with self.tx_manager:
+            attempt, = self._attempts(1)
+            prepared = requests.Request('POST', 'https://example.com',
+                                        data=attempt.payload_data).prepare()
+            response = requests.Response()
+            response.status_code = 200
+            response.reason = 'OK'
+            response.request = prepared
+            response._content = b''
+            ShipmentInfo._fill_req_resp_from_request(attempt, response)
+            self.assertEqual(attempt.request.body, BIG)
+            self.assertIs(stored_shared_payload(attempt.request, 'body'),
+                          stored_shared_payload(attempt))
+
+            # Something else is stored as-is.
+            attempt.request.body = u'other'
+            self.assertEqual(attempt.request.body, u'other')
+            self.assertIsNone(stored_shared_payload(attempt.request, 'body'))
+
+    def test_request_body_validated(self):
+        from zope.schema.interfaces import ValidationError
+        request = WebhookDeliveryAttemptRequest()
+        with self.assertRaises(ValidationError):
+            request.body = b'bytes'
+        with self.assertRaises(ValidationError):
+            request.body = SharedPayload('digest', b'bytes')
+        self.assertIsNone(stored_shared_payload(request, 'body'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pruning.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import transaction
+from ZODB import DB
+
+from nti.webhooks.attempts import WebhookDeliveryAttemptSucceededEvent
+from nti.webhooks.pruning import global_pruning_sweeper
+from nti.webhooks.pruning import prune_subscription
+from nti.webhooks.subscriptions import PersistentSubscription
+from nti.webhooks.subscriptions import prune_subscription_when_resolved
+
+
+class TestPruning(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.addCleanup(self.db.close)
+        self.tx_manager = transaction.TransactionManager(explicit=True)
+        self.conn = self.db.open(transaction_manager=self.tx_manager)
+        self.addCleanup(self.conn.close)
+
+    def _subscription(self, statuses):
+        with self.tx_manager:
+            sub = self.conn.root()['sub'] = PersistentSubscription()
+            sub.attempt_limit = 2
+            for i, status in enumerate(statuses):
+                attempt = sub._new_deliveryAttempt()
+                sub[str(i)] = attempt
+                if status != 'pending':
+                    attempt.status = status
+        return sub
+
+    def _other_connection(self):
+        tx_manager = transaction.TransactionManager(explicit=True)
+        conn = self.db.open(transaction_manager=tx_manager)
+        self.addCleanup(conn.close)
+        return tx_manager, conn
+
+    def test_oldest_resolved_removed(self):
+        self._subscription(['failed', 'pending', 'successful', 'failed', 'successful'])
+        tx_manager, conn = self._other_connection()
+        with tx_manager:
+            sub = conn.root()['sub']
+            self.assertEqual(prune_subscription(sub), 3)
+            self.assertEqual(list(sub), ['1', '4'])
+        # Only what was removed was loaded.
+        self.assertEqual(sub['4']._p_status, 'ghost')
+
+    def test_index_built_when_missing(self):
+        sub = self._subscription(['successful', 'failed', 'pending'])
+        with self.tx_manager:
+            # As if stored before the index was kept.
+            del sub._resolved_attempt_keys
+            self.assertEqual(prune_subscription(sub), 1)
+            self.assertEqual(list(sub), ['1', '2'])
+            self.assertEqual(list(sub._resolved_attempt_keys), ['1'])
+
+    def test_in_background(self):
+        self.addCleanup(global_pruning_sweeper._reset)
+        global_pruning_sweeper.tick_interval = 1000
+        self.addCleanup(delattr, global_pruning_sweeper, 'tick_interval')
+        sub = self._subscription(['successful', 'successful', 'pending'])
+        with self.tx_manager:
+            sub.prune_in_background = True
+            attempt = sub['2']
+            attempt.status = 'successful'
+            prune_subscription_when_resolved(WebhookDeliveryAttemptSucceededEvent(attempt))
+            self.assertEqual(len(sub), 3)
+            self.assertEqual(global_pruning_sweeper.pending_count(), 0)
+
+        self.assertEqual(global_pruning_sweeper.pending_count(), 1)
+        self.assertEqual(global_pruning_sweeper.tick(self.db), 1)
+        self.assertEqual(global_pruning_sweeper.pending_count(), 0)
+        with self.tx_manager:
+            self.assertEqual(list(sub), ['1', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
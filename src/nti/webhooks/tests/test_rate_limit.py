@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for rate_limit.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from nti.webhooks.rate_limit import DestinationRateLimiter
+from nti.webhooks.rate_limit import TokenBucket
+
+
+class Dialect(object):
+    rate_limit = None
+    rate_limit_burst = None
+    subscription_rate_limit = None
+    subscription_rate_limit_burst = None
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_refill(self):
+        bucket = TokenBucket(2.0, 3, now=0)
+        for _ in range(3):
+            self.assertEqual(bucket.wait_time(0), 0)
+            bucket.take()
+        self.assertEqual(bucket.wait_time(0), 0.5)
+        self.assertEqual(bucket.wait_time(0.25), 0.25)
+        self.assertEqual(bucket.wait_time(0.5), 0)
+        self.assertFalse(bucket.full(1.0))
+        self.assertTrue(bucket.full(10))
+        self.assertEqual(bucket.tokens, 3)
+
+
+class TestDestinationRateLimiter(unittest.TestCase):
+
+    def test_no_limits(self):
+        limiter = DestinationRateLimiter()
+        for _ in range(10):
+            self.assertEqual(limiter.acquire('a', 1, Dialect()), 0)
+        self.assertEqual(len(limiter), 0)
+        self.assertEqual(limiter.acquire('a', 1, object()), 0)
+
+    def test_host_limit(self):
+        limiter = DestinationRateLimiter()
+        dialect = Dialect()
+        dialect.rate_limit = 0.001
+        dialect.rate_limit_burst = 2
+        self.assertEqual(limiter.acquire('a', 1, dialect), 0)
+        self.assertEqual(limiter.acquire('a', 2, dialect), 0)
+        self.assertGreater(limiter.acquire('a', 3, dialect), 900)
+        self.assertEqual(limiter.acquire('b', 1, dialect), 0)
+        self.assertEqual(limiter.throttled_count, 1)
+
+    def test_subscription_limit(self):
+        limiter = DestinationRateLimiter()
+        dialect = Dialect()
+        dialect.subscription_rate_limit = 0.001
+        self.assertEqual(limiter.acquire('a', 1, dialect), 0)
+        self.assertGreater(limiter.acquire('a', 1, dialect), 0)
+        self.assertEqual(limiter.acquire('a', 2, dialect), 0)
+
+    def test_dialects_with_different_host_limits(self):
+        limiter = DestinationRateLimiter()
+        slow = Dialect()
+        slow.rate_limit = 0.001
+        fast = Dialect()
+        fast.rate_limit = 1000
+        fast.rate_limit_burst = 5
+        self.assertEqual(limiter.acquire('a', 1, slow), 0)
+        for _ in range(5):
+            self.assertEqual(limiter.acquire('a', 2, fast), 0)
+        # Each keeps its own bucket for the host.
+        self.assertGreater(limiter.acquire('a', 1, slow), 900)
+        self.assertEqual(len(limiter), 2)
+        self.assertLess(limiter._buckets[('host', 'a', 0.001, 1)].tokens, 1)
+
+    def test_throttled_takes_nothing(self):
+        limiter = DestinationRateLimiter()
+        dialect = Dialect()
+        dialect.rate_limit = 1000
+        dialect.rate_limit_burst = 5
+        dialect.subscription_rate_limit = 0.001
+        self.assertEqual(limiter.acquire('a', 1, dialect), 0)
+        for _ in range(10):
+            self.assertGreater(limiter.acquire('a', 1, dialect), 0)
+        # The host bucket wasn't drained by the throttled requests.
+        self.assertGreaterEqual(limiter._buckets[('host', 'a', 1000, 5)].tokens, 4)
+
+    def test_forgets_full_buckets(self):
+        limiter = DestinationRateLimiter()
+        limiter.max_buckets = 2
+        dialect = Dialect()
+        dialect.rate_limit = 0.001
+        limiter.acquire('a', 1, dialect)
+        limiter.acquire('b', 1, dialect)
+        # Both are empty; nothing to forget.
+        limiter.acquire('c', 1, dialect)
+        self.assertEqual(len(limiter), 3)
+        # Once they've refilled, they are forgotten.
+        for bucket in limiter._buckets.values():
+            bucket.updated -= 10000
+        self.assertEqual(limiter.acquire('d', 1, dialect), 0)
+        self.assertEqual(list(limiter._buckets), [('host', 'd', 0.001, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for retries.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import has_length
+from hamcrest import has_properties
+
+import transaction
+from persistent import Persistent
+from persistent.list import PersistentList
+from zope import component
+from ZODB import DB
+from ZODB.interfaces import IDatabase
+
+from nti.webhooks import delivery_manager
+from nti.webhooks import retries
+from nti.webhooks.attempts import PersistentWebhookDeliveryAttempt
+from nti.webhooks.attempts import WebhookDeliveryAttemptFailedEvent
+from nti.webhooks.dialect import DefaultWebhookDialect
+from nti.webhooks.interfaces import IWebhookDeliveryManager
+
+
+class RetryingDialect(DefaultWebhookDialect):
+    retry_limit = 2
+    retry_initial_delay = 10.0
+    retry_max_delay = 100.0
+    retry_jitter = 0.0
+
+
+class PersistentMockSubscription(Persistent):
+    active = True
+    to = 'https://example.com/hook'
+    dialect = RetryingDialect()
+
+    def __init__(self):
+        self.attempts = PersistentList()
+
+    def createDeliveryAttempt(self, payload_data):
+        attempt = PersistentWebhookDeliveryAttempt()
+        attempt.payload_data = payload_data
+        attempt.__parent__ = self
+        self.attempts.append(attempt)
+        return attempt
+
+
+class TestFunctions(unittest.TestCase):
+
+    def test_compute_retry_delay(self):
+        delay = retries.compute_retry_delay
+        self.assertEqual(delay(0, 10, 2, 100, 0), 10)
+        self.assertEqual(delay(3, 10, 2, 100, 0), 80)
+        self.assertEqual(delay(4, 10, 2, 100, 0), 100)
+        self.assertEqual(delay(1, 10, 2, 100, 0.5, lambda: 1.0), 10)
+        self.assertEqual(delay(1, 10, 2, 100, 1.0, lambda: 0.25), 15)
+
+    def test_retry_setting(self):
+        sub = PersistentMockSubscription()
+        self.assertEqual(retries.retry_setting(sub, 'retry_limit'), 2)
+        self.assertEqual(retries.retry_setting(sub, 'retry_backoff_multiplier'), 2.0)
+        sub.retry_limit = 5
+        self.assertEqual(retries.retry_setting(sub, 'retry_limit'), 5)
+
+    def test_is_retryable(self):
+        attempt = PersistentWebhookDeliveryAttempt()
+        self.assertTrue(retries.is_retryable(attempt))
+        for status, expected in ((500, True), (404, False), (429, True)):
+            attempt.response.status_code = status
+            self.assertEqual(retries.is_retryable(attempt), expected)
+
+
+class TestRetryScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(None)
+        self.addCleanup(self.db.close)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(self.db, IDatabase)
+        self.addCleanup(gsm.unregisterUtility, self.db, IDatabase)
+
+        self.manager = delivery_manager.DefaultDeliveryManager('test')
+        self.addCleanup(self.manager._reset)
+        self.accepted = []
+        self.manager.acceptForDelivery = self.accepted.append
+        gsm.registerUtility(self.manager, IWebhookDeliveryManager)
+        self.addCleanup(gsm.unregisterUtility, self.manager, IWebhookDeliveryManager)
+
+        self.scheduler = retries.global_retry_scheduler
+        self.addCleanup(self.scheduler.stop)
+        self.tx_manager = transaction.TransactionManager(explicit=True)
+        self.conn = self.db.open(transaction_manager=self.tx_manager)
+        self.addCleanup(self.conn.close)
+
+    def _fail(self, count=1, retry_number=0, active=True):
+        with self.tx_manager:
+            sub = self.conn.root()['sub'] = PersistentMockSubscription()
+            self.conn.add(sub)
+            sub.active = active
+            attempts = []
+            for _ in range(count):
+                attempt = sub.createDeliveryAttempt(u'{}')
+                attempt.retry_number = retry_number
+                attempt.status = 'failed'
+                retries.schedule_retry_when_failed(WebhookDeliveryAttemptFailedEvent(attempt))
+                attempts.append(attempt)
+        return sub, attempts
+
+    def test_retry_when_due(self):
+        before = time.time()
+        sub, _ = self._fail()
+        self.assertEqual(self.scheduler.pending_count(self.db), 1)
+
+        self.assertEqual(self.scheduler.tick(now=before + 5), 0)
+        self.assertEqual(self.scheduler.tick(now=time.time() + 10), 1)
+        self.assertEqual(self.scheduler.pending_count(self.db), 0)
+
+        shipment, = self.accepted
+        assert_that(shipment.work_units[0].results, has_length(1))
+        with self.tx_manager:
+            sub = self.conn.root()['sub']
+            assert_that(sub.attempts, has_length(2))
+            assert_that(sub.attempts[1], has_properties(retry_number=1,
+                                                        payload_data=u'{}',
+                                                        status='pending'))
+
+    def test_limit_reached(self):
+        self._fail(retry_number=2)
+        self.assertEqual(self.scheduler.pending_count(self.db), 0)
+
+    def test_inactive_not_scheduled(self):
+        self._fail(active=False)
+        self.assertEqual(self.scheduler.pending_count(self.db), 0)
+
+    def test_deactivated_before_due(self):
+        self._fail()
+        with self.tx_manager:
+            self.conn.root()['sub'].active = False
+        self.assertEqual(self.scheduler.tick(now=time.time() + 10), 0)
+        self.assertEqual(self.scheduler.pending_count(self.db), 0)
+
+    def test_batches_per_tick(self):
+        self.scheduler.batch_size = 1
+        self.scheduler.batches_per_tick = 2
+        self.addCleanup(self.scheduler.__dict__.pop, 'batch_size')
+        self.addCleanup(self.scheduler.__dict__.pop, 'batches_per_tick')
+        self._fail(count=3)
+
+        self.assertEqual(self.scheduler.tick(now=time.time() + 10), 2)
+        assert_that(self.accepted, has_length(2))
+        self.assertEqual(self.scheduler.tick(now=time.time() + 10), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
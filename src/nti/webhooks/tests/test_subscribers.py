@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for subscribers.py
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from zope import component
+from zope.interface.registry import Components
+
+from nti.webhooks import _util
+from nti.webhooks.interfaces import IWebhookSubscriptionManager
+from nti.webhooks.subscribers import SubscriptionManagerCache
+from nti.webhooks.subscriptions import GlobalWebhookSubscriptionManager
+from nti.webhooks.subscriptions import global_subscription_manager
+from nti.webhooks.tests import WebhookLayer
+
+
+class TestSubscriptionManagerCache(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def setUp(self):
+        self.cache = SubscriptionManagerCache()
+        self.gsm = component.getGlobalSiteManager()
+        # Acting as the site manager of the data is the data itself.
+        self.data = Components('local', bases=(self.gsm,))
+        self.local_manager = GlobalWebhookSubscriptionManager('local')
+        self.data.registerUtility(self.local_manager, IWebhookSubscriptionManager)
+
+    def _register_global(self, name):
+        manager = GlobalWebhookSubscriptionManager(name)
+        self.gsm.registerUtility(manager, IWebhookSubscriptionManager, name)
+        self.addCleanup(self.gsm.unregisterUtility, manager, IWebhookSubscriptionManager, name)
+        return manager
+
+    def test_cached(self):
+        managers = self.cache.find(self.data)
+        self.assertEqual(managers, [global_subscription_manager, self.local_manager])
+        self.assertEqual(self.cache.find(self.data), managers)
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+
+    def test_registering_invalidates(self):
+        self.cache.find(self.data)
+        other = GlobalWebhookSubscriptionManager('other')
+        self.data.registerUtility(other, IWebhookSubscriptionManager, 'other')
+        self.assertIn(other, self.cache.find(self.data))
+
+        # Changes to the bases are seen too.
+        global_manager = self._register_global('global')
+        self.assertIn(global_manager, self.cache.find(self.data))
+        self.assertEqual((self.cache.misses, self.cache.hits), (3, 0))
+
+    def test_bases_changes_invalidate(self):
+        self.assertNotIn(self.local_manager, self.cache.find(Components('other')))
+        base = Components('base')
+        base_manager = GlobalWebhookSubscriptionManager('base')
+        base.registerUtility(base_manager, IWebhookSubscriptionManager)
+        self.cache.find(self.data)
+        self.data.__bases__ = (base, self.gsm)
+        self.assertIn(base_manager, self.cache.find(self.data))
+        self.assertEqual((self.cache.misses, self.cache.hits), (3, 0))
+
+    def test_registration_events_invalidate_without_generations(self):
+        # If the registries stop keeping the private generation counter,
+        # registration events still invalidate.
+        self.addCleanup(setattr, _util, '_registry_generation', _util._registry_generation)
+        _util._registry_generation = lambda registry: None
+        self.cache.find(self.data)
+        self.assertEqual(len(self.cache.find(self.data)), 2)
+        other = GlobalWebhookSubscriptionManager('other')
+        self.data.registerUtility(other, IWebhookSubscriptionManager, 'other')
+        self.assertIn(other, self.cache.find(self.data))
+        self.data.unregisterUtility(other, IWebhookSubscriptionManager, 'other')
+        self.assertNotIn(other, self.cache.find(self.data))
+        self.assertEqual((self.cache.misses, self.cache.hits), (3, 1))
+
+    def test_least_recently_used_forgotten(self):
+        self.cache.max_entries = 1
+        other = Components('other', bases=(self.gsm,))
+        self.cache.find(self.data)
+        self.cache.find(other)
+        self.cache.find(self.data)
+        self.assertEqual((self.cache.misses, self.cache.hits), (3, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,8 @@ from __future__ import print_function
 
 
 import unittest
+
+import transaction
 from hamcrest import assert_that
 from hamcrest import is_
 from hamcrest import is_not
@@ -17,10 +19,16 @@ from hamcrest import has_properties
 
 from persistent import Persistent
 from zope import component
+from zope.interface import Interface
+from zope.interface import implementer
+from zope.interface.registry import Components
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
 
 from nti.webhooks import subscriptions
 
 from nti.webhooks.tests import DCTimesMixin
+from nti.webhooks.tests import WebhookLayer
 
 class TestPersistentSubscriptionManager(DCTimesMixin,
                                         unittest.TestCase):
@@ -68,3 +76,243 @@ class TestPersistentSubscription(TestSubscription):
 
     def test_persistent(self):
         assert_that(self._makeOne(), is_(Persistent))
+
+
+class IThing(Interface):
+    pass
+
+
+@implementer(IThing)
+class _Thing(object):
+    pass
+
+
+class TestSecurityLookupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = subscriptions.SecurityLookupCache()
+        # The data acts as its own site manager.
+        self.data = Components('local', bases=(component.getGlobalSiteManager(),))
+        self.lookups = []
+
+    def _lookup(self, data, cacheable=True):
+        self.lookups.append(data)
+        return len(self.lookups), cacheable
+
+    def _find(self, name='bob', ttl=None, lookup=None):
+        return self.cache.find('principal', name, self.data, lookup or self._lookup, ttl)
+
+    def test_cached(self):
+        assert_that(self._find(), is_(1))
+        assert_that(self._find(), is_(1))
+        assert_that(self._find('alice'), is_(2))
+        assert_that(self.cache, has_properties(hits=1, misses=2))
+
+    def test_not_cacheable(self):
+        lookup = lambda data: self._lookup(data, False)
+        self._find(lookup=lookup)
+        assert_that(self._find(lookup=lookup), is_(2))
+
+    def test_expires(self):
+        self._find(ttl=-1)
+        assert_that(self._find(ttl=-1), is_(2))
+
+    def test_ttl_zero_not_remembered(self):
+        self._find(ttl=0)
+        assert_that(self._find(ttl=0), is_(2))
+
+    def test_invalidate_principal(self):
+        self._find()
+        self._find('alice')
+        self.cache.invalidate('bob')
+        assert_that(self._find(), is_(3))
+        assert_that(self._find('alice'), is_(2))
+
+    def test_registration_changes_invalidate(self):
+        self._find()
+        self.data.registerUtility(object(), IThing)
+        assert_that(self._find(), is_(2))
+        # Including in the bases.
+        gsm = component.getGlobalSiteManager()
+        thing = object()
+        gsm.registerUtility(thing, IThing)
+        self.addCleanup(gsm.unregisterUtility, thing, IThing)
+        assert_that(self._find(), is_(3))
+        assert_that(self._find(), is_(3))
+
+
+class _Principal(object):
+    id = 'bob'
+
+
+class _CountingSubscription(subscriptions.PersistentSubscription):
+    lookups = 0
+    principal = _Principal()
+
+    def _find_principal(self, data):
+        self.lookups += 1
+        return self.principal
+
+    def _find_permission(self, data):
+        return object()
+
+
+class _UncachedPrincipalSubscription(_CountingSubscription):
+
+    def _find_principal(self, data):
+        # As when principals aren't cached: a new object each time.
+        self.lookups += 1
+        return _Principal()
+
+
+class TestSecurityMemo(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def setUp(self):
+        self.tx_manager = transaction.TransactionManager(explicit=True)
+        self.tx = self.tx_manager.begin()
+        self.addCleanup(self.tx_manager.abort)
+        self.sub = _CountingSubscription(owner_id=u'bob', permission_id=u'zope.View')
+        self.data = object()
+
+    def test_reused_in_transaction(self):
+        with subscriptions.remember_security_decisions(self.tx):
+            # The (paranoid) security policy denies access.
+            assert_that(self.sub(self.data, None), is_(None))
+        with subscriptions.remember_security_decisions(self.tx):
+            assert_that(self.sub(self.data, None), is_(None))
+            assert_that(self.sub.lookups, is_(1))
+            self.sub(object(), None)
+        assert_that(self.sub.lookups, is_(2))
+
+    def test_forgotten_at_transaction_end(self):
+        with subscriptions.remember_security_decisions(self.tx):
+            self.sub(self.data, None)
+        self.tx_manager.abort()
+        with subscriptions.remember_security_decisions(self.tx_manager.begin()):
+            self.sub(self.data, None)
+        assert_that(self.sub.lookups, is_(2))
+
+    def test_not_remembered_outside(self):
+        self.sub(self.data, None)
+        self.sub(self.data, None)
+        assert_that(self.sub.lookups, is_(2))
+
+    def test_missing_principal_not_remembered(self):
+        self.sub.principal = None
+        with subscriptions.remember_security_decisions(self.tx):
+            self.sub(self.data, None)
+            self.sub(self.data, None)
+        assert_that(self.sub.lookups, is_(2))
+        assert_that(self.sub._delivery_applicable_precondition_failed.value, is_(2))
+
+    def test_isApplicable_memoized(self):
+        self.sub.for_ = Interface
+        with subscriptions.remember_security_decisions(self.tx):
+            self.sub.isApplicable(self.data)
+            self.sub(self.data, None)
+        assert_that(self.sub.lookups, is_(1))
+
+
+class TestSubscriptionsToDeliver(unittest.TestCase):
+
+    layer = WebhookLayer
+
+    def setUp(self):
+        from nti.webhooks import interest
+        self.addCleanup(interest._reset)
+        self.checks = []
+        def checkPermission(permission_id, data):
+            self.checks.append(permission_id)
+            return True
+        self.addCleanup(setattr, subscriptions, 'checkPermission', subscriptions.checkPermission)
+        subscriptions.checkPermission = checkPermission
+        self.manager = subscriptions.PersistentWebhookSubscriptionManager()
+
+    def _create(self, permission_id=u'zope.View', factory=_CountingSubscription):
+        # Not stored, so no permissions are granted to it.
+        subscription = factory(to=u'https://example.com/hook', for_=IThing,
+                               when=IObjectModifiedEvent, owner_id=u'bob',
+                               permission_id=permission_id)
+        subscription.__parent__ = self.manager
+        self.manager.activateSubscription(subscription)
+        return subscription
+
+    def test_one_check_per_principal_and_permission(self):
+        subs = [self._create(), self._create(), self._create(u'zope.ManageContent')]
+        data = _Thing()
+        delivered = self.manager.subscriptionsToDeliver(data, ObjectModifiedEvent(data))
+        assert_that(sorted(delivered, key=id), is_(sorted(subs, key=id)))
+        assert_that(sorted(self.checks), is_([u'zope.ManageContent', u'zope.View']))
+
+    def test_distinct_principal_objects_share_checks(self):
+        factory = _UncachedPrincipalSubscription
+        subs = [self._create(factory=factory), self._create(factory=factory)]
+        data = _Thing()
+        delivered = self.manager.subscriptionsToDeliver(data, ObjectModifiedEvent(data))
+        assert_that(sorted(delivered, key=id), is_(sorted(subs, key=id)))
+        assert_that(self.checks, is_([u'zope.View']))
+
+    def test_precondition_failures_counted(self):
+        self.addCleanup(setattr, _CountingSubscription, 'principal',
+                        _CountingSubscription.principal)
+        _CountingSubscription.principal = None
+        subs = [self._create(), self._create()]
+        data = _Thing()
+        assert_that(self.manager.subscriptionsToDeliver(data, ObjectModifiedEvent(data)), is_([]))
+        assert_that(self.checks, is_([]))
+        for sub in subs:
+            assert_that(sub._delivery_applicable_precondition_failed.value, is_(1))
+
+
+class TestAttemptCounts(unittest.TestCase):
+
+    def _makeOne(self):
+        return subscriptions.PersistentSubscription()
+
+    def _add(self, sub, name, status=None):
+        attempt = sub._new_deliveryAttempt()
+        sub[name] = attempt
+        if status:
+            attempt.status = status
+        return attempt
+
+    def test_counts_follow_attempts(self):
+        sub = self._makeOne()
+        self._add(sub, u'a')
+        self._add(sub, u'b', 'failed')
+        self._add(sub, u'c', 'successful')
+        assert_that(sub.attemptCounts(), is_({'pending': 1, 'failed': 1, 'successful': 1}))
+        del sub[u'b']
+        sub[u'a'].status = 'successful'
+        assert_that(sub.attemptCounts(), is_({'pending': 0, 'failed': 0, 'successful': 2}))
+
+    def _makeLegacy(self):
+        sub = self._makeOne()
+        self._add(sub, u'a', 'failed')
+        self._add(sub, u'b')
+        # As if stored before counts were kept.
+        del sub._attempt_counts
+        return sub
+
+    def test_counted_without_storing_when_missing(self):
+        sub = self._makeLegacy()
+        assert_that(sub.attemptCounts(), is_({'pending': 1, 'failed': 1, 'successful': 0}))
+        self.assertNotIn('_attempt_counts', sub.__dict__)
+
+    def test_stored_when_attempts_change(self):
+        sub = self._makeLegacy()
+        self._add(sub, u'c')
+        self.assertIn('_attempt_counts', sub.__dict__)
+        assert_that(sub.attemptCounts(), is_({'pending': 2, 'failed': 1, 'successful': 0}))
+
+        sub = self._makeLegacy()
+        sub[u'b'].status = 'successful'
+        self.assertIn('_attempt_counts', sub.__dict__)
+        assert_that(sub.attemptCounts(), is_({'pending': 0, 'failed': 1, 'successful': 1}))
+
+        sub = self._makeLegacy()
+        del sub[u'a']
+        self.assertIn('_attempt_counts', sub.__dict__)
+        assert_that(sub.attemptCounts(), is_({'pending': 1, 'failed': 0, 'successful': 0}))
@@ -13,6 +13,10 @@ from zope.configuration.fields import Text
 from zope.interface import Interface
 
 from zope.security.zcml import Permission
+from zope.schema import Bool
+from zope.schema import Choice
+from zope.schema import Float
+from zope.schema import Int
 from zope.schema import TextLine
 
 from nti.webhooks.subscriptions import getGlobalSubscriptionManager
@@ -162,6 +166,129 @@ class IDialectDirective(Interface):
         required=False,
     )
 
+    payload_cache_key = Choice(
+        title=u"What the externalized data depends on.",
+        description=u"""
+        One of ``data`` (the default), ``data+event_type`` or ``data+event``.
+        Payloads are only externalized once for each distinct key.
+        """,
+        values=(u'data', u'data+event_type', u'data+event'),
+        required=False,
+    )
+
+    defer_payload_rendering = Bool(
+        title=u"Render payloads after the transaction commits?",
+        required=False,
+    )
+
+    coalescing_policy = TextLine(
+        title=u"The name of the event coalescing policy to use.",
+        description=u"""
+        Decides which of the events fired for one object in one
+        transaction are delivered, for example ``first``, ``last``
+        or ``merge-modified``. By default, all of them are.
+        """,
+        required=False,
+    )
+
+    connect_timeout = Float(
+        title=u"Seconds to wait to connect to the receiver.",
+        min=0.0,
+        required=False,
+    )
+
+    read_timeout = Float(
+        title=u"Seconds to wait for each part of the response.",
+        min=0.0,
+        required=False,
+    )
+
+    total_timeout = Float(
+        title=u"Seconds the whole response may take.",
+        min=0.0,
+        required=False,
+    )
+
+    retry_limit = Int(
+        title=u"How many times to retry failed deliveries.",
+        min=0,
+        required=False,
+    )
+
+    retry_initial_delay = Float(
+        title=u"Seconds to wait before the first retry.",
+        min=0.0,
+        required=False,
+    )
+
+    retry_backoff_multiplier = Float(
+        title=u"How much longer each retry waits than the one before.",
+        min=1.0,
+        required=False,
+    )
+
+    retry_max_delay = Float(
+        title=u"The most seconds to wait before a retry.",
+        min=0.0,
+        required=False,
+    )
+
+    retry_jitter = Float(
+        title=u"The fraction of each wait that is random.",
+        min=0.0,
+        max=1.0,
+        required=False,
+    )
+
+    rate_limit = Float(
+        title=u"The most requests per second to send to a destination host.",
+        min=0.0,
+        required=False,
+    )
+
+    rate_limit_burst = Int(
+        title=u"The most requests to send to a destination host in a burst.",
+        min=1,
+        required=False,
+    )
+
+    subscription_rate_limit = Float(
+        title=u"The most requests per second to send for a subscription.",
+        min=0.0,
+        required=False,
+    )
+
+    subscription_rate_limit_burst = Int(
+        title=u"The most requests to send for a subscription in a burst.",
+        min=1,
+        required=False,
+    )
+
+    failure_ratio_limit = Float(
+        title=u"The fraction of recent deliveries that may fail before deactivating.",
+        min=0.0,
+        max=1.0,
+        required=False,
+    )
+
+    failure_window_size = Int(
+        title=u"How many recent delivery results to consider.",
+        min=1,
+        required=False,
+    )
+
+    failure_window_seconds = Float(
+        title=u"Only consider delivery results from this many seconds ago or later.",
+        min=0.0,
+        required=False,
+    )
+
+    failure_window_minimum = Int(
+        title=u"The fewest delivery results to consider before deactivating.",
+        min=1,
+        required=False,
+    )
+
 def _static_subscription_action(subscription_kwargs):
     getGlobalSubscriptionManager().createSubscription(**subscription_kwargs)
 